@@ -0,0 +1,211 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import database
+from config.config import DB_READER_THREADS
+
+# Асинхронные обёртки над database: запросы выполняются в пулах потоков и не блокируют event loop.
+# Все записи идут через один поток — они сериализуются и не конкурируют за блокировку SQLite.
+# Чтения выполняются параллельно в отдельном пуле (WAL не блокирует читателей во время записи).
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+_readers = ThreadPoolExecutor(max_workers=DB_READER_THREADS, thread_name_prefix="db-reader")
+
+async def _read(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_readers, functools.partial(func, *args, **kwargs))
+
+async def _write(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_writer, functools.partial(func, *args, **kwargs))
+
+###############################
+# ПОДПИСКИ
+###############################
+async def add_subscription(telegram_user_id: int, username: str):
+    """
+    Добавление подписки для пользователя.
+    """
+    await _write(database.add_subscription, telegram_user_id, username)
+
+async def remove_subscription(telegram_user_id: int, username: str):
+    """
+    Удаление подписки для пользователя.
+    """
+    await _write(database.remove_subscription, telegram_user_id, username)
+
+async def get_subscriptions(telegram_user_id: int = None):
+    """
+    Получение списка подписок.
+    """
+    return await _read(database.get_subscriptions, telegram_user_id)
+
+async def get_subscriptions_grouped(username: str = None) -> dict:
+    """
+    Получение подписок, сгруппированных по никнейму Instagram.
+    """
+    return await _read(database.get_subscriptions_grouped, username)
+
+async def update_last_sent_post_ids(updates: list):
+    """
+    Пакетное обновление последних ID публикаций.
+    """
+    await _write(database.update_last_sent_post_ids, updates)
+
+async def update_high_water_marks(updates: list):
+    """
+    Пакетное обновление отметок уровня подписок.
+    """
+    await _write(database.update_high_water_marks, updates)
+
+###############################
+# КЭШ FILE_ID TELEGRAM
+###############################
+async def get_cached_files(media_id: str) -> dict:
+    """
+    Получение сохранённых file_id Telegram для медиа Instagram.
+    """
+    return await _read(database.get_cached_files, media_id)
+
+async def save_file_id(media_id: str, node_index: int, file_id: str, media_type: str):
+    """
+    Сохранение file_id Telegram.
+    """
+    await _write(database.save_file_id, media_id, node_index, file_id, media_type)
+
+async def delete_file_ids(entries: list):
+    """
+    Удаление недействительных file_id Telegram.
+    """
+    await _write(database.delete_file_ids, entries)
+
+###############################
+# НАСТРОЙКИ ПОЛЬЗОВАТЕЛЕЙ
+###############################
+async def get_user_lang(telegram_user_id: int):
+    """
+    Получение сохранённого языка пользователя.
+    """
+    return await _read(database.get_user_lang, telegram_user_id)
+
+async def save_user_langs(langs: list):
+    """
+    Пакетное сохранение языков пользователей.
+    """
+    await _write(database.save_user_langs, langs)
+
+async def get_user_state(store: str, telegram_user_id: int):
+    """
+    Получение сохранённого состояния пользователя.
+    """
+    return await _read(database.get_user_state, store, telegram_user_id)
+
+async def save_user_states(states: list):
+    """
+    Пакетное сохранение состояния пользователей.
+    """
+    await _write(database.save_user_states, states)
+
+async def purge_user_states() -> int:
+    """
+    Удаление истёкшего состояния пользователей.
+    """
+    return await _write(database.purge_user_states)
+
+###############################
+# ЖУРНАЛ ДОСТАВЛЕННЫХ ИСТОРИЙ
+###############################
+async def get_seen_story_ids(username: str) -> dict:
+    """
+    Получение уже доставленных историй аккаунта.
+    """
+    return await _read(database.get_seen_story_ids, username)
+
+async def mark_stories_seen(entries: list):
+    """
+    Пакетная запись доставленных историй.
+    """
+    await _write(database.mark_stories_seen, entries)
+
+async def purge_seen_stories() -> int:
+    """
+    Удаление записей об истёкших историях.
+    """
+    return await _write(database.purge_seen_stories)
+
+###############################
+# ЗАДАНИЯ ПРОВЕРКИ ПРОФИЛЕЙ
+###############################
+async def sync_poll_jobs(initial_interval: float):
+    """
+    Синхронизация заданий проверки со списком подписок.
+    """
+    await _write(database.sync_poll_jobs, initial_interval)
+
+async def claim_poll_jobs(owner: str, limit: int, lease_time: float, retry_delay: float, max_retry_delay: float) -> list:
+    """
+    Аренда подошедших заданий проверки.
+    """
+    return await _write(database.claim_poll_jobs, owner, limit, lease_time, retry_delay, max_retry_delay)
+
+async def extend_poll_job_leases(owner: str, usernames: list, lease_time: float):
+    """
+    Продление аренды заданий.
+    """
+    await _write(database.extend_poll_job_leases, owner, usernames, lease_time)
+
+async def complete_poll_jobs(owner: str, entries: list):
+    """
+    Завершение заданий с планированием следующих проверок.
+    """
+    await _write(database.complete_poll_jobs, owner, entries)
+
+async def release_poll_jobs(owner: str, entries: list):
+    """
+    Снятие аренды с неудачных заданий.
+    """
+    await _write(database.release_poll_jobs, owner, entries)
+
+async def get_next_poll_job_at():
+    """
+    Время ближайшего задания проверки.
+    """
+    return await _read(database.get_next_poll_job_at)
+
+###############################
+# ИСХОДЯЩАЯ ОЧЕРЕДЬ TELEGRAM
+###############################
+async def enqueue_outbox(messages: list):
+    """
+    Постановка сообщений в исходящую очередь.
+    """
+    await _write(database.enqueue_outbox, messages)
+
+async def claim_outbox(owner: str, limit: int, lease_time: float, exclude_ids=()) -> list:
+    """
+    Аренда сообщений, готовых к отправке.
+    """
+    return await _write(database.claim_outbox, owner, limit, lease_time, exclude_ids)
+
+async def extend_outbox_lease(outbox_id: int, owner: str, lease_time: float):
+    """
+    Продление аренды отправляемого сообщения.
+    """
+    await _write(database.extend_outbox_lease, outbox_id, owner, lease_time)
+
+async def retry_outbox(outbox_id: int, owner: str, next_attempt_at: float, error: str, count_attempt: bool = True):
+    """
+    Возврат сообщения в очередь для повторной отправки.
+    """
+    await _write(database.retry_outbox, outbox_id, owner, next_attempt_at, error, count_attempt)
+
+async def complete_outbox(outbox_id: int):
+    """
+    Удаление сообщения из очереди.
+    """
+    await _write(database.complete_outbox, outbox_id)
+
+async def get_next_outbox_at():
+    """
+    Время готовности ближайшего сообщения очереди.
+    """
+    return await _read(database.get_next_outbox_at)
@@ -0,0 +1,254 @@
+import copy
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import instagram_parser
+import media_cache
+from state_store import ExpiringStore
+from metrics import cache_lookup
+from config.config import (
+    INSTAGRAM_WORKERS, INSTAGRAM_INTERACTIVE_WORKERS, STREAM_MAX_VIDEO_BYTES,
+    PREFETCH_POSTS, PREFETCH_CONCURRENCY, PREFETCH_TTL, PREFETCH_CACHE_SIZE
+)
+
+# Вся блокирующая работа Instaloader выполняется в отдельных пулах потоков,
+# чтобы медленный ответ Instagram не останавливал event loop бота.
+# Фоновая работа (проверки планировщика, скачивание, упреждающая загрузка):
+_executor = ThreadPoolExecutor(max_workers=INSTAGRAM_WORKERS, thread_name_prefix="instagram")
+# Запросы из хендлеров — свой пул: нажатие пользователя не ждёт в очереди за циклом проверок
+_interactive_executor = ThreadPoolExecutor(
+    max_workers=INSTAGRAM_INTERACTIVE_WORKERS, thread_name_prefix="instagram-interactive"
+)
+
+# Запросы, которые выполняются прямо сейчас: {(операция, *аргументы): {"future": ..., "waiters": int}}.
+# Одинаковые запросы объединяются (single-flight): результат одного получают все ожидающие.
+_in_flight = {}
+
+# Посты, загруженные заранее, пока пользователь листает ленту: {(username, index): post}
+_prefetched = ExpiringStore(PREFETCH_TTL, PREFETCH_CACHE_SIZE)
+# Упреждающая загрузка каждого пользователя: {user_id: asyncio.Task}
+_prefetch_tasks = {}
+# Сколько упреждающих загрузок идёт одновременно (на всех пользователей)
+_prefetch_slots = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+async def _run(func, *args, executor: ThreadPoolExecutor = None, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor or _executor, functools.partial(func, *args, **kwargs))
+
+def _land(key, flight: dict, files, future: asyncio.Future) -> None:
+    """
+    Запрос завершён: новые ожидающие больше не присоединяются,
+    каждый из уже ожидающих становится держателем файлов медиакэша
+    (одно закрепление уже сделал сам запрос).
+    """
+    if _in_flight.get(key) is flight:
+        del _in_flight[key]
+    if files is None or future.cancelled() or future.exception() is not None:
+        return
+    for path in files(future.result()):
+        if flight["waiters"]:
+            media_cache.pin(path, flight["waiters"] - 1)
+        else:
+            media_cache.release(path)
+
+async def _coalesced(key: tuple, func, *args, files=None, executor: ThreadPoolExecutor = None):
+    """
+    Выполняет func(*args) в пуле, объединяя одновременные запросы с одинаковым key.
+    :param files: функция, возвращающая пути файлов медиакэша в результате;
+                  такие результаты копируются для каждого ожидающего, а файлы
+                  каждый из них отпускает через release_files.
+    :param executor: пул потоков (по умолчанию — фоновый); присоединившийся запрос
+                     ждёт того, что уже выполняется, в каком бы пуле оно ни шло.
+    """
+    flight = _in_flight.get(key)
+    cache_lookup("coalesce", flight is not None)
+    if flight is None:
+        flight = {"future": asyncio.ensure_future(_run(func, *args, executor=executor)), "waiters": 0}
+        _in_flight[key] = flight
+        flight["future"].add_done_callback(functools.partial(_land, key, flight, files))
+    flight["waiters"] += 1
+
+    future = flight["future"]
+    try:
+        # shield: уход одного ожидающего не отменяет общий запрос
+        result = await asyncio.shield(future)
+    except asyncio.CancelledError:
+        if not future.done():
+            flight["waiters"] -= 1
+        elif files is not None and not future.cancelled() and future.exception() is None:
+            release_files(files(future.result()))
+        raise
+    # Каждый получатель меняет свою копию (file_id, file_path после отправки)
+    return copy.deepcopy(result) if files is not None else result
+
+def release_files(paths) -> None:
+    """
+    Отпускает файлы медиакэша, полученные из get_post / get_stories (и скачанные при отправке).
+    Файлы остаются на диске для повторных просмотров, пока их не вытеснит медиакэш.
+    """
+    for path in paths:
+        media_cache.release(path)
+
+def _post_files(post) -> list:
+    return [media["file_path"] for media in post["media"] if media.get("file_path")] if post else []
+
+def _story_files(stories: list) -> list:
+    return [story["url"] for story in stories if story["url"]]
+
+###############################
+# ЗАПРОСЫ ИЗ ХЕНДЛЕРОВ
+###############################
+async def get_post(username: str, index: int):
+    """
+    Одна публикация из ленты по индексу (см. instagram_parser.get_new_posts).
+    Если пост уже загружен заранее (prefetch_posts), возвращается сразу.
+    После отправки файлы нужно отпустить через release_files.
+    """
+    post = _take_prefetched(username, index)
+    if post is not None:
+        return post
+    return await _load_post(username, index, _interactive_executor)
+
+async def _load_post(username: str, index: int, executor: ThreadPoolExecutor):
+    return await _coalesced(
+        ("post", username, index),
+        functools.partial(instagram_parser.get_new_posts, index=index, time_filter=False),
+        username,
+        files=_post_files,
+        executor=executor
+    )
+
+async def get_post_count(username: str) -> int:
+    """
+    Количество публикаций в ленте (см. instagram_parser.get_new_posts_count).
+    """
+    return await _coalesced(
+        ("post_count", username), instagram_parser.get_new_posts_count, username, executor=_interactive_executor
+    )
+
+async def get_stories(username: str) -> list:
+    """
+    Скачанные истории пользователя (см. instagram_parser.get_stories).
+    После отправки файлы нужно отпустить через release_files.
+    """
+    return await _coalesced(
+        ("stories", username), instagram_parser.get_stories, username,
+        files=_story_files, executor=_interactive_executor
+    )
+
+###############################
+# УПРЕЖДАЮЩАЯ ЗАГРУЗКА
+###############################
+def _take_prefetched(username: str, index: int):
+    """
+    Копия заранее загруженного поста с закреплёнными файлами или None.
+    Если файлы поста уже вытеснены из медиакэша, пост загружается заново.
+    """
+    post = _prefetched.get((username, index))
+    acquired = []
+    if post is not None:
+        for path in _post_files(post):
+            if not media_cache.acquire(path):
+                release_files(acquired)
+                _prefetched.pop((username, index))
+                post = None
+                break
+            acquired.append(path)
+    cache_lookup("prefetch", post is not None)
+    return copy.deepcopy(post) if post is not None else None
+
+def _warm_media(media: list) -> None:
+    """
+    Скачивает в медиакэш медиа поста, которое при отправке пошло бы с CDN (режим MEDIA_STREAMING):
+    при открытии поста media_input возьмёт его с диска. Видео, которое не отправилось бы
+    потоком (больше STREAM_MAX_VIDEO_BYTES или неизвестного размера), заранее не качается.
+    """
+    for item in media:
+        if item.get("file_id") or item.get("file_path") or not item.get("source_url"):
+            continue
+        if item["media_type"] == "video" and (item.get("size") is None or item["size"] > STREAM_MAX_VIDEO_BYTES):
+            continue
+        extension = "mp4" if item["media_type"] == "video" else "jpg"
+        path = media_cache.fetch(item["source_url"], item["media_id"], item["node_index"], extension)
+        # Файл остаётся в кэше; закрепит его тот, кто будет отправлять
+        media_cache.release(path)
+
+async def _prefetch_post(username: str, index: int) -> None:
+    if (username, index) in _prefetched:
+        return
+    async with _prefetch_slots:
+        # Упреждающая загрузка идёт в фоновом пуле и не занимает потоки хендлеров
+        post = await _load_post(username, index, _executor)
+        if not post:
+            return
+        try:
+            await asyncio.to_thread(_warm_media, post["media"])
+            _prefetched[(username, index)] = post
+        finally:
+            # Закрепления этой загрузки не нужны: при выдаче пост закрепит файлы заново
+            release_files(_post_files(post))
+
+async def _prefetch(username: str, indexes: list) -> None:
+    for index in indexes:
+        try:
+            await _prefetch_post(username, index)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Не удалось заранее загрузить пост {index} пользователя {username}: {e}")
+
+def prefetch_posts(user_id: int, username: str, indexes) -> None:
+    """
+    Начинает фоновую загрузку постов ленты username (0-based индексы), которые пользователь
+    видит на странице и, скорее всего, откроет: метаданные и медиа попадают в кэш,
+    и get_post отдаёт их сразу. На пользователя загружается не больше PREFETCH_POSTS постов
+    по порядку; прежняя загрузка этого пользователя отменяется.
+    """
+    cancel_prefetch(user_id)
+    indexes = list(indexes)[:PREFETCH_POSTS]
+    if not indexes:
+        return
+    task = asyncio.create_task(_prefetch(username, indexes))
+    _prefetch_tasks[user_id] = task
+    task.add_done_callback(lambda _: _prefetch_tasks.pop(user_id, None) if _prefetch_tasks.get(user_id) is task else None)
+
+def cancel_prefetch(user_id: int) -> None:
+    """
+    Отменяет упреждающую загрузку пользователя (ушёл со страницы или из просмотра ленты).
+    Уже загруженное остаётся в кэше до истечения PREFETCH_TTL.
+    """
+    task = _prefetch_tasks.pop(user_id, None)
+    if task is not None:
+        task.cancel()
+
+###############################
+# ЗАПРОСЫ ПЛАНИРОВЩИКА
+###############################
+async def fetch_new_posts(username: str, last_sent_post_id: str = None, last_seen_mediacount: int = None):
+    """
+    Новые публикации профиля (instaloader.Post) без скачивания медиа, текущий mediacount
+    и mediaid самого нового поста ленты (см. instagram_parser.fetch_new_posts).
+    """
+    return await _coalesced(
+        ("new_posts", username, last_sent_post_id, last_seen_mediacount),
+        instagram_parser.fetch_new_posts, username, last_sent_post_id, last_seen_mediacount
+    )
+
+async def fetch_story_items(username: str) -> list:
+    """
+    Элементы историй профиля (instaloader.StoryItem) без скачивания медиа.
+    """
+    return await _coalesced(("story_items", username), instagram_parser.fetch_story_items, username)
+
+async def download_post(post, username: str) -> dict:
+    """
+    Скачивание медиа публикации (см. instagram_parser.download_post).
+    """
+    return await _run(instagram_parser.download_post, post, username)
+
+async def download_story_items(items: list, username: str) -> list:
+    """
+    Скачивание элементов историй (см. instagram_parser.download_story_items).
+    """
+    return await _run(instagram_parser.download_story_items, items, username)
@@ -0,0 +1,433 @@
+"""
+Поддельный Instagram для бенчмарков: отвечает на те запросы, которые делает Instaloader
+(страница профиля, GraphQL-запросы профиля, ленты, поста и историй, iPhone API историй),
+и раздаёт медиа как CDN. Задержка ответа, размер страницы ленты, доля ответов 429
+и размер медиа настраиваются.
+
+Режимы записи и воспроизведения: --record FILE сохраняет все ответы API в JSONL,
+--replay FILE отдаёт сохранённые ответы вместо сгенерированных — так прогоны
+сравниваются на одинаковых данных.
+
+Служебные адреса для bench/run.py:
+  GET  /__bench__/stats    — счётчики запросов;
+  POST /__bench__/reset    — обнулить счётчики;
+  POST /__bench__/publish  — опубликовать новые посты у части профилей.
+
+Запуск: python bench/fake_instagram.py --port 8701 --profiles 50
+"""
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+from collections import Counter
+from aiohttp import web
+
+# Запросы, которые делает Instaloader 4.15 (doc_id / query_hash)
+DOC_PROFILE = "27937681195819736"
+DOC_FEED = "28975909992013618"
+DOC_POST = "27128499623469141"
+QUERY_STORIES = "303a4ae99711322310f25250d988f3b7"
+
+# Метка адреса поддельного сервера в записанных ответах (--record / --replay)
+CDN_PLACEHOLDER = "http://bench-instagram"
+
+PHOTO, VIDEO, SIDECAR = 1, 2, 8
+
+# Варианты разрешения, как у настоящего CDN: ширина (px). Размер файла варианта пропорционален
+# площади, --photo-size и --video-size — размеры вариантов шириной 1080 и 720
+PHOTO_WIDTHS = (1440, 1080, 750, 640, 480, 320)
+VIDEO_WIDTHS = (1080, 720, 480)
+
+
+class FakeInstagram:
+    """
+    Состояние поддельного Instagram: профили, посты и истории генерируются детерминированно из seed.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.base_url = f"http://{args.host}:{args.port}"
+        self.next_pk = 3_000_000_000_000_000_000
+        self.profiles = {}       # {username: {"pk", "username", "posts": [media, ...] (новые первыми), "stories"}}
+        self.by_pk = {}          # {pk профиля: username}
+        self.by_code = {}        # {shortcode: media}
+        self.stats = Counter()   # {вид запроса: число}
+        self.per_profile = Counter()
+        self.cdn_bytes = 0
+        self.replay = self._load_replay(args.replay) if args.replay else None
+        self.record = open(args.record, "a", encoding="utf-8") if args.record else None
+        self._media = bytes(max(
+            int(args.photo_size * (max(PHOTO_WIDTHS) / 1080) ** 2), int(args.video_size * (max(VIDEO_WIDTHS) / 720) ** 2)
+        ) + 1)
+        self._generate()
+
+    ###############################
+    # ДАННЫЕ
+    ###############################
+    def _generate(self) -> None:
+        now = time.time()
+        for index in range(self.args.profiles):
+            username = f"bench_{index:04d}"
+            profile = {"pk": 1_000_000 + index, "username": username, "posts": [], "stories": []}
+            self.profiles[username] = profile
+            self.by_pk[profile["pk"]] = username
+            # Посты от старых к новым, чтобы mediaid рос со временем
+            for age in range(self.args.posts, 0, -1):
+                self._add_post(profile, now - age * self.args.post_interval)
+            if self.random.random() < self.args.story_ratio:
+                for age in range(self.args.stories, 0, -1):
+                    self._add_story(profile, now - age * 600)
+
+    def _cdn_url(self, name: str, media_type: int, width: int) -> str:
+        if media_type == VIDEO:
+            size = int(self.args.video_size * (width / 720) ** 2)
+            return f"{self.base_url}/cdn/{name}_{width}.mp4?size={size}"
+        size = int(self.args.photo_size * (width / 1080) ** 2)
+        return f"{self.base_url}/cdn/{name}_{width}.jpg?size={size}"
+
+    def _media_versions(self, name: str, media_type: int) -> dict:
+        versions = {
+            "image_versions2": {"candidates": [
+                {"url": self._cdn_url(name, PHOTO, width), "width": width, "height": width * 5 // 4}
+                for width in PHOTO_WIDTHS
+            ]}
+        }
+        if media_type == VIDEO:
+            versions["video_versions"] = [
+                {"url": self._cdn_url(name, VIDEO, width), "type": 101, "width": width, "height": width * 16 // 9}
+                for width in VIDEO_WIDTHS
+            ]
+        return versions
+
+    def _add_post(self, profile: dict, taken_at: float) -> dict:
+        self.next_pk += 1
+        pk = self.next_pk
+        code = f"B{pk % 10 ** 10:010d}"
+        roll = self.random.random()
+        media_type = SIDECAR if roll < self.args.sidecar_ratio else (
+            VIDEO if roll < self.args.sidecar_ratio + self.args.video_ratio else PHOTO
+        )
+        media = {
+            "pk": pk,
+            "id": f"{pk}_{profile['pk']}",
+            "code": code,
+            "media_type": media_type,
+            "taken_at": int(taken_at),
+            "caption": {"text": f"Пост {code}"},
+            "like_count": self.random.randint(0, 5000),
+            "comment_count": self.random.randint(0, 300),
+            "has_liked": False,
+            "user": {
+                "pk": profile["pk"], "username": profile["username"], "full_name": profile["username"],
+                "is_private": False, "profile_pic_url": ""
+            },
+            **self._media_versions(code, PHOTO if media_type == SIDECAR else media_type)
+        }
+        if media_type == VIDEO:
+            media.update(video_duration=10.0, view_count=100)
+        if media_type == SIDECAR:
+            media["carousel_media"] = [
+                {"media_type": child_type, **self._media_versions(f"{code}_{child}", child_type)}
+                for child, child_type in enumerate([PHOTO, VIDEO, PHOTO], start=1)
+            ]
+        profile["posts"].insert(0, media)
+        self.by_code[code] = media
+        return media
+
+    def _add_story(self, profile: dict, taken_at: float) -> None:
+        self.next_pk += 1
+        is_video = self.random.random() < self.args.video_ratio
+        name = f"S{self.next_pk % 10 ** 10:010d}"
+        profile["stories"].append({
+            "pk": self.next_pk,
+            "taken_at": int(taken_at),
+            "is_video": is_video,
+            **self._media_versions(name, VIDEO if is_video else PHOTO)
+        })
+
+    def publish(self, ratio: float, posts: int) -> int:
+        """
+        Публикует posts новых постов у доли ratio профилей. Возвращает число новых постов.
+        """
+        published = 0
+        for profile in self.profiles.values():
+            if self.random.random() < ratio:
+                for _ in range(posts):
+                    self._add_post(profile, time.time())
+                    published += 1
+        return published
+
+    ###############################
+    # ОТВЕТЫ API
+    ###############################
+    def _user(self, profile: dict) -> dict:
+        return {
+            "pk": str(profile["pk"]),
+            "id": str(profile["pk"]),
+            "username": profile["username"],
+            "full_name": profile["username"],
+            "is_private": False,
+            "media_count": len(profile["posts"]),
+            "follower_count": 1000,
+            "following_count": 100,
+            "friendship_status": {"following": True},
+            "profile_pic_url": ""
+        }
+
+    def profile_page(self, username: str):
+        profile = self.profiles.get(username.lower())
+        if profile is None:
+            return 404, "<html></html>"
+        self.per_profile[profile["username"]] += 1
+        data = {"require": [["ScheduledServerJS", {"__bbox": {"result": {"data": {
+            "xig_user_by_username": self._user(profile)
+        }}}}]]}
+        return 200, f'<html><script type="application/json">{json.dumps(data)}</script></html>'
+
+    def graphql(self, params: dict):
+        variables = json.loads(params.get("variables") or "{}")
+        doc_id = params.get("doc_id")
+        if doc_id == DOC_PROFILE:
+            profile = self.profiles.get(self.by_pk.get(int(variables.get("id", 0))))
+            self.stats["profile"] += 1
+            if profile is None:
+                return 200, {"data": {"user": None}, "status": "ok"}
+            self.per_profile[profile["username"]] += 1
+            return 200, {"data": {"user": self._user(profile)}, "status": "ok"}
+
+        if doc_id == DOC_FEED:
+            profile = self.profiles.get(variables.get("username", ""))
+            self.stats["feed_page"] += 1
+            if profile is None:
+                return 404, {"message": "not found", "status": "fail"}
+            self.per_profile[profile["username"]] += 1
+            offset = int(variables.get("after") or 0)
+            page = profile["posts"][offset:offset + self.args.page_size]
+            has_next = offset + self.args.page_size < len(profile["posts"])
+            return 200, {"data": {"xdt_api__v1__feed__user_timeline_graphql_connection": {
+                "edges": [{"node": media} for media in page],
+                "page_info": {"has_next_page": has_next, "end_cursor": str(offset + self.args.page_size)}
+            }}, "status": "ok"}
+
+        if doc_id == DOC_POST:
+            media = self.by_code.get(variables.get("shortcode"))
+            self.stats["post"] += 1
+            if media is not None:
+                self.per_profile[media["user"]["username"]] += 1
+            return 200, {"data": {"xdt_api__v1__media__shortcode__web_info": {
+                "items": [media] if media else []
+            }}, "status": "ok"}
+
+        if params.get("query_hash") == QUERY_STORIES:
+            self.stats["stories"] += 1
+            reels = []
+            for reel_id in variables.get("reel_ids", []):
+                profile = self.profiles.get(self.by_pk.get(int(reel_id)))
+                if profile is None:
+                    continue
+                self.per_profile[profile["username"]] += 1
+                if profile["stories"]:
+                    reels.append(self._reel(profile))
+            return 200, {"data": {"reels_media": reels}, "status": "ok"}
+
+        self.stats["unknown"] += 1
+        return 400, {"message": "unknown query", "status": "fail"}
+
+    def _reel(self, profile: dict) -> dict:
+        return {
+            "id": str(profile["pk"]),
+            "latest_reel_media": profile["stories"][-1]["taken_at"],
+            "seen": None,
+            "user": {"id": str(profile["pk"]), "username": profile["username"], "is_private": False},
+            "items": [
+                {
+                    "id": str(story["pk"]),
+                    "__typename": "GraphStoryVideo" if story["is_video"] else "GraphStoryImage",
+                    "taken_at_timestamp": story["taken_at"],
+                    "expiring_at_timestamp": story["taken_at"] + 24 * 3600,
+                    "is_video": story["is_video"],
+                    # graphql отдаёт варианты от меньшего к большему
+                    "display_resources": [
+                        {"src": candidate["url"], "config_width": candidate["width"], "config_height": candidate["height"]}
+                        for candidate in reversed(story["image_versions2"]["candidates"])
+                    ],
+                    **({"video_resources": [
+                        {"src": version["url"], "config_width": version["width"], "config_height": version["height"]}
+                        for version in reversed(story["video_versions"])
+                    ]} if story["is_video"] else {})
+                }
+                for story in profile["stories"]
+            ]
+        }
+
+    def iphone_reels(self, reel_id: str):
+        self.stats["stories_iphone"] += 1
+        profile = self.profiles.get(self.by_pk.get(int(reel_id)))
+        if profile is None:
+            return 200, {"reels": {}, "status": "ok"}
+        self.per_profile[profile["username"]] += 1
+        return 200, {"reels": {reel_id: {"items": [
+            {
+                "pk": story["pk"],
+                "image_versions2": story["image_versions2"],
+                **({"video_versions": story["video_versions"]} if story["is_video"] else {})
+            }
+            for story in profile["stories"]
+        ]}}, "status": "ok"}
+
+    ###############################
+    # ЗАПИСЬ И ВОСПРОИЗВЕДЕНИЕ
+    ###############################
+    @staticmethod
+    def _load_replay(path: str) -> dict:
+        """
+        {ключ запроса: [ответ, ...]} из JSONL; повторные запросы получают ответы по порядку.
+        """
+        replay = {}
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if line.strip():
+                    entry = json.loads(line)
+                    replay.setdefault(entry["key"], []).append(entry)
+        return replay
+
+    def respond(self, key: str, generate):
+        """
+        Ответ на запрос API: из записи (--replay) или сгенерированный; с записью в --record.
+        """
+        if self.replay is not None:
+            entries = self.replay.get(key)
+            if not entries:
+                self.stats["replay_miss"] += 1
+                return 404, {"message": "not recorded", "status": "fail"}
+            entry = entries.pop(0) if len(entries) > 1 else entries[0]
+            status = entry["status"]
+            body = json.loads(json.dumps(entry["body"]).replace(CDN_PLACEHOLDER, self.base_url))
+        else:
+            status, body = generate()
+        if self.record is not None:
+            # Адрес CDN зависит от порта, поэтому в записи он заменён меткой
+            recorded = json.loads(json.dumps(body).replace(self.base_url, CDN_PLACEHOLDER))
+            self.record.write(json.dumps({"key": key, "status": status, "body": recorded}, ensure_ascii=False) + "\n")
+            self.record.flush()
+        return status, body
+
+
+def _request_key(request: web.Request, params: dict) -> str:
+    return f"{request.method} {request.path} " + json.dumps(sorted(params.items()), ensure_ascii=False)
+
+
+def build_app(state: FakeInstagram) -> web.Application:
+    args = state.args
+
+    async def delay():
+        if args.latency:
+            await asyncio.sleep(args.latency / 1000 * state.random.uniform(1 - args.jitter, 1 + args.jitter))
+
+    def reply(status: int, body) -> web.Response:
+        if isinstance(body, str):
+            return web.Response(status=status, text=body, content_type="text/html")
+        return web.json_response(body, status=status)
+
+    async def api(request: web.Request) -> web.Response:
+        params = dict(request.query)
+        if request.method == "POST":
+            params.update(await request.post())
+        state.stats["requests"] += 1
+        await delay()
+        if state.random.random() < args.error_rate:
+            state.stats["429"] += 1
+            return web.json_response(
+                {"message": "Please wait a few minutes before you try again.", "status": "fail"}, status=429
+            )
+
+        path = request.path
+        if path == "/graphql/query":
+            generate = lambda: state.graphql(params)
+        elif path.startswith("/api/v1/feed/reels_media/"):
+            generate = lambda: state.iphone_reels(params.get("reel_ids", "0"))
+        elif path == "/":
+            # Главная страница: только cookie csrftoken для doc_id-запросов
+            response = web.Response(text="<html></html>", content_type="text/html")
+            response.set_cookie("csrftoken", "bench")
+            return response
+        else:
+            state.stats["page"] += 1
+            generate = lambda: state.profile_page(path.strip("/").split("/")[0])
+        return reply(*state.respond(_request_key(request, params), generate))
+
+    async def cdn(request: web.Request) -> web.Response:
+        size = int(request.query.get("size", args.photo_size))
+        state.stats["cdn"] += 1
+        if args.cdn_latency:
+            await asyncio.sleep(args.cdn_latency / 1000)
+        if request.method == "GET":
+            state.cdn_bytes += size
+        return web.Response(body=state._media[:size], content_type="application/octet-stream")
+
+    async def stats(request: web.Request) -> web.Response:
+        profiles_hit = len(state.per_profile)
+        return web.json_response({
+            "requests": dict(state.stats),
+            "profiles_requested": profiles_hit,
+            "requests_per_profile": (
+                sum(state.per_profile.values()) / profiles_hit if profiles_hit else 0.0
+            ),
+            "cdn_bytes": state.cdn_bytes
+        })
+
+    async def reset(request: web.Request) -> web.Response:
+        state.stats.clear()
+        state.per_profile.clear()
+        state.cdn_bytes = 0
+        return web.json_response({"ok": True})
+
+    async def publish(request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response({"published": state.publish(body.get("ratio", 0.3), body.get("posts", 1))})
+
+    app = web.Application()
+    app.router.add_get("/__bench__/stats", stats)
+    app.router.add_post("/__bench__/reset", reset)
+    app.router.add_post("/__bench__/publish", publish)
+    app.router.add_get("/cdn/{name}", cdn)
+    app.router.add_route("*", "/{tail:.*}", api)
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Поддельный Instagram (API и CDN) для бенчмарков.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8701)
+    parser.add_argument("--profiles", type=int, default=50, help="число профилей bench_0000...")
+    parser.add_argument("--posts", type=int, default=30, help="постов в ленте каждого профиля")
+    parser.add_argument("--post-interval", type=float, default=6 * 3600, help="промежуток между постами, сек")
+    parser.add_argument("--page-size", type=int, default=12, help="постов на странице ленты")
+    parser.add_argument("--stories", type=int, default=3, help="историй у профиля с историями")
+    parser.add_argument("--story-ratio", type=float, default=0.5, help="доля профилей с историями")
+    parser.add_argument("--video-ratio", type=float, default=0.2, help="доля видео среди постов и историй")
+    parser.add_argument("--sidecar-ratio", type=float, default=0.2, help="доля каруселей среди постов")
+    parser.add_argument("--latency", type=float, default=50, help="задержка ответа API, мс")
+    parser.add_argument("--jitter", type=float, default=0.3, help="разброс задержки (доля)")
+    parser.add_argument("--cdn-latency", type=float, default=20, help="задержка ответа CDN, мс")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--photo-size", type=int, default=150_000, help="размер фото шириной 1080, байт")
+    parser.add_argument("--video-size", type=int, default=3_000_000, help="размер видео шириной 720, байт")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--record", help="записывать ответы API в JSONL")
+    parser.add_argument("--replay", help="отдавать ответы API из JSONL")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    state = FakeInstagram(args)
+    web.run_app(build_app(state), host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Поддельный Telegram Bot API для бенчмарков: принимает запросы aiogram
+(/bot<token>/<method>), отвечает правдоподобными объектами Message и считает,
+сколько запросов и байт загрузок пришло. Задержка ответа и доля ответов 429
+(«Too Many Requests: retry after N») настраиваются.
+
+Служебные адреса для bench/run.py:
+  GET  /__bench__/stats — счётчики запросов;
+  POST /__bench__/reset — обнулить счётчики.
+
+Запуск: python bench/fake_telegram.py --port 8702
+"""
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+from collections import Counter
+from aiohttp import web
+
+
+class FakeTelegram:
+    """
+    Счётчики и генерация ответов поддельного Bot API.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.next_id = 0
+        self.stats = Counter()     # {метод: число запросов}
+        self.chats = set()
+        self.upload_bytes = 0
+
+    def _id(self) -> int:
+        self.next_id += 1
+        return self.next_id
+
+    def _file(self, media) -> str:
+        # Уже загруженное медиа приходит строкой file_id, новое — ссылкой attach:// на часть формы
+        if isinstance(media, str) and not media.startswith("attach://"):
+            return media
+        return f"bench-file-{self._id()}"
+
+    def message(self, chat_id, media_type: str = None, media=None, text: str = None) -> dict:
+        message = {
+            "message_id": self._id(),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Bench"}
+        }
+        if text is not None:
+            message["text"] = text
+        if media_type == "photo":
+            file_id = self._file(media)
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1080, "height": 1350}]
+        elif media_type == "video":
+            file_id = self._file(media)
+            message["video"] = {
+                "file_id": file_id, "file_unique_id": file_id, "width": 720, "height": 1280, "duration": 10
+            }
+        return message
+
+    def result(self, method: str, fields: dict):
+        chat_id = fields.get("chat_id", 0)
+        if method.startswith("send"):
+            self.chats.add(str(chat_id))
+        if method in ("sendMessage", "editMessageText"):
+            return self.message(chat_id, text=fields.get("text", ""))
+        if method == "sendPhoto":
+            return self.message(chat_id, "photo", fields.get("photo"))
+        if method == "sendVideo":
+            return self.message(chat_id, "video", fields.get("video"))
+        if method == "sendMediaGroup":
+            return [
+                self.message(chat_id, item["type"], item["media"])
+                for item in json.loads(fields.get("media", "[]"))
+            ]
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        # answerCallbackQuery, deleteMessage, deleteWebhook, setWebhook и прочие
+        return True
+
+
+def build_app(state: FakeTelegram) -> web.Application:
+    args = state.args
+
+    async def api(request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        fields = {}
+        if request.method == "POST":
+            form = await request.post()
+            for key, value in form.items():
+                if isinstance(value, web.FileField):
+                    state.upload_bytes += len(value.file.read())
+                else:
+                    fields[key] = value
+        state.stats[method] += 1
+        if args.latency:
+            await asyncio.sleep(args.latency / 1000 * state.random.uniform(1 - args.jitter, 1 + args.jitter))
+        if method.startswith("send") and state.random.random() < args.error_rate:
+            state.stats["429"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {args.retry_after}",
+                "parameters": {"retry_after": args.retry_after}
+            })
+        return web.json_response({"ok": True, "result": state.result(method, fields)})
+
+    async def stats(request: web.Request) -> web.Response:
+        return web.json_response({
+            "requests": dict(state.stats),
+            "chats": len(state.chats),
+            "upload_bytes": state.upload_bytes
+        })
+
+    async def reset(request: web.Request) -> web.Response:
+        state.stats.clear()
+        state.chats.clear()
+        state.upload_bytes = 0
+        return web.json_response({"ok": True})
+
+    app = web.Application(client_max_size=200 * 1024 * 1024)
+    app.router.add_get("/__bench__/stats", stats)
+    app.router.add_post("/__bench__/reset", reset)
+    app.router.add_route("*", "/bot{token}/{method}", api)
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Поддельный Telegram Bot API для бенчмарков.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8702)
+    parser.add_argument("--latency", type=float, default=30, help="задержка ответа, мс")
+    parser.add_argument("--jitter", type=float, default=0.3, help="разброс задержки (доля)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429 на send*")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответах 429, сек")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    web.run_app(build_app(FakeTelegram(args)), host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
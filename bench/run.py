@@ -0,0 +1,462 @@
+"""
+Офлайн-бенчмарк бота: без живых аккаунтов Instagram и Telegram.
+
+Поднимает поддельные Instagram (API + CDN, bench/fake_instagram.py) и Telegram Bot API
+(bench/fake_telegram.py) отдельными процессами, направляет на них instagram_parser
+(все запросы Instaloader к www/i.instagram.com) и aiogram Bot, создаёт N подписок и гоняет:
+  - несколько проходов check_updates по всем подпискам (между проходами у части профилей
+    появляются новые посты) и ждёт, пока диспетчер outbox разошлёт очередь;
+  - M одновременных пользователей, которые проходят сценарий бота
+    (/start, язык, просмотр поста, истории, подписка) через Dispatcher.feed_update.
+
+Отчёт: время прохода и рассылки, запросы к Instagram на профиль, p50/p99 задержки
+хендлеров, пиковый RSS процесса бота. --output сохраняет отчёт в JSON,
+--compare сравнивает с сохранённым отчётом. --record / --replay записывают и
+воспроизводят ответы поддельного Instagram, чтобы прогоны шли на одинаковых данных.
+
+По умолчанию лимиты скорости (GRAPHQL_*, CDN_*, TELEGRAM_*, SESSION_REQUEST_BUDGET)
+подняты, чтобы измерялся код, а не паузы лимитеров; --keep-limits оставляет настройки
+из окружения. Прочие настройки (MEDIA_STREAMING, SCHEDULER_* и т.д.) берутся из окружения.
+
+Пример: python bench/run.py --subscriptions 500 --profiles 100 --users 50 --output base.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+from urllib.parse import urlsplit, urlunsplit
+import httpx
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# Хосты, запросы к которым Instaloader отправляет на поддельный Instagram
+INSTAGRAM_HOSTS = {"www.instagram.com", "i.instagram.com", "instagram.com"}
+
+# Лимиты, которые бенчмарк поднимает, если не задан --keep-limits
+UNTHROTTLED_ENV = {
+    "GRAPHQL_RATE": "1000", "GRAPHQL_BURST": "1000",
+    "CDN_RATE": "1000", "CDN_BURST": "1000",
+    "TELEGRAM_GLOBAL_RATE": "1000", "TELEGRAM_CHAT_INTERVAL": "0",
+    "SESSION_REQUEST_BUDGET": "1000000"
+}
+
+# Пользователи бенчмарка: подписчики и «живые» пользователи хендлеров
+SUBSCRIBER_ID_BASE = 100_000
+USER_ID_BASE = 900_000
+
+
+###############################
+# ПОДДЕЛЬНЫЕ СЕРВЕРЫ
+###############################
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_server(script: str, port: int, extra_args: list) -> subprocess.Popen:
+    """
+    Запускает поддельный сервер отдельным процессом (его память не попадает в RSS бота)
+    и ждёт, пока он начнёт отвечать.
+    """
+    process = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, script), "--port", str(port), *extra_args])
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{script} завершился с кодом {process.returncode}")
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/__bench__/stats", timeout=1)
+            return process
+        except httpx.TransportError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"{script} не запустился за 30 с")
+
+
+def _route_instagram_to(base_url: str) -> None:
+    """
+    Подменяет адрес всех запросов requests к хостам Instagram на поддельный сервер
+    (Instaloader создаёт сессии requests сам, в том числе анонимные).
+    """
+    target = urlsplit(base_url)
+    original_send = requests.adapters.HTTPAdapter.send
+
+    def send(self, request, *args, **kwargs):
+        parts = urlsplit(request.url)
+        if parts.hostname in INSTAGRAM_HOSTS:
+            request.url = urlunsplit((target.scheme, target.netloc, parts.path, parts.query, ""))
+        return original_send(self, request, *args, **kwargs)
+
+    requests.adapters.HTTPAdapter.send = send
+
+
+async def _server_call(client: httpx.AsyncClient, base_url: str, path: str, payload: dict = None) -> dict:
+    if payload is None and path.endswith("stats"):
+        response = await client.get(f"{base_url}/__bench__/{path}")
+    else:
+        response = await client.post(f"{base_url}/__bench__/{path}", json=payload or {})
+    response.raise_for_status()
+    return response.json()
+
+
+###############################
+# ИЗМЕРЕНИЯ
+###############################
+def _percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))]
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss — в килобайтах на Linux и в байтах на macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / (1024 if sys.platform == "darwin" else 1)
+
+
+async def _wait_outbox_drained(count_outbox, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if await asyncio.to_thread(count_outbox) == 0:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+###############################
+# СЦЕНАРИИ
+###############################
+async def run_cycles(args, bot, instagram_url: str, telegram_url: str) -> list:
+    """
+    Проходы check_updates по всем подпискам и рассылка результатов диспетчером outbox.
+    """
+    from database import count_outbox
+    from scheduler import check_updates
+
+    cycles = []
+    async with httpx.AsyncClient() as client:
+        for number in range(args.cycles):
+            published = 0
+            if number:
+                published = (await _server_call(client, instagram_url, "publish", {
+                    "ratio": args.new_posts_ratio, "posts": args.new_posts
+                }))["published"]
+            await _server_call(client, instagram_url, "reset")
+            await _server_call(client, telegram_url, "reset")
+
+            started = time.perf_counter()
+            await check_updates(bot)
+            cycle_seconds = time.perf_counter() - started
+            drained = await _wait_outbox_drained(count_outbox, args.drain_timeout)
+            delivery_seconds = time.perf_counter() - started
+
+            instagram = await _server_call(client, instagram_url, "stats")
+            telegram = await _server_call(client, telegram_url, "stats")
+            cycles.append({
+                "cycle": number + 1,
+                "published_posts": published,
+                "cycle_seconds": round(cycle_seconds, 3),
+                "delivery_seconds": round(delivery_seconds, 3),
+                "outbox_drained": drained,
+                "instagram_requests": instagram["requests"].get("requests", 0),
+                "instagram_requests_per_profile": round(
+                    instagram["requests"].get("requests", 0) / max(args.profiles, 1), 2
+                ),
+                "instagram_429": instagram["requests"].get("429", 0),
+                "cdn_requests": instagram["requests"].get("cdn", 0),
+                "cdn_mb": round(instagram["cdn_bytes"] / 1024 / 1024, 2),
+                "telegram_requests": sum(
+                    count for method, count in telegram["requests"].items() if method != "429"
+                ),
+                "telegram_upload_mb": round(telegram["upload_bytes"] / 1024 / 1024, 2)
+            })
+            logging.warning(f"Проход {number + 1}: {cycles[-1]}")
+    return cycles
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": "Bench", "language_code": "ru"}
+
+
+def _message(user_id: int, message_id: int, text: str) -> dict:
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        "text": text
+    }
+
+
+async def simulate_user(args, dp, bot, user_id: int, rng: random.Random, latencies: dict) -> None:
+    """
+    Один пользователь проходит сценарий бота; задержка каждого апдейта пишется в latencies[шаг].
+    """
+    from aiogram.types import Update
+
+    counter = {"update_id": user_id * 1000}
+
+    async def feed(step: str, message: str = None, callback: str = None):
+        counter["update_id"] += 1
+        update_id = counter["update_id"]
+        if message is not None:
+            data = {"update_id": update_id, "message": _message(user_id, update_id, message)}
+        else:
+            data = {"update_id": update_id, "callback_query": {
+                "id": str(update_id),
+                "from": _user(user_id),
+                "chat_instance": "bench",
+                "data": callback,
+                "message": {**_message(user_id, update_id, "menu"), "from": {"id": 1, "is_bot": True, "first_name": "Bench"}}
+            }}
+        update = Update.model_validate(data, context={"bot": bot})
+        started = time.perf_counter()
+        await dp.feed_update(bot, update)
+        latencies.setdefault(step, []).append(time.perf_counter() - started)
+
+    await feed("start", message="/start")
+    await feed("language", callback="lang:ru")
+    for _ in range(args.user_rounds):
+        username = f"bench_{rng.randrange(args.profiles):04d}"
+        await feed("ask_post", callback="ask_username_post")
+        await feed("post_count", message=username)
+        # Пользователь смотрит на список постов, прежде чем выбрать
+        await asyncio.sleep(args.think_time / 1000)
+        await feed("select_post", callback=f"select_post:{rng.randint(1, 5)}")
+        await feed("ask_story", callback="ask_username_story")
+        await feed("stories", message=username)
+        await feed("ask_add", callback="ask_username_add")
+        await feed("add_subscription", message=username)
+
+
+async def run_users(args, bot) -> dict:
+    """
+    M одновременных пользователей; возвращает задержки хендлеров (сек) по шагам.
+    """
+    import main as bot_main
+
+    latencies = {}
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        simulate_user(args, bot_main.dp, bot, USER_ID_BASE + index, random.Random(rng.random()), latencies)
+        for index in range(args.users)
+    ])
+    total = time.perf_counter() - started
+    all_latencies = [value for values in latencies.values() for value in values]
+    return {
+        "users": args.users,
+        "updates": len(all_latencies),
+        "seconds": round(total, 3),
+        "p50_ms": round(_percentile(all_latencies, 0.5) * 1000, 1),
+        "p99_ms": round(_percentile(all_latencies, 0.99) * 1000, 1),
+        "steps": {
+            step: {
+                "p50_ms": round(_percentile(values, 0.5) * 1000, 1),
+                "p99_ms": round(_percentile(values, 0.99) * 1000, 1)
+            }
+            for step, values in latencies.items()
+        }
+    }
+
+
+###############################
+# ЗАПУСК
+###############################
+def _prepare_environment(args, workdir: str) -> None:
+    """
+    Настройки для модулей бота: задаются до их импорта (config читает окружение при импорте).
+    """
+    os.environ["TELEGRAM_TOKEN"] = "123456:bench"
+    os.environ["INSTAGRAM_USERNAME"] = ""
+    os.environ["INSTAGRAM_PASSWORD"] = ""
+    os.environ["METRICS_PORT"] = "0"
+    if not args.keep_limits:
+        for name, value in UNTHROTTLED_ENV.items():
+            os.environ.setdefault(name, value)
+    # База, медиакэш и sessions/ — во временном каталоге
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+
+def _add_sessions(count: int, sleep: bool) -> None:
+    """
+    Поддельные авторизованные сессии Instaloader в пуле instagram_parser.
+    """
+    from instagram_parser import pool, _new_loader, SESSION_FOLDER
+    from session_pool import InstaSession, SESSION_FILE_PREFIX
+
+    for index in range(count):
+        username = f"bench{index}"
+        loader = _new_loader()
+        loader.context.sleep = sleep
+        loader.context.load_session(username, {
+            "sessionid": f"bench{index}", "csrftoken": "bench", "ds_user_id": str(index + 1),
+            "mid": "bench", "ig_did": "bench"
+        })
+        pool.add(InstaSession(username, os.path.join(SESSION_FOLDER, f"{SESSION_FILE_PREFIX}{username}"), loader))
+
+
+async def run_benchmark(args, instagram_url: str, telegram_url: str) -> dict:
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from database import initialize_database, add_subscription
+    from outbox import TelegramRateMiddleware, run_dispatcher
+    import main as bot_main
+
+    logging.getLogger().setLevel(args.log_level)
+    _route_instagram_to(instagram_url)
+    initialize_database()
+    _add_sessions(args.sessions, args.instaloader_sleep)
+
+    bot = Bot(token=os.environ["TELEGRAM_TOKEN"], session=AiohttpSession(api=TelegramAPIServer.from_base(telegram_url)))
+    bot.session.middleware(TelegramRateMiddleware())
+    # Хендлеры обращаются к глобальному bot модуля main
+    bot_main.bot = bot
+    bot_main.dp.include_router(bot_main.router)
+
+    # Подписка i: пользователь SUBSCRIBER_ID_BASE + i // profiles на профиль i % profiles
+    for index in range(args.subscriptions):
+        add_subscription(SUBSCRIBER_ID_BASE + index // args.profiles, f"bench_{index % args.profiles:04d}")
+
+    dispatcher = asyncio.create_task(run_dispatcher(bot))
+    try:
+        report = {
+            "config": {
+                "subscriptions": args.subscriptions,
+                "profiles": args.profiles,
+                "sessions": args.sessions,
+                "users": args.users,
+                "media_streaming": os.environ.get("MEDIA_STREAMING", "1"),
+                "replay": bool(args.replay)
+            },
+            "cycles": await run_cycles(args, bot, instagram_url, telegram_url),
+            "handlers": await run_users(args, bot) if args.users else None
+        }
+    finally:
+        dispatcher.cancel()
+        await asyncio.gather(dispatcher, return_exceptions=True)
+        await bot.session.close()
+    report["peak_rss_mb"] = round(_peak_rss_mb(), 1)
+    return report
+
+
+def _flatten(report: dict, prefix: str = "") -> dict:
+    values = {}
+    for key, value in report.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            values.update(_flatten(value, f"{name}."))
+        elif isinstance(value, list):
+            for index, item in enumerate(value):
+                values.update(_flatten(item, f"{name}[{index}]."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+
+def compare(report: dict, baseline: dict) -> list:
+    """
+    Строки сравнения числовых показателей отчёта с базовым: «имя: было -> стало (изменение %)».
+    """
+    current, previous = _flatten(report), _flatten(baseline)
+    lines = []
+    for name in sorted(set(current) & set(previous)):
+        before, after = previous[name], current[name]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        lines.append(f"{name}: {before} -> {after} ({change})")
+    return lines
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк InstaSplinter.")
+    parser.add_argument("--subscriptions", type=int, default=200, help="число подписок (N)")
+    parser.add_argument("--profiles", type=int, default=50, help="число разных профилей Instagram")
+    parser.add_argument("--users", type=int, default=20, help="одновременных пользователей хендлеров (M)")
+    parser.add_argument("--user-rounds", type=int, default=2, help="повторов сценария на пользователя")
+    parser.add_argument("--think-time", type=float, default=0, help="пауза перед выбором поста, мс")
+    parser.add_argument("--cycles", type=int, default=2, help="проходов check_updates")
+    parser.add_argument("--new-posts-ratio", type=float, default=0.3, help="доля профилей с новыми постами между проходами")
+    parser.add_argument("--new-posts", type=int, default=1, help="новых постов у такого профиля")
+    parser.add_argument("--sessions", type=int, default=4, help="поддельных сессий Instaloader в пуле")
+    parser.add_argument("--instaloader-sleep", action="store_true", help="оставить случайные паузы Instaloader")
+    parser.add_argument("--keep-limits", action="store_true", help="не поднимать лимиты скорости")
+    parser.add_argument("--drain-timeout", type=float, default=300, help="сколько ждать рассылки очереди, сек")
+    parser.add_argument("--ig-latency", type=float, default=50, help="задержка API Instagram, мс")
+    parser.add_argument("--cdn-latency", type=float, default=20, help="задержка CDN, мс")
+    parser.add_argument("--ig-error-rate", type=float, default=0.0, help="доля ответов 429 от Instagram")
+    parser.add_argument("--page-size", type=int, default=12, help="постов на странице ленты")
+    parser.add_argument("--photo-size", type=int, default=150_000, help="размер фото шириной 1080, байт")
+    parser.add_argument("--video-size", type=int, default=3_000_000, help="размер видео шириной 720, байт")
+    parser.add_argument("--tg-latency", type=float, default=30, help="задержка Bot API, мс")
+    parser.add_argument("--tg-error-rate", type=float, default=0.0, help="доля ответов 429 от Telegram")
+    parser.add_argument("--record", help="записать ответы поддельного Instagram в JSONL")
+    parser.add_argument("--replay", help="воспроизвести ответы Instagram из JSONL")
+    parser.add_argument("--output", help="сохранить отчёт в JSON")
+    parser.add_argument("--compare", help="сравнить с отчётом из JSON")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep-workdir", action="store_true", help="не удалять временный каталог")
+    parser.add_argument("--log-level", default="WARNING")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level, format="%(asctime)s - %(levelname)s - %(message)s")
+    for name in ("record", "replay", "output", "compare"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    workdir = tempfile.mkdtemp(prefix="instasplinter-bench-")
+    instagram_port, telegram_port = _free_port(), _free_port()
+    instagram_args = [
+        "--profiles", str(args.profiles), "--page-size", str(args.page_size),
+        "--latency", str(args.ig_latency), "--cdn-latency", str(args.cdn_latency),
+        "--error-rate", str(args.ig_error_rate), "--photo-size", str(args.photo_size),
+        "--video-size", str(args.video_size), "--seed", str(args.seed)
+    ]
+    if args.record:
+        instagram_args += ["--record", args.record]
+    if args.replay:
+        instagram_args += ["--replay", args.replay]
+    servers = [
+        _start_server("fake_instagram.py", instagram_port, instagram_args),
+        _start_server("fake_telegram.py", telegram_port, [
+            "--latency", str(args.tg_latency), "--error-rate", str(args.tg_error_rate), "--seed", str(args.seed)
+        ])
+    ]
+    instagram_url, telegram_url = f"http://127.0.0.1:{instagram_port}", f"http://127.0.0.1:{telegram_port}"
+    try:
+        _prepare_environment(args, workdir)
+        report = asyncio.run(run_benchmark(args, instagram_url, telegram_url))
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            print("\n".join(compare(report, json.load(file))))
+
+
+if __name__ == "__main__":
+    main()
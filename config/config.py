@@ -6,7 +6,153 @@ load_dotenv()
 
 # Telegram
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+# Приём апдейтов: пустой WEBHOOK_URL — long polling; иначе вебхук на WEBHOOK_URL + WEBHOOK_PATH
+# (публичный HTTPS-адрес; TLS обычно завершает обратный прокси перед ботом)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token
+# (обязателен для вебхука; 1–256 символов A-Z, a-z, 0-9, _ и -)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Адрес и порт HTTP-сервера вебхука
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Процессов, принимающих апдейты (делят порт через SO_REUSEPORT); при нескольких процессах
+# состояние диалога пользователей хранится в базе. Лимит запросов к Instagram (GRAPHQL_RATE)
+# процессы делят через базу, а SESSION_REQUEST_BUDGET делится между ними поровну
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+# Сколько одновременных соединений Telegram открывает к вебхуку (1–100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
 
 # Instagram
 INSTAGRAM_USERNAME = os.getenv("INSTAGRAM_USERNAME")
 INSTAGRAM_PASSWORD = os.getenv("INSTAGRAM_PASSWORD")
+
+# Пул сессий Instagram: бюджет запросов на сессию за окно (сек, в каждом процессе свой)
+# и пауза после ошибок (сек)
+SESSION_REQUEST_BUDGET = int(os.getenv("SESSION_REQUEST_BUDGET", "200"))
+SESSION_BUDGET_WINDOW = int(os.getenv("SESSION_BUDGET_WINDOW", "3600"))
+SESSION_COOLDOWN = int(os.getenv("SESSION_COOLDOWN", "600"))
+# Предохранитель сессии: пауза после ограничения скорости удваивается до SESSION_MAX_COOLDOWN (сек)
+SESSION_MAX_COOLDOWN = int(os.getenv("SESSION_MAX_COOLDOWN", str(6 * 3600)))
+# Сколько секунд запрос ждёт свободную сессию; если все сессии на паузе дольше — ошибка сразу
+SESSION_LEASE_TIMEOUT = float(os.getenv("SESSION_LEASE_TIMEOUT", "30"))
+
+# Общие лимитеры запросов (запросов в секунду и размер всплеска): API Instagram и CDN медиа.
+# Лимит действует на всю машину: процессы бота, worker.py и вебхука делят его через базу
+GRAPHQL_RATE = float(os.getenv("GRAPHQL_RATE", "0.5"))
+GRAPHQL_BURST = float(os.getenv("GRAPHQL_BURST", "10"))
+# Дольше стольких секунд запрос к Instagram токена не ждёт (ведро закрыто после 429) —
+# прерывается с RateLimitedError, не занимая поток и сессию
+GRAPHQL_MAX_WAIT = float(os.getenv("GRAPHQL_MAX_WAIT", "30"))
+CDN_RATE = float(os.getenv("CDN_RATE", "20"))
+CDN_BURST = float(os.getenv("CDN_BURST", "40"))
+# При 429 скорость падает вдвое, но не ниже доли LIMITER_MIN_RATE от максимальной;
+# каждый успешный запрос возвращает LIMITER_RECOVERY от максимальной скорости.
+LIMITER_MIN_RATE = float(os.getenv("LIMITER_MIN_RATE", "0.1"))
+LIMITER_RECOVERY = float(os.getenv("LIMITER_RECOVERY", "0.05"))
+# Пауза после 429 (сек), если сервер не назвал свою; удваивается при повторных 429
+LIMITER_BACKOFF = float(os.getenv("LIMITER_BACKOFF", "60"))
+LIMITER_MAX_BACKOFF = float(os.getenv("LIMITER_MAX_BACKOFF", "3600"))
+
+# Сколько секунд хранить курсор ленты профиля при листании публикаций
+FEED_CURSOR_TTL = int(os.getenv("FEED_CURSOR_TTL", "600"))
+# Новая подписка (ещё без отметки уровня) получает публикации не старше стольких часов
+FEED_BOOTSTRAP_HOURS = int(os.getenv("FEED_BOOTSTRAP_HOURS", "24"))
+
+# Справочник профилей: сколько секунд доверять сохранённым данным
+# (отдельно для несуществующих/закрытых профилей)
+PROFILE_TTL = int(os.getenv("PROFILE_TTL", "3600"))
+PROFILE_NEGATIVE_TTL = int(os.getenv("PROFILE_NEGATIVE_TTL", "21600"))
+
+# Планировщик: количество воркеров на каждой стадии и размер очередей между стадиями
+SCHEDULER_FETCH_WORKERS = int(os.getenv("SCHEDULER_FETCH_WORKERS", "4"))
+SCHEDULER_DOWNLOAD_WORKERS = int(os.getenv("SCHEDULER_DOWNLOAD_WORKERS", "8"))
+SCHEDULER_DELIVERY_WORKERS = int(os.getenv("SCHEDULER_DELIVERY_WORKERS", "4"))
+SCHEDULER_QUEUE_SIZE = int(os.getenv("SCHEDULER_QUEUE_SIZE", "32"))
+
+# Адаптивное расписание проверок (сек): у каждого профиля свой интервал в пределах
+# [SCHEDULER_MIN_INTERVAL, SCHEDULER_MAX_INTERVAL]. Интервал сокращается при новом контенте
+# и растёт в SCHEDULER_BACKOFF раз без него; SCHEDULER_JITTER — доля случайного разброса.
+# MAX меньше срока жизни историй (24 ч), чтобы ни одна история не пропала непросмотренной.
+SCHEDULER_MIN_INTERVAL = int(os.getenv("SCHEDULER_MIN_INTERVAL", "900"))
+SCHEDULER_MAX_INTERVAL = int(os.getenv("SCHEDULER_MAX_INTERVAL", "43200"))
+SCHEDULER_INITIAL_INTERVAL = int(os.getenv("SCHEDULER_INITIAL_INTERVAL", "3600"))
+SCHEDULER_BACKOFF = float(os.getenv("SCHEDULER_BACKOFF", "1.5"))
+SCHEDULER_JITTER = float(os.getenv("SCHEDULER_JITTER", "0.2"))
+# Сколько подошедших по времени профилей проверяется за один проход конвейера
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "20"))
+# Как часто (сек) планировщик сверяет список подписок, если проверять пока нечего
+SCHEDULER_TICK = int(os.getenv("SCHEDULER_TICK", "60"))
+# Аренда задания проверки воркером (сек): продлевается во время проверки, после падения воркера истекает
+POLL_LEASE_TIME = int(os.getenv("POLL_LEASE_TIME", "300"))
+# Запускать воркер проверок в процессе бота. 0 — бот только общается с пользователями,
+# проверки выполняют отдельные процессы worker.py
+EMBEDDED_WORKER = os.getenv("EMBEDDED_WORKER", "1") == "1"
+
+# Загрузка медиа с CDN Instagram: размер чанка (байт), параллельность, повторы и таймаут (сек)
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DOWNLOAD_CHUNK_SIZE", "65536"))
+DOWNLOAD_PER_HOST_LIMIT = int(os.getenv("DOWNLOAD_PER_HOST_LIMIT", "6"))
+DOWNLOAD_MAX_WORKERS = int(os.getenv("DOWNLOAD_MAX_WORKERS", "16"))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "3"))
+DOWNLOAD_TIMEOUT = float(os.getenv("DOWNLOAD_TIMEOUT", "30"))
+DOWNLOAD_BACKOFF = float(os.getenv("DOWNLOAD_BACKOFF", "0.5"))
+
+# Медиакэш на диске (файлы, скачанные с CDN): каталог, предел размера (байт) и сколько секунд
+# недавно использованный файл не вытесняется (его может отправлять другой процесс)
+MEDIA_CACHE_FOLDER = os.getenv("MEDIA_CACHE_FOLDER", "temp")
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+MEDIA_CACHE_MIN_AGE = int(os.getenv("MEDIA_CACHE_MIN_AGE", "600"))
+
+# Выбор разрешения медиа: берётся наименьший вариант не уже целевой ширины (px); 0 — самый большой.
+# Видео больше TELEGRAM_UPLOAD_LIMIT (байт, предел загрузки Bot API) понижается до меньшего варианта
+# или пропускается ещё до скачивания; 0 — не проверять
+PHOTO_TARGET_WIDTH = int(os.getenv("PHOTO_TARGET_WIDTH", "1080"))
+VIDEO_TARGET_WIDTH = int(os.getenv("VIDEO_TARGET_WIDTH", "720"))
+TELEGRAM_UPLOAD_LIMIT = int(os.getenv("TELEGRAM_UPLOAD_LIMIT", str(50 * 1024 * 1024)))
+
+# Потоковая отправка медиа: байты с CDN идут прямо в Telegram, минуя медиакэш.
+# Видео больше STREAM_MAX_VIDEO_BYTES (или неизвестного размера) всё же скачивается на диск.
+MEDIA_STREAMING = os.getenv("MEDIA_STREAMING", "1") == "1"
+STREAM_MAX_VIDEO_BYTES = int(os.getenv("STREAM_MAX_VIDEO_BYTES", str(20 * 1024 * 1024)))
+
+# Сколько потоков параллельно читают из SQLite для асинхронных хендлеров
+DB_READER_THREADS = int(os.getenv("DB_READER_THREADS", "4"))
+
+# Состояние диалогов: TTL (сек) и максимальное число записей в памяти
+USER_ACTION_TTL = int(os.getenv("USER_ACTION_TTL", "1800"))
+LAST_MESSAGE_TTL = int(os.getenv("LAST_MESSAGE_TTL", str(48 * 3600)))  # старше 48 ч Telegram не даёт удалить
+USER_STATE_MAX_SIZE = int(os.getenv("USER_STATE_MAX_SIZE", "10000"))
+# Язык пользователей: размер кэша в памяти и период записи изменений в SQLite (сек)
+LANG_CACHE_SIZE = int(os.getenv("LANG_CACHE_SIZE", "10000"))
+LANG_FLUSH_INTERVAL = float(os.getenv("LANG_FLUSH_INTERVAL", "5"))
+
+# Упреждающая загрузка при листании ленты: сколько постов видимой страницы загружать заранее
+# на пользователя (0 — выключено), сколько таких загрузок идёт одновременно на всех пользователей,
+# сколько секунд (с последнего обращения) и сколько штук держать загруженные посты
+PREFETCH_POSTS = int(os.getenv("PREFETCH_POSTS", "5"))
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+PREFETCH_TTL = int(os.getenv("PREFETCH_TTL", "300"))
+PREFETCH_CACHE_SIZE = int(os.getenv("PREFETCH_CACHE_SIZE", "500"))
+
+# Сколько потоков выполняют запросы Instaloader: фоновые (планировщик, упреждающая загрузка)
+# и отдельно — запросы из хендлеров пользователей
+INSTAGRAM_WORKERS = int(os.getenv("INSTAGRAM_WORKERS", "4"))
+INSTAGRAM_INTERACTIVE_WORKERS = int(os.getenv("INSTAGRAM_INTERACTIVE_WORKERS", "2"))
+
+# Эндпоинт метрик Prometheus (/metrics): адрес и порт; 0 — выключен.
+# Каждому процессу на одной машине нужен свой порт: процессы вебхука занимают METRICS_PORT,
+# METRICS_PORT + 1, ..., а отдельный worker.py — WORKER_METRICS_PORT
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9107"))
+
+# Лимиты Telegram: сообщений в секунду на бота и минимальный промежуток между сообщениями в один чат (сек)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", "1"))
+# Исходящая очередь: одновременных отправок, аренда сообщения (сек), число попыток,
+# начальная задержка повтора (сек, удваивается) и период опроса очереди (сек)
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "20"))
+OUTBOX_LEASE_TIME = int(os.getenv("OUTBOX_LEASE_TIME", "300"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_DELAY = float(os.getenv("OUTBOX_RETRY_DELAY", "5"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
@@ -1,94 +1,923 @@
 import sqlite3
 import os
+import time
+import threading
+from contextlib import contextmanager
 
 DB_PATH = "db/instagram_bot.db"
 
-def initialize_database():
-    """
-    Инициализация базы данных.
-    """
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+# Соединения живут всё время работы процесса: по одному на поток (WAL позволяет
+# читать параллельно, запись сериализует сам SQLite через busy_timeout).
+_local = threading.local()
 
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+# Настройки соединения: WAL, облегчённый fsync, кэш страниц в памяти
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",  # ~16 МБ
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 5000",
+)
 
-    # Создание таблицы для подписок
-    cursor.execute("""
+###############################
+# МИГРАЦИИ СХЕМЫ
+###############################
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется один раз,
+# в своей транзакции. Новые таблицы и индексы добавляются только новой миграцией в конец списка.
+MIGRATIONS = [
+    # 1: таблица подписок
+    [
+        """
         CREATE TABLE IF NOT EXISTS subscriptions (
             telegram_user_id INTEGER NOT NULL,
             username TEXT NOT NULL,
             last_sent_post_id TEXT,
             PRIMARY KEY (telegram_user_id, username)
         )
-    """)
+        """,
+    ],
+    # 2: индекс для группировки подписок, справочник профилей, кэш file_id Telegram
+    [
+        """
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_username
+        ON subscriptions (username)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS profiles (
+            username TEXT PRIMARY KEY,
+            userid INTEGER,
+            mediacount INTEGER,
+            has_viewable_story INTEGER,
+            status TEXT NOT NULL,
+            refreshed_at REAL NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS telegram_files (
+            media_id TEXT NOT NULL,
+            node_index INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            media_type TEXT NOT NULL,
+            PRIMARY KEY (media_id, node_index)
+        )
+        """,
+    ],
+    # 3: настройки пользователей бота (язык)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS user_settings (
+            telegram_user_id INTEGER PRIMARY KEY,
+            lang TEXT NOT NULL
+        )
+        """,
+    ],
+    # 4: отметка уровня (high-water mark) подписки — число публикаций профиля при последней проверке
+    [
+        """
+        ALTER TABLE subscriptions ADD COLUMN last_seen_mediacount INTEGER
+        """,
+    ],
+    # 5: журнал доставленных историй (запись живёт, пока история доступна в Instagram)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS seen_stories (
+            telegram_user_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            media_id INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (username, telegram_user_id, media_id)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_seen_stories_expires_at
+        ON seen_stories (expires_at)
+        """,
+    ],
+    # 6: расписание проверок профилей (свой интервал и время следующей проверки у каждого)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS poll_schedule (
+            username TEXT PRIMARY KEY,
+            check_interval REAL NOT NULL,
+            next_check_at REAL NOT NULL
+        )
+        """,
+    ],
+    # 7: состояние лимитеров запросов и предохранителей сессий (переживает перезапуск)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS limiter_state (
+            name TEXT PRIMARY KEY,
+            rate REAL,
+            backoff REAL,
+            blocked_until REAL
+        )
+        """,
+    ],
+    # 8: расписание проверок становится таблицей заданий с арендой (несколько воркеров)
+    [
+        """
+        ALTER TABLE poll_schedule ADD COLUMN lease_owner TEXT
+        """,
+        """
+        ALTER TABLE poll_schedule ADD COLUMN lease_expires_at REAL
+        """,
+        """
+        ALTER TABLE poll_schedule ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_poll_schedule_next_check_at
+        ON poll_schedule (next_check_at)
+        """,
+    ],
+    # 9: исходящая очередь сообщений Telegram и временные файлы, на которые она ссылается
+    [
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            next_attempt_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_expires_at REAL,
+            last_error TEXT
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_outbox_chat_id
+        ON outbox (chat_id, id)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt_at
+        ON outbox (next_attempt_at)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS outbox_files (
+            outbox_id INTEGER NOT NULL,
+            file_path TEXT NOT NULL,
+            PRIMARY KEY (outbox_id, file_path)
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_outbox_files_file_path
+        ON outbox_files (file_path)
+        """,
+    ],
+    # 10: состояние диалога пользователей, общее для нескольких процессов бота (режим вебхука)
+    [
+        """
+        CREATE TABLE IF NOT EXISTS user_state (
+            store TEXT NOT NULL,
+            telegram_user_id INTEGER NOT NULL,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (store, telegram_user_id)
+        )
+        """,
+    ],
+    # 11: ведро токенов лимитера, общее для всех процессов с этой базой
+    [
+        """
+        ALTER TABLE limiter_state ADD COLUMN tokens REAL
+        """,
+        """
+        ALTER TABLE limiter_state ADD COLUMN updated_at REAL
+        """,
+    ],
+]
+
+###############################
+# SQL-ЗАПРОСЫ
+###############################
+# Тексты запросов — константы: sqlite3 кэширует подготовленные выражения по тексту запроса
+SQL_ADD_SUBSCRIPTION = """
+    INSERT OR IGNORE INTO subscriptions (telegram_user_id, username, last_sent_post_id)
+    VALUES (?, ?, NULL)
+"""
+SQL_REMOVE_SUBSCRIPTION = """
+    DELETE FROM subscriptions
+    WHERE telegram_user_id = ? AND username = ?
+"""
+SQL_GET_USER_SUBSCRIPTIONS = """
+    SELECT telegram_user_id, username, last_sent_post_id
+    FROM subscriptions
+    WHERE telegram_user_id = ?
+"""
+SQL_GET_ALL_SUBSCRIPTIONS = """
+    SELECT telegram_user_id, username, last_sent_post_id
+    FROM subscriptions
+"""
+SQL_GET_PROFILE_SUBSCRIBERS = """
+    SELECT username, telegram_user_id, last_sent_post_id, last_seen_mediacount
+    FROM subscriptions
+    WHERE username = ?
+"""
+SQL_GET_SUBSCRIBERS_GROUPED = """
+    SELECT username, telegram_user_id, last_sent_post_id, last_seen_mediacount
+    FROM subscriptions
+    ORDER BY username
+"""
+SQL_UPDATE_LAST_SENT_POST_ID = """
+    UPDATE subscriptions
+    SET last_sent_post_id = ?
+    WHERE telegram_user_id = ? AND username = ?
+"""
+SQL_UPDATE_HIGH_WATER_MARK = """
+    UPDATE subscriptions
+    SET last_sent_post_id = COALESCE(?, last_sent_post_id),
+        last_seen_mediacount = COALESCE(?, last_seen_mediacount)
+    WHERE telegram_user_id = ? AND username = ?
+"""
+SQL_GET_PROFILE = """
+    SELECT username, userid, mediacount, has_viewable_story, status, refreshed_at
+    FROM profiles
+    WHERE username = ?
+"""
+SQL_UPSERT_PROFILE = """
+    INSERT INTO profiles (username, userid, mediacount, has_viewable_story, status, refreshed_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(username) DO UPDATE SET
+        userid = excluded.userid,
+        mediacount = excluded.mediacount,
+        has_viewable_story = COALESCE(excluded.has_viewable_story, profiles.has_viewable_story),
+        status = excluded.status,
+        refreshed_at = excluded.refreshed_at
+"""
+SQL_UPDATE_PROFILE_STORY_FLAG = """
+    UPDATE profiles
+    SET has_viewable_story = ?
+    WHERE username = ?
+"""
+SQL_GET_CACHED_FILES = """
+    SELECT node_index, file_id, media_type
+    FROM telegram_files
+    WHERE media_id = ?
+"""
+SQL_SAVE_FILE_ID = """
+    INSERT OR REPLACE INTO telegram_files (media_id, node_index, file_id, media_type)
+    VALUES (?, ?, ?, ?)
+"""
+SQL_DELETE_FILE_ID = """
+    DELETE FROM telegram_files
+    WHERE media_id = ? AND node_index = ?
+"""
+SQL_GET_USER_LANG = """
+    SELECT lang
+    FROM user_settings
+    WHERE telegram_user_id = ?
+"""
+SQL_SAVE_USER_LANG = """
+    INSERT INTO user_settings (telegram_user_id, lang)
+    VALUES (?, ?)
+    ON CONFLICT(telegram_user_id) DO UPDATE SET lang = excluded.lang
+"""
+SQL_GET_USER_STATE = """
+    SELECT value, expires_at
+    FROM user_state
+    WHERE store = ? AND telegram_user_id = ? AND expires_at > ?
+"""
+SQL_SAVE_USER_STATE = """
+    INSERT OR REPLACE INTO user_state (store, telegram_user_id, value, expires_at)
+    VALUES (?, ?, ?, ?)
+"""
+SQL_DELETE_USER_STATE = """
+    DELETE FROM user_state
+    WHERE store = ? AND telegram_user_id = ?
+"""
+SQL_PURGE_USER_STATES = """
+    DELETE FROM user_state
+    WHERE expires_at <= ?
+"""
+SQL_GET_SEEN_STORIES = """
+    SELECT telegram_user_id, media_id
+    FROM seen_stories
+    WHERE username = ? AND expires_at > ?
+"""
+SQL_MARK_STORY_SEEN = """
+    INSERT OR REPLACE INTO seen_stories (telegram_user_id, username, media_id, expires_at)
+    VALUES (?, ?, ?, ?)
+"""
+SQL_PURGE_SEEN_STORIES = """
+    DELETE FROM seen_stories
+    WHERE expires_at <= ?
+"""
+SQL_ADD_POLL_JOBS = """
+    INSERT OR IGNORE INTO poll_schedule (username, check_interval, next_check_at)
+    SELECT DISTINCT username, ?, ? + (abs(random()) % 1000000) / 1000000.0 * ?
+    FROM subscriptions
+"""
+SQL_REMOVE_ORPHAN_POLL_JOBS = """
+    DELETE FROM poll_schedule
+    WHERE username NOT IN (SELECT username FROM subscriptions)
+"""
+SQL_GET_DUE_POLL_JOBS = """
+    SELECT username, check_interval, attempts
+    FROM poll_schedule
+    WHERE next_check_at <= ? AND (lease_owner IS NULL OR lease_expires_at <= ?)
+    ORDER BY next_check_at
+    LIMIT ?
+"""
+SQL_LEASE_POLL_JOB = """
+    UPDATE poll_schedule
+    SET lease_owner = ?,
+        lease_expires_at = ?,
+        next_check_at = ? + min(? * (1 << min(attempts, 16)), ?),
+        attempts = attempts + 1
+    WHERE username = ?
+"""
+SQL_EXTEND_POLL_JOB_LEASE = """
+    UPDATE poll_schedule
+    SET lease_expires_at = ?,
+        next_check_at = max(next_check_at, ?)
+    WHERE username = ? AND lease_owner = ?
+"""
+SQL_COMPLETE_POLL_JOB = """
+    UPDATE poll_schedule
+    SET check_interval = ?,
+        next_check_at = ?,
+        lease_owner = NULL,
+        lease_expires_at = NULL,
+        attempts = 0
+    WHERE username = ? AND lease_owner = ?
+"""
+SQL_RELEASE_POLL_JOB = """
+    UPDATE poll_schedule
+    SET next_check_at = ?,
+        lease_owner = NULL,
+        lease_expires_at = NULL
+    WHERE username = ? AND lease_owner = ?
+"""
+SQL_GET_NEXT_POLL_JOB_AT = """
+    SELECT MIN(next_check_at)
+    FROM poll_schedule
+"""
+SQL_COUNT_DUE_POLL_JOBS = """
+    SELECT COUNT(*)
+    FROM poll_schedule
+    WHERE next_check_at <= ?
+"""
+SQL_GET_LIMITER_STATE = """
+    SELECT rate, backoff, blocked_until
+    FROM limiter_state
+    WHERE name = ?
+"""
+SQL_SAVE_LIMITER_STATE = """
+    INSERT OR REPLACE INTO limiter_state (name, rate, backoff, blocked_until)
+    VALUES (?, ?, ?, ?)
+"""
+SQL_GET_SHARED_LIMITER_STATE = """
+    SELECT rate, backoff, blocked_until, tokens, updated_at
+    FROM limiter_state
+    WHERE name = ?
+"""
+SQL_SAVE_SHARED_LIMITER_STATE = """
+    INSERT OR REPLACE INTO limiter_state (name, rate, backoff, blocked_until, tokens, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+SQL_ENQUEUE_OUTBOX = """
+    INSERT INTO outbox (chat_id, payload, created_at, next_attempt_at)
+    VALUES (?, ?, ?, ?)
+"""
+SQL_ADD_OUTBOX_FILE = """
+    INSERT OR IGNORE INTO outbox_files (outbox_id, file_path)
+    VALUES (?, ?)
+"""
+SQL_GET_DUE_OUTBOX = """
+    SELECT id, chat_id, payload, attempts
+    FROM outbox AS message
+    WHERE next_attempt_at <= ?
+      AND (lease_owner IS NULL OR lease_expires_at <= ?)
+      AND id = (SELECT MIN(id) FROM outbox WHERE chat_id = message.chat_id)
+    ORDER BY next_attempt_at, id
+    LIMIT ?
+"""
+SQL_LEASE_OUTBOX = """
+    UPDATE outbox
+    SET lease_owner = ?, lease_expires_at = ?
+    WHERE id = ?
+"""
+SQL_EXTEND_OUTBOX_LEASE = """
+    UPDATE outbox
+    SET lease_expires_at = ?
+    WHERE id = ? AND lease_owner = ?
+"""
+SQL_RETRY_OUTBOX = """
+    UPDATE outbox
+    SET next_attempt_at = ?,
+        attempts = attempts + ?,
+        last_error = ?,
+        lease_owner = NULL,
+        lease_expires_at = NULL
+    WHERE id = ? AND lease_owner = ?
+"""
+SQL_DELETE_OUTBOX = """
+    DELETE FROM outbox
+    WHERE id = ?
+"""
+SQL_DELETE_OUTBOX_FILES = """
+    DELETE FROM outbox_files
+    WHERE outbox_id = ?
+"""
+SQL_GET_OUTBOX_FILE_PATHS = """
+    SELECT DISTINCT file_path
+    FROM outbox_files
+"""
+SQL_GET_NEXT_OUTBOX_AT = """
+    SELECT MIN(max(next_attempt_at, COALESCE(lease_expires_at, 0)))
+    FROM outbox
+    WHERE id IN (SELECT MIN(id) FROM outbox GROUP BY chat_id)
+"""
+SQL_COUNT_OUTBOX = """
+    SELECT COUNT(*)
+    FROM outbox
+"""
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Возвращает долгоживущее соединение текущего потока (создаёт при первом обращении).
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+    return conn
+
+def close_connection():
+    """
+    Закрывает соединение текущего потока (если оно открыто).
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+@contextmanager
+def immediate_transaction(conn: sqlite3.Connection):
+    """
+    Явная транзакция BEGIN IMMEDIATE: блокировка записи берётся сразу, и в транзакцию
+    попадают в том числе DDL-запросы (в устаревшем режиме транзакций модуля sqlite3
+    `with conn:` их не охватывает). Фиксируется при выходе, откатывается при ошибке.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
     conn.commit()
-    conn.close()
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """
+    Применяет недостающие миграции из MIGRATIONS. Возвращает итоговую версию схемы.
+    Каждая миграция — отдельная транзакция BEGIN IMMEDIATE: при падении процесса посреди миграции
+    она откатывается целиком, а версия схемы перечитывается внутри транзакции, поэтому
+    одновременный запуск нескольких процессов (бот и worker.py) не применяет миграцию дважды.
+    """
+    while True:
+        with immediate_transaction(conn):
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= len(MIGRATIONS):
+                return version
+            for statement in MIGRATIONS[version]:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+
+def initialize_database():
+    """
+    Инициализация базы данных: настройка соединения и применение миграций схемы.
+    """
+    migrate(get_connection())
 
 def add_subscription(telegram_user_id: int, username: str):
     """
     Добавление подписки для пользователя.
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        INSERT OR IGNORE INTO subscriptions (telegram_user_id, username, last_sent_post_id)
-        VALUES (?, ?, NULL)
-    """, (telegram_user_id, username))
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_ADD_SUBSCRIPTION, (telegram_user_id, username))
 
 def remove_subscription(telegram_user_id: int, username: str):
     """
     Удаление подписки для пользователя.
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        DELETE FROM subscriptions
-        WHERE telegram_user_id = ? AND username = ?
-    """, (telegram_user_id, username))
-    conn.commit()
-    conn.close()
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_REMOVE_SUBSCRIPTION, (telegram_user_id, username))
 
 def get_subscriptions(telegram_user_id: int = None):
     """
     Получение списка подписок.
     Если указан telegram_user_id, возвращаются подписки только для этого пользователя.
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-
+    conn = get_connection()
     if telegram_user_id:
-        cursor.execute("""
-            SELECT telegram_user_id, username, last_sent_post_id
-            FROM subscriptions
-            WHERE telegram_user_id = ?
-        """, (telegram_user_id,))
-    else:
-        cursor.execute("""
-            SELECT telegram_user_id, username, last_sent_post_id
-            FROM subscriptions
-        """)
+        return conn.execute(SQL_GET_USER_SUBSCRIPTIONS, (telegram_user_id,)).fetchall()
+    return conn.execute(SQL_GET_ALL_SUBSCRIPTIONS).fetchall()
 
-    subscriptions = cursor.fetchall()
-    conn.close()
+def get_subscriptions_grouped(username: str = None) -> dict:
+    """
+    Получение подписок, сгруппированных по никнейму Instagram.
+    Возвращает словарь {username: [(telegram_user_id, last_sent_post_id, last_seen_mediacount), ...]}.
+    Если указан username, возвращаются подписчики только этого аккаунта.
+    """
+    conn = get_connection()
+    if username:
+        rows = conn.execute(SQL_GET_PROFILE_SUBSCRIBERS, (username,))
+    else:
+        rows = conn.execute(SQL_GET_SUBSCRIBERS_GROUPED)
 
-    return subscriptions
+    grouped = {}
+    for insta_username, telegram_user_id, last_sent_post_id, last_seen_mediacount in rows:
+        grouped.setdefault(insta_username, []).append(
+            (telegram_user_id, last_sent_post_id, last_seen_mediacount)
+        )
+    return grouped
 
 def update_last_sent_post_id(telegram_user_id: int, username: str, last_sent_post_id: str):
     """
     Обновление последнего ID публикации.
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    update_last_sent_post_ids([(telegram_user_id, username, last_sent_post_id)])
 
-    cursor.execute("""
-        UPDATE subscriptions
-        SET last_sent_post_id = ?
-        WHERE telegram_user_id = ? AND username = ?
-    """, (last_sent_post_id, telegram_user_id, username))
-    conn.commit()
-    conn.close()
+def update_last_sent_post_ids(updates: list):
+    """
+    Пакетное обновление последних ID публикаций одной транзакцией (один fsync на весь пакет).
+    updates = [(telegram_user_id, username, last_sent_post_id), ...]
+    """
+    if not updates:
+        return
+    conn = get_connection()
+    with conn:
+        conn.executemany(
+            SQL_UPDATE_LAST_SENT_POST_ID,
+            [(last_sent_post_id, telegram_user_id, username)
+             for telegram_user_id, username, last_sent_post_id in updates]
+        )
+
+def update_high_water_marks(updates: list):
+    """
+    Пакетное обновление отметок уровня подписок одной транзакцией.
+    updates = [(telegram_user_id, username, last_sent_post_id, last_seen_mediacount), ...]
+    None в last_sent_post_id / last_seen_mediacount оставляет сохранённое значение.
+    """
+    if not updates:
+        return
+    conn = get_connection()
+    with conn:
+        conn.executemany(
+            SQL_UPDATE_HIGH_WATER_MARK,
+            [(None if last_sent_post_id is None else str(last_sent_post_id),
+              last_seen_mediacount, telegram_user_id, username)
+             for telegram_user_id, username, last_sent_post_id, last_seen_mediacount in updates]
+        )
+
+def get_profile(username: str):
+    """
+    Получение профиля из справочника.
+    Возвращает словарь с ключами username, userid, mediacount, has_viewable_story,
+    status ("ok" / "private" / "not_exists"), refreshed_at — или None, если профиля нет.
+    """
+    row = get_connection().execute(SQL_GET_PROFILE, (username,)).fetchone()
+    if row is None:
+        return None
+    return {
+        "username": row[0],
+        "userid": row[1],
+        "mediacount": row[2],
+        "has_viewable_story": None if row[3] is None else bool(row[3]),
+        "status": row[4],
+        "refreshed_at": row[5]
+    }
+
+def upsert_profile(
+    username: str,
+    status: str,
+    userid: int = None,
+    mediacount: int = None,
+    has_viewable_story: bool = None
+):
+    """
+    Сохранение (или обновление) профиля в справочнике с текущим временем обновления.
+    has_viewable_story=None оставляет ранее сохранённое значение.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_UPSERT_PROFILE, (
+            username, userid, mediacount,
+            None if has_viewable_story is None else int(has_viewable_story),
+            status, time.time()
+        ))
+
+def update_profile_story_flag(username: str, has_viewable_story: bool):
+    """
+    Обновление признака наличия историй без сдвига времени обновления профиля.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_UPDATE_PROFILE_STORY_FLAG, (int(has_viewable_story), username))
+
+def get_cached_files(media_id: str) -> dict:
+    """
+    Получение сохранённых file_id Telegram для медиа Instagram.
+    Возвращает словарь {node_index: (file_id, media_type)}.
+    """
+    rows = get_connection().execute(SQL_GET_CACHED_FILES, (str(media_id),))
+    return {node_index: (file_id, media_type) for node_index, file_id, media_type in rows}
+
+def save_file_id(media_id: str, node_index: int, file_id: str, media_type: str):
+    """
+    Сохранение file_id Telegram, полученного после первой загрузки медиа.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_SAVE_FILE_ID, (str(media_id), node_index, file_id, media_type))
+
+def delete_file_ids(entries: list):
+    """
+    Удаление недействительных file_id Telegram: entries = [(media_id, node_index), ...].
+    """
+    if not entries:
+        return
+    conn = get_connection()
+    with conn:
+        conn.executemany(SQL_DELETE_FILE_ID, [(str(media_id), node_index) for media_id, node_index in entries])
+
+def get_user_lang(telegram_user_id: int):
+    """
+    Получение сохранённого языка пользователя или None.
+    """
+    row = get_connection().execute(SQL_GET_USER_LANG, (telegram_user_id,)).fetchone()
+    return row[0] if row else None
+
+def save_user_langs(langs: list):
+    """
+    Пакетное сохранение языков пользователей: langs = [(telegram_user_id, lang), ...].
+    """
+    if not langs:
+        return
+    conn = get_connection()
+    with conn:
+        conn.executemany(SQL_SAVE_USER_LANG, langs)
+
+def get_user_state(store: str, telegram_user_id: int):
+    """
+    Получение сохранённого состояния пользователя: (value, expires_at) или None, если его нет или оно истекло.
+    """
+    return get_connection().execute(SQL_GET_USER_STATE, (store, telegram_user_id, time.time())).fetchone()
+
+def save_user_states(states: list):
+    """
+    Пакетное сохранение состояния пользователей: states = [(store, telegram_user_id, value, expires_at), ...].
+    value = None — состояние удалено.
+    """
+    if not states:
+        return
+    conn = get_connection()
+    with conn:
+        for store, telegram_user_id, value, expires_at in states:
+            if value is None:
+                conn.execute(SQL_DELETE_USER_STATE, (store, telegram_user_id))
+            else:
+                conn.execute(SQL_SAVE_USER_STATE, (store, telegram_user_id, value, expires_at))
+
+def purge_user_states() -> int:
+    """
+    Удаление истёкшего состояния пользователей. Возвращает число удалённых записей.
+    """
+    conn = get_connection()
+    with conn:
+        return conn.execute(SQL_PURGE_USER_STATES, (time.time(),)).rowcount
+
+def get_seen_story_ids(username: str) -> dict:
+    """
+    Получение уже доставленных историй аккаунта.
+    Возвращает словарь {telegram_user_id: {media_id, ...}}.
+    """
+    rows = get_connection().execute(SQL_GET_SEEN_STORIES, (username, time.time()))
+    seen = {}
+    for telegram_user_id, media_id in rows:
+        seen.setdefault(telegram_user_id, set()).add(media_id)
+    return seen
+
+def mark_stories_seen(entries: list):
+    """
+    Пакетная запись доставленных историй одной транзакцией.
+    entries = [(telegram_user_id, username, media_id, expires_at), ...]
+    """
+    if not entries:
+        return
+    conn = get_connection()
+    with conn:
+        conn.executemany(SQL_MARK_STORY_SEEN, entries)
+
+def purge_seen_stories() -> int:
+    """
+    Удаление записей об историях, срок жизни которых истёк. Возвращает число удалённых записей.
+    """
+    conn = get_connection()
+    with conn:
+        return conn.execute(SQL_PURGE_SEEN_STORIES, (time.time(),)).rowcount
+
+def sync_poll_jobs(initial_interval: float):
+    """
+    Приводит таблицу заданий проверки к списку подписок: новые аккаунты получают задание
+    со случайным временем первой проверки в пределах initial_interval, задания аккаунтов
+    без подписчиков удаляются.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_ADD_POLL_JOBS, (initial_interval, time.time(), initial_interval))
+        conn.execute(SQL_REMOVE_ORPHAN_POLL_JOBS)
+
+def claim_poll_jobs(owner: str, limit: int, lease_time: float, retry_delay: float, max_retry_delay: float) -> list:
+    """
+    Атомарно арендует до limit заданий, время которых наступило (в том числе задания
+    с истёкшей арендой упавших воркеров). Возвращает [(username, check_interval, attempts), ...].
+    На случай падения воркера время следующей проверки сразу сдвигается за конец аренды
+    с экспоненциальной задержкой по числу попыток (retry_delay * 2^attempts, не больше max_retry_delay).
+    """
+    conn = get_connection()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        jobs = conn.execute(SQL_GET_DUE_POLL_JOBS, (now, now, limit)).fetchall()
+        conn.executemany(SQL_LEASE_POLL_JOB, [
+            (owner, now + lease_time, now + lease_time, retry_delay, max_retry_delay, username)
+            for username, _, _ in jobs
+        ])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return [(username, check_interval, attempts + 1) for username, check_interval, attempts in jobs]
+
+def extend_poll_job_leases(owner: str, usernames: list, lease_time: float):
+    """
+    Продлевает аренду заданий воркера (heartbeat), пока идёт проверка.
+    """
+    lease_expires_at = time.time() + lease_time
+    conn = get_connection()
+    with conn:
+        conn.executemany(SQL_EXTEND_POLL_JOB_LEASE, [
+            (lease_expires_at, lease_expires_at, username, owner) for username in usernames
+        ])
+
+def complete_poll_jobs(owner: str, entries: list):
+    """
+    Завершает задания и планирует следующие проверки:
+    entries = [(username, check_interval, next_check_at), ...].
+    Задание, аренду которого уже перехватил другой воркер, не меняется.
+    """
+    if not entries:
+        return
+    conn = get_connection()
+    with conn:
+        conn.executemany(SQL_COMPLETE_POLL_JOB, [
+            (check_interval, next_check_at, username, owner)
+            for username, check_interval, next_check_at in entries
+        ])
+
+def release_poll_jobs(owner: str, entries: list):
+    """
+    Снимает аренду с неудачных заданий для повторной попытки:
+    entries = [(username, retry_at), ...]. Счётчик попыток сохраняется.
+    """
+    if not entries:
+        return
+    conn = get_connection()
+    with conn:
+        conn.executemany(SQL_RELEASE_POLL_JOB, [
+            (retry_at, username, owner) for username, retry_at in entries
+        ])
+
+def get_next_poll_job_at():
+    """
+    Время ближайшего задания проверки (timestamp) или None, если заданий нет.
+    """
+    return get_connection().execute(SQL_GET_NEXT_POLL_JOB_AT).fetchone()[0]
 
+def count_due_poll_jobs() -> int:
+    """
+    Число заданий проверки, время которых уже наступило (отставание воркеров).
+    """
+    return get_connection().execute(SQL_COUNT_DUE_POLL_JOBS, (time.time(),)).fetchone()[0]
+
+def get_limiter_state(name: str):
+    """
+    Получение сохранённого состояния лимитера: (rate, backoff, blocked_until) или None.
+    """
+    return get_connection().execute(SQL_GET_LIMITER_STATE, (name,)).fetchone()
+
+def save_limiter_state(name: str, rate: float, backoff: float, blocked_until: float):
+    """
+    Сохранение состояния лимитера (скорость, следующая пауза, пауза до какого времени).
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_SAVE_LIMITER_STATE, (name, rate, backoff, blocked_until))
+
+# Поля общего состояния лимитера (update_limiter_state)
+SHARED_LIMITER_FIELDS = ("rate", "backoff", "blocked_until", "tokens", "updated_at")
+
+def update_limiter_state(name: str, update):
+    """
+    Атомарно (BEGIN IMMEDIATE) читает общее состояние лимитера name, передаёт его в update(state)
+    и сохраняет изменённое состояние. Так лимитер делят все процессы с этой базой.
+    state — словарь с ключами SHARED_LIMITER_FIELDS (пустой, если записи ещё нет).
+    Возвращает результат update; исключение из update откатывает транзакцию.
+    """
+    conn = get_connection()
+    with immediate_transaction(conn):
+        row = conn.execute(SQL_GET_SHARED_LIMITER_STATE, (name,)).fetchone()
+        state = dict(zip(SHARED_LIMITER_FIELDS, row)) if row else {}
+        result = update(state)
+        if state:
+            conn.execute(SQL_SAVE_SHARED_LIMITER_STATE, (name, *(state.get(field) for field in SHARED_LIMITER_FIELDS)))
+    return result
+
+def enqueue_outbox(messages: list):
+    """
+    Ставит сообщения в исходящую очередь одной транзакцией.
+    messages = [(chat_id, payload_json, [file_path, ...]), ...] — порядок внутри чата сохраняется.
+    """
+    if not messages:
+        return
+    now = time.time()
+    conn = get_connection()
+    with conn:
+        for chat_id, payload, file_paths in messages:
+            outbox_id = conn.execute(SQL_ENQUEUE_OUTBOX, (chat_id, payload, now, now)).lastrowid
+            conn.executemany(SQL_ADD_OUTBOX_FILE, [(outbox_id, file_path) for file_path in file_paths])
+
+def claim_outbox(owner: str, limit: int, lease_time: float, exclude_ids=()) -> list:
+    """
+    Атомарно арендует до limit сообщений, готовых к отправке: из каждого чата — только
+    самое старое (следующее сообщение чата ждёт, пока не уйдёт предыдущее).
+    exclude_ids — сообщения, которые вызывающий ещё отправляет: их не арендует повторно,
+    даже если аренда успела истечь.
+    Возвращает [(id, chat_id, payload_json, attempts), ...].
+    """
+    exclude_ids = set(exclude_ids)
+    conn = get_connection()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        messages = [
+            row for row in conn.execute(SQL_GET_DUE_OUTBOX, (now, now, limit + len(exclude_ids)))
+            if row[0] not in exclude_ids
+        ][:limit]
+        conn.executemany(SQL_LEASE_OUTBOX, [(owner, now + lease_time, row[0]) for row in messages])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return messages
+
+def extend_outbox_lease(outbox_id: int, owner: str, lease_time: float):
+    """
+    Продлевает аренду сообщения, пока идёт его отправка (heartbeat).
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_EXTEND_OUTBOX_LEASE, (time.time() + lease_time, outbox_id, owner))
+
+def retry_outbox(outbox_id: int, owner: str, next_attempt_at: float, error: str, count_attempt: bool = True):
+    """
+    Возвращает сообщение в очередь для повторной отправки не раньше next_attempt_at.
+    count_attempt=False — не считать попытку (например, Telegram попросил подождать).
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_RETRY_OUTBOX, (next_attempt_at, int(count_attempt), error, outbox_id, owner))
+
+def complete_outbox(outbox_id: int):
+    """
+    Удаляет сообщение из очереди (отправлено или отброшено) вместе с его ссылками на файлы медиакэша.
+    """
+    conn = get_connection()
+    with conn:
+        conn.execute(SQL_DELETE_OUTBOX_FILES, (outbox_id,))
+        conn.execute(SQL_DELETE_OUTBOX, (outbox_id,))
+
+def get_outbox_file_paths() -> list:
+    """
+    Файлы медиакэша, на которые ссылаются сообщения исходящей очереди (их нельзя вытеснять).
+    """
+    return [row[0] for row in get_connection().execute(SQL_GET_OUTBOX_FILE_PATHS)]
+
+def get_next_outbox_at():
+    """
+    Время, когда станет готово ближайшее сообщение очереди (timestamp), или None, если очередь пуста.
+    """
+    return get_connection().execute(SQL_GET_NEXT_OUTBOX_AT).fetchone()[0]
+
+def count_outbox() -> int:
+    """
+    Число сообщений в исходящей очереди.
+    """
+    return get_connection().execute(SQL_COUNT_OUTBOX).fetchone()[0]
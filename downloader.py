@@ -0,0 +1,193 @@
+import os
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import httpx
+from rate_limiter import cdn_limiter
+from metrics import media_download_seconds, media_download_bytes_total
+from config.config import (
+    DOWNLOAD_CHUNK_SIZE, DOWNLOAD_PER_HOST_LIMIT, DOWNLOAD_MAX_WORKERS,
+    DOWNLOAD_RETRIES, DOWNLOAD_TIMEOUT, DOWNLOAD_BACKOFF
+)
+
+# Коды ответа, после которых имеет смысл повторить запрос
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Общий HTTP-клиент с пулом соединений (keep-alive) для CDN Instagram
+_client = httpx.Client(
+    timeout=DOWNLOAD_TIMEOUT,
+    follow_redirects=True,
+    limits=httpx.Limits(
+        max_connections=DOWNLOAD_MAX_WORKERS,
+        max_keepalive_connections=DOWNLOAD_MAX_WORKERS
+    )
+)
+# Клиенты для запросов через прокси: {(http_proxy, https_proxy): httpx.Client}
+_proxy_clients = {}
+_clients_lock = threading.Lock()
+
+# Ограничение одновременных загрузок с одного хоста: {host: Semaphore}
+_host_semaphores = {}
+_host_semaphores_lock = threading.Lock()
+
+# Пул потоков для параллельной загрузки нескольких файлов (карусели, истории)
+_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_MAX_WORKERS, thread_name_prefix="download")
+
+
+def _get_client(proxies: dict = None) -> httpx.Client:
+    if not proxies:
+        return _client
+    key = (proxies.get("http"), proxies.get("https"))
+    with _clients_lock:
+        client = _proxy_clients.get(key)
+        if client is None:
+            mounts = {
+                f"{scheme}://": httpx.HTTPTransport(proxy=proxy)
+                for scheme, proxy in proxies.items() if proxy
+            }
+            client = httpx.Client(timeout=DOWNLOAD_TIMEOUT, follow_redirects=True, mounts=mounts)
+            _proxy_clients[key] = client
+        return client
+
+
+def _host_semaphore(url: str) -> threading.Semaphore:
+    host = urlsplit(url).hostname or ""
+    with _host_semaphores_lock:
+        semaphore = _host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(DOWNLOAD_PER_HOST_LIMIT)
+            _host_semaphores[host] = semaphore
+        return semaphore
+
+
+def _backoff(attempt: int) -> float:
+    """
+    Экспоненциальная задержка с джиттером (full jitter).
+    """
+    return random.uniform(0, DOWNLOAD_BACKOFF * (2 ** attempt))
+
+
+def _retry_after(response: httpx.Response):
+    """
+    Пауза из заголовка Retry-After (в секундах) или None.
+    """
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        return None
+
+
+def _request_with_retries(url: str, handle, proxies: dict = None):
+    """
+    Выполняет потоковый GET через общий пул соединений и передаёт ответ в handle(response).
+    Каждый запрос берёт токен общего лимитера CDN; на 429 лимитер снижает скорость для всех загрузок.
+    Повторяет запрос при сетевых ошибках и кодах 429/5xx (DOWNLOAD_RETRIES раз, с джиттером).
+    Возвращает результат handle или None при ошибке.
+    """
+    client = _get_client(proxies)
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            cdn_limiter.acquire()
+            with _host_semaphore(url):
+                with client.stream("GET", url) as response:
+                    if response.status_code in RETRY_STATUS_CODES and attempt < DOWNLOAD_RETRIES:
+                        raise httpx.HTTPStatusError(
+                            f"HTTP {response.status_code}", request=response.request, response=response
+                        )
+                    response.raise_for_status()
+                    result = handle(response)
+            cdn_limiter.success()
+            return result
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            retryable = (
+                isinstance(e, httpx.TransportError)
+                or e.response.status_code in RETRY_STATUS_CODES
+            )
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 429:
+                # Следующий запрос сам подождёт паузу лимитера
+                cdn_limiter.penalize(_retry_after(e.response) or _backoff(attempt + 1))
+            if not retryable or attempt >= DOWNLOAD_RETRIES:
+                logging.error(f"Ошибка при скачивании файла {url}: {e}")
+                return None
+            delay = _backoff(attempt)
+            logging.warning(f"Повтор скачивания {url} через {delay:.1f} c ({e})")
+            time.sleep(delay)
+        except Exception as e:
+            logging.error(f"Ошибка при скачивании файла {url}: {e}")
+            return None
+    return None
+
+
+def download_to_file(url: str, filepath: str, proxies: dict = None, chunk_size: int = None) -> bool:
+    """
+    Скачивает файл по URL в filepath потоково, через общий пул соединений.
+    Файл пишется во временный *.part (свой у каждого потока и процесса) и переименовывается
+    только после полной загрузки, поэтому другие никогда не видят недокачанный filepath.
+    Возвращает True при успехе.
+    """
+    chunk_size = chunk_size or DOWNLOAD_CHUNK_SIZE
+    part_path = f"{filepath}.{os.getpid()}-{threading.get_ident()}.part"
+
+    def write(response):
+        with open(part_path, "wb") as file:
+            for chunk in response.iter_bytes(chunk_size=chunk_size):
+                file.write(chunk)
+                media_download_bytes_total.inc(len(chunk))
+        os.replace(part_path, filepath)
+        return True
+
+    with media_download_seconds.time():
+        downloaded = _request_with_retries(url, write, proxies)
+    if downloaded:
+        return True
+    if os.path.exists(part_path):
+        os.remove(part_path)
+    return False
+
+
+def fetch_bytes(url: str, proxies: dict = None):
+    """
+    Скачивает файл по URL целиком в память (для небольших файлов, например фото).
+    Возвращает bytes или None при ошибке.
+    """
+    def read(response):
+        data = response.read()
+        media_download_bytes_total.inc(len(data))
+        return data
+
+    with media_download_seconds.time():
+        return _request_with_retries(url, read, proxies)
+
+
+def content_length(url: str, proxies: dict = None):
+    """
+    Возвращает размер файла по URL (заголовок Content-Length) или None, если он неизвестен.
+    """
+    try:
+        cdn_limiter.acquire()
+        with _host_semaphore(url):
+            response = _get_client(proxies).head(url)
+        response.raise_for_status()
+        length = response.headers.get("Content-Length")
+        return int(length) if length is not None else None
+    except Exception as e:
+        logging.warning(f"Не удалось узнать размер файла {url}: {e}")
+        return None
+
+
+def download_many(jobs: list, proxies: dict = None) -> list:
+    """
+    Параллельно скачивает несколько файлов: jobs = [(url, filepath), ...].
+    Возвращает список результатов download_to_file в том же порядке.
+    Время загрузки карусели близко ко времени самого медленного файла, а не к сумме.
+    """
+    if not jobs:
+        return []
+    if len(jobs) == 1:
+        url, filepath = jobs[0]
+        return [download_to_file(url, filepath, proxies)]
+    futures = [_executor.submit(download_to_file, url, filepath, proxies) for url, filepath in jobs]
+    return [future.result() for future in futures]
@@ -1,39 +1,96 @@
 import os
 import logging
-import requests
 import instaloader
-import shutil
-from datetime import datetime, timedelta
-from config.config import INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from config.config import (
+    INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD,
+    SESSION_REQUEST_BUDGET, SESSION_BUDGET_WINDOW, SESSION_COOLDOWN, SESSION_MAX_COOLDOWN, SESSION_LEASE_TIMEOUT,
+    FEED_CURSOR_TTL, FEED_BOOTSTRAP_HOURS, PROFILE_TTL, PROFILE_NEGATIVE_TTL, MEDIA_STREAMING
+)
+from database import (
+    get_profile, upsert_profile, update_profile_story_flag, get_cached_files,
+    get_limiter_state, save_limiter_state
+)
+import media_cache
+from media_variants import pick_image, pick_video, video_variants, is_video_node
+from session_pool import SessionPool, InstaSession, NoSessionAvailableError, SESSION_FILE_PREFIX
+from rate_limiter import (
+    LimitedRateController, RateLimitedError, graphql_limiter, cdn_limiter, is_rate_limit_error, last_query
+)
+from metrics import instagram_profile_seconds, instagram_feed_page_seconds, cache_lookup
 
-TEMP_FOLDER = "temp"
-SESSION_FOLDER = "sessions"  # Папка, где будем хранить файл сессии (по желанию)
+SESSION_FOLDER = "sessions"  # Папка, где хранятся файлы сессий (session-<username>)
 
-# Создание временных папок, если их нет
-os.makedirs(TEMP_FOLDER, exist_ok=True)
+# Создание папки сессий, если её нет
 os.makedirs(SESSION_FOLDER, exist_ok=True)
 
-# Инициализация Instaloader
-loader = instaloader.Instaloader()
+def _new_loader() -> instaloader.Instaloader:
+    """
+    Экземпляр Instaloader, все запросы которого проходят через общий лимитер.
+    """
+    return instaloader.Instaloader(rate_controller=LimitedRateController)
+
+# Пул сессий Instaloader: каждый запрос арендует одну из сессий в sessions/
+pool = SessionPool(
+    SESSION_FOLDER,
+    request_budget=SESSION_REQUEST_BUDGET,
+    budget_window=SESSION_BUDGET_WINDOW,
+    cooldown=SESSION_COOLDOWN,
+    max_cooldown=SESSION_MAX_COOLDOWN,
+    loader_factory=_new_loader,
+    credentials=(
+        {INSTAGRAM_USERNAME.lower(): INSTAGRAM_PASSWORD}
+        if INSTAGRAM_USERNAME and INSTAGRAM_PASSWORD else {}
+    )
+)
+
+# Статусы профилей в справочнике (таблица profiles)
+PROFILE_OK = "ok"
+PROFILE_PRIVATE = "private"
+PROFILE_NOT_EXISTS = "not_exists"
+
+# Instagram сейчас недоступен (ограничение скорости, все сессии на паузе): запросы из хендлеров
+# не глотают эти ошибки, чтобы пользователь узнал, что нужно попробовать позже
+INSTAGRAM_BUSY_ERRORS = (RateLimitedError, NoSessionAvailableError)
+
+# Кэш курсоров ленты: {username: {"posts": [...], "iterator": генератор _get_posts, ...}}
+# Позволяет листать ленту по index, не перечитывая уже загруженные страницы.
+_feed_cursors = {}
+_feed_cursors_lock = threading.Lock()
+
+# Когда этот процесс последний раз узнал, есть ли у профиля истории: {username: time.monotonic()}.
+# Истории появляются в любой момент, поэтому «историй нет» верим не дольше PROFILE_TTL
+_story_flag_checked_at = {}
 
 # -- Если хотите использовать прокси, раскомментируйте строки ниже и укажите ваш прокси --
+# (после login(), чтобы прокси получили все загруженные сессии)
 # proxy = "https://173.212.237.43:32562"
-# loader.context._session.proxies = {
-#     'http': proxy,
-#     'https': proxy
-# }
+# for session in pool.sessions:
+#     session.loader.context._session.proxies = {
+#         'http': proxy,
+#         'https': proxy
+#     }
+
+def _session_file(username: str) -> str:
+    return os.path.join(SESSION_FOLDER, f"{SESSION_FILE_PREFIX}{username.lower()}")
 
 def load_session(username: str, session_file: str = None) -> bool:
     """
-    Пытается загрузить ранее сохранённую сессию из файла session_file (по умолчанию session-USERNAME).
+    Пытается загрузить ранее сохранённую сессию из файла session_file (по умолчанию session-USERNAME)
+    и добавить её в пул.
     Возвращает True, если сессия загружена успешно, иначе False.
     """
     if session_file is None:
-        session_file = os.path.join(SESSION_FOLDER, f"session-{username.lower()}")
+        session_file = _session_file(username)
 
     if os.path.exists(session_file):
+        session = InstaSession(username.lower(), session_file, _new_loader())
         try:
-            loader.load_session_from_file(username, filename=session_file)
+            session.loader.load_session_from_file(username, filename=session_file)
+            pool.add(session)
             logging.info(f"Сессия загружена из файла: {session_file}")
             return True
         except Exception as e:
@@ -43,106 +100,570 @@ def load_session(username: str, session_file: str = None) -> bool:
         logging.info(f"Файл сессии не найден: {session_file}")
         return False
 
-def save_session(username: str, session_file: str = None):
+def save_session(session: InstaSession):
     """
-    Сохраняет текущую сессию Instaloader в файл (по умолчанию session-USERNAME).
+    Сохраняет сессию Instaloader в её файл (session-USERNAME).
     """
-    if session_file is None:
-        session_file = os.path.join(SESSION_FOLDER, f"session-{username.lower()}")
     try:
-        loader.save_session_to_file(filename=session_file)
-        logging.info(f"Сессия сохранена в файл: {session_file}")
+        session.loader.save_session_to_file(filename=session.session_file)
+        logging.info(f"Сессия сохранена в файл: {session.session_file}")
     except Exception as e:
-        logging.error(f"Ошибка при сохранении сессии {session_file}: {e}")
+        logging.error(f"Ошибка при сохранении сессии {session.session_file}: {e}")
 
 def login(username: str, password: str, use_session=True) -> None:
     """
     Авторизация в Instagram через Instaloader.
-    Если use_session=True, сначала пытается загрузить сессию.
-    Если не удалось, то логинится по логину/паролю и (при успехе) сохраняет сессию.
+    Если use_session=True, сначала загружает в пул все сессии из sessions/.
+    Если сессии для username среди них нет, логинится по логину/паролю и (при успехе) сохраняет сессию.
     """
-    # Попробуем загрузить сессию, если хотим
+    graphql_limiter.restore()
+    cdn_limiter.restore()
+
+    # Загружаем все сохранённые сессии, если хотим
     if use_session:
-        loaded = load_session(username)
-        if loaded:
+        loaded = pool.load()
+        logging.info(f"Загружено сессий Instaloader: {loaded}")
+        _restore_breakers()
+        if any(session.username == username.lower() for session in pool.sessions):
             logging.info("Сессия Instaloader загружена; повторный логин не требуется.")
             return
 
     # Если не загрузили или use_session=False, делаем классический логин
+    session = InstaSession(username.lower(), _session_file(username), _new_loader())
     try:
-        loader.login(username, password)
+        session.loader.login(username, password)
         logging.info("Успешная авторизация в Instagram.")
+        pool.add(session)
+        _restore_breakers()
         # Если нужно, сохраняем сессию
         if use_session:
-            save_session(username)
+            save_session(session)
     except instaloader.exceptions.BadCredentialsException:
         logging.error("Неверный логин или пароль.")
-        raise
+        if not pool.sessions:
+            raise
     except instaloader.exceptions.TwoFactorAuthRequiredException:
         logging.error("Требуется двухфакторная аутентификация.")
-        raise
+        if not pool.sessions:
+            raise
     except Exception as e:
         logging.error(f"Ошибка авторизации: {e}")
-        raise
+        if not pool.sessions:
+            raise
+
+# Как часто (сек) процесс перечитывает предохранители сессий, сработавшие в других процессах
+BREAKER_SYNC_INTERVAL = 5
+_breakers_synced_at = 0.0
+
+def split_session_budget(processes: int) -> None:
+    """
+    Делит бюджет аренд сессии (SESSION_REQUEST_BUDGET) между processes процессами,
+    которые работают с одними и теми же аккаунтами (процессы вебхука): каждый процесс
+    считает аренды сам, и без деления аккаунт получил бы бюджет в processes раз больше.
+    Лимитеры запросов и предохранители сессий и так общие (через базу).
+    """
+    pool.request_budget = max(1, SESSION_REQUEST_BUDGET // max(processes, 1))
+
+def _breaker_key(session: InstaSession) -> str:
+    return f"session:{session.username}"
+
+def _restore_breakers() -> None:
+    """
+    Перечитывает из базы паузы сессий: сработавшие до перезапуска и в других процессах
+    (бот, worker.py и процессы вебхука работают с одними и теми же аккаунтами).
+    """
+    global _breakers_synced_at
+    _breakers_synced_at = time.monotonic()
+    for session in pool.sessions:
+        state = get_limiter_state(_breaker_key(session))
+        if state is None:
+            continue
+        _, session.breaker_backoff, blocked_until = state
+        remaining = (blocked_until or 0) - time.time()
+        # Паузу, которую сессия уже держит, заново не ставим
+        if remaining > 0 and session.cooldown_until < time.monotonic() + remaining - 1:
+            pool.pause(session, remaining)
+
+def _trip_breaker(session: InstaSession, error: Exception) -> None:
+    """
+    Instagram ограничил сессию: пауза вместо повторных запросов (с сохранением в базе).
+    """
+    logging.warning(f"Instagram ограничил сессию {session.username}: {error}")
+    pause = pool.trip(session)
+    save_limiter_state(_breaker_key(session), None, session.breaker_backoff, time.time() + pause)
+
+def _with_session(operation, session_username: str = None, pass_session: bool = False):
+    """
+    Выполняет operation(loader) на арендованной сессии из пула
+    (operation(loader, session) при pass_session=True).
+    При истёкшей авторизации переавторизуется только эта сессия (один раз),
+    после чего запрос повторяется один раз на свежеарендованной сессии.
+    При ограничении скорости (429, 400 «please wait» / checkpoint) срабатывает предохранитель
+    сессии, а ошибка передаётся вызывающему без повторов.
+    Свободную сессию ждёт не дольше SESSION_LEASE_TIMEOUT (NoSessionAvailableError).
+    session_username — арендовать конкретную сессию.
+    """
+    if time.monotonic() - _breakers_synced_at >= BREAKER_SYNC_INTERVAL:
+        _restore_breakers()
+    for attempt in range(2):
+        with pool.lease(timeout=SESSION_LEASE_TIMEOUT, username=session_username) as session:
+            generation = session.generation
+            try:
+                result = operation(session.loader, session) if pass_session else operation(session.loader)
+            except instaloader.exceptions.LoginRequiredException:
+                if attempt:
+                    raise
+                logging.warning(f"Сессия Instaloader {session.username} истекла. Повторная авторизация...")
+                pool.reauthenticate(session, generation)
+                continue
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    _trip_breaker(session, e)
+                raise
+
+            graphql_limiter.success()
+            if session.breaker_backoff is not None:
+                pool.record_success(session)
+                save_limiter_state(_breaker_key(session), None, None, 0)
+            return result
+
+def _load_profile(loader, username: str):
+    """
+    instaloader.Profile.from_username с замером времени запроса.
+    """
+    with instagram_profile_seconds.time():
+        return instaloader.Profile.from_username(loader.context, username)
 
-def save_file_from_url(url: str, filename: str, proxies: dict = None) -> str:
+@contextmanager
+def _feed_page_timer():
     """
-    Скачивает файл по URL и сохраняет его во временную папку.
-    Возвращает путь к файлу или None при ошибке.
+    Если внутри блока with поток обратился к Instagram (страница ленты), записывает
+    в instagram_feed_page_seconds время от начала последнего запроса — без ожидания лимитеров.
     """
+    count, _ = last_query()
     try:
-        filepath = os.path.join(TEMP_FOLDER, filename)
-        response = requests.get(url, stream=True, proxies=proxies)
-        response.raise_for_status()
+        yield
+    finally:
+        new_count, started = last_query()
+        if new_count != count:
+            instagram_feed_page_seconds.observe(time.perf_counter() - started)
 
-        with open(filepath, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
+def _get_posts(profile):
+    """
+    profile.get_posts() с замером времени загрузки каждой страницы ленты
+    (первая страница запрашивается сразу, следующие — по мере чтения).
+    """
+    with _feed_page_timer():
+        posts = iter(profile.get_posts())
+    while True:
+        with _feed_page_timer():
+            post = next(posts, None)
+        if post is None:
+            return
+        yield post
 
-        return filepath
+def _viewable_story(profile):
+    """
+    profile.has_viewable_story; None, если Instagram не ответил (кроме ограничения скорости).
+    Для профилей, на которые сессия не подписана, это отдельный запрос — вызывать в аренде сессии.
+    """
+    try:
+        return profile.has_viewable_story
     except Exception as e:
-        logging.error(f"Ошибка при скачивании файла {url}: {e}")
+        if is_rate_limit_error(e):
+            raise
+        logging.warning(f"Не удалось узнать, есть ли истории у {profile.username}: {e}")
         return None
 
-def delete_temp_file(filepath: str) -> None:
+def _remember_profile(username: str, profile, story_flag: bool = False) -> dict:
+    """
+    Сохраняет в справочник данные уже загруженного instaloader.Profile и возвращает их.
+    story_flag=True — заодно сохраняет has_viewable_story (может стоить запроса к Instagram);
+    иначе в справочнике остаётся прежнее значение.
+    """
+    status = PROFILE_PRIVATE if profile.is_private and not profile.followed_by_viewer else PROFILE_OK
+    has_viewable_story = None
+    if status != PROFILE_OK:
+        has_viewable_story = False
+    elif story_flag:
+        has_viewable_story = _viewable_story(profile)
+    if has_viewable_story is not None:
+        _story_flag_checked_at[username] = time.monotonic()
+    upsert_profile(
+        username, status, userid=profile.userid, mediacount=profile.mediacount,
+        has_viewable_story=has_viewable_story
+    )
+    return {
+        "username": username,
+        "userid": profile.userid,
+        "mediacount": profile.mediacount,
+        "has_viewable_story": has_viewable_story,
+        "status": status,
+        "refreshed_at": time.time()
+    }
+
+def _has_no_story(info: dict) -> bool:
+    """
+    True, если этот процесс не дольше PROFILE_TTL назад узнал, что историй у профиля нет.
     """
-    Удаляет временный файл, если он существует.
+    checked_at = _story_flag_checked_at.get(info["username"])
+    return (
+        info.get("has_viewable_story") is False
+        and checked_at is not None and time.monotonic() - checked_at < PROFILE_TTL
+    )
+
+def _is_fresh(info: dict) -> bool:
+    ttl = PROFILE_TTL if info["status"] == PROFILE_OK else PROFILE_NEGATIVE_TTL
+    return time.time() - info["refreshed_at"] < ttl
+
+def _is_known_unavailable(username: str) -> bool:
+    """
+    True, если профиль в пределах TTL известен как закрытый или несуществующий.
+    Такие профили не запрашиваем каждый цикл.
+    """
+    info = get_profile(username)
+    return info is not None and info["status"] != PROFILE_OK and _is_fresh(info)
+
+def get_profile_info(username: str, refresh: bool = False) -> dict:
     """
+    Возвращает данные профиля (userid, mediacount, status, ...) из справочника profiles.
+    Если записи нет или она старше PROFILE_TTL (PROFILE_NEGATIVE_TTL для закрытых
+    и несуществующих профилей), профиль запрашивается в Instagram и сохраняется.
+    """
+    info = None if refresh else get_profile(username)
+    if info is not None and _is_fresh(info):
+        cache_lookup("profile", True)
+        return info
+    cache_lookup("profile", False)
+
     try:
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            logging.info(f"Удалён временный файл: {filepath}")
+        # Признак историй запрашивается в той же аренде сессии, что и профиль
+        return _with_session(
+            lambda loader: _remember_profile(username, _load_profile(loader, username), story_flag=True)
+        )
+    except instaloader.exceptions.ProfileNotExistsException:
+        upsert_profile(username, PROFILE_NOT_EXISTS)
+        return {
+            "username": username, "userid": None, "mediacount": 0, "has_viewable_story": False,
+            "status": PROFILE_NOT_EXISTS
+        }
+
+def save_file_from_url(url: str, media_id, node_index: int, extension: str, proxies: dict = None) -> str:
+    """
+    Возвращает путь к медиа в медиакэше, скачивая его по URL, если его там ещё нет.
+    Путь закреплён за вызывающим (отпустить через media_cache.release); None при ошибке.
+    """
+    return media_cache.fetch(url, media_id, node_index, extension, proxies)
+
+def save_files_from_urls(jobs: list, proxies: dict = None) -> list:
+    """
+    Параллельно получает несколько медиа через медиакэш: jobs = [(url, media_id, node_index, extension), ...].
+    Возвращает список закреплённых путей (None для файлов, которые скачать не удалось) в том же порядке.
+    """
+    return media_cache.fetch_many(jobs, proxies)
+
+def _media_entry(
+    post_id: str,
+    node_index: int,
+    media_type: str,
+    file_path: str = None,
+    file_id: str = None,
+    source_url: str = None,
+    size: int = None
+) -> dict:
+    """
+    Внутренняя функция: описание одного медиа публикации.
+    Если медиа уже загружалось в Telegram, вместо file_path указывается file_id.
+    В режиме MEDIA_STREAMING вместо file_path указывается source_url (адрес на CDN)
+    и, если он уже известен, size (размер файла в байтах).
+    """
+    entry = {
+        "media_id": post_id,
+        "node_index": node_index,
+        "media_type": media_type
+    }
+    if file_id:
+        entry["file_id"] = file_id
+    elif source_url:
+        entry["source_url"] = source_url
+        if size is not None:
+            entry["size"] = size
+    else:
+        entry["file_path"] = file_path
+    return entry
+
+def _media_node(item) -> dict:
+    """
+    Внутренняя функция: узел медиа instaloader.Post / StoryItem с вариантами разрешения —
+    структура iPhone API, если она уже пришла вместе с лентой, иначе узел graphql.
+    Дополнительных запросов к Instagram не делает (в отличие от item.url / item.video_url).
+    """
+    return item._iphone_struct_ or item._node
+
+def _sidecar_children(post) -> list:
+    """
+    Внутренняя функция: узлы элементов карусели с вариантами разрешения.
+    """
+    struct = post._iphone_struct_
+    if struct and struct.get("carousel_media"):
+        return struct["carousel_media"]
+    edges = post._field("edge_sidecar_to_children", "edges")
+    if any(edge["node"]["is_video"] and "video_url" not in edge["node"] for edge in edges):
+        # video_url элементов карусели есть только в полных метаданных публикации
+        edges = post._full_metadata["edge_sidecar_to_children"]["edges"]
+    return [edge["node"] for edge in edges]
+
+def _resolve_media(post) -> list:
+    """
+    Внутренняя функция: узлы медиа публикации с вариантами разрешения — элементы карусели
+    или единственный узел. Недостающее (полные метаданные карусели, адрес видео) запрашивается
+    у Instagram через контекст post, поэтому вызывается внутри _with_session. Результат запоминается в post.
+    """
+    if post.typename == "GraphSidecar":
+        nodes = _sidecar_children(post)
+    else:
+        node = _media_node(post)
+        if post.typename == "GraphVideo" and not video_variants(node):
+            # В узле без вариантов (анонимный запрос) адрес видео есть только у самого Post
+            node = {**node, "video_url": post.video_url}
+        nodes = [node]
+    post._media_nodes_ = nodes
+    return nodes
+
+def _prefetch_media(post) -> None:
+    """
+    Внутренняя функция: в аренде сессии, в которой получен пост, заранее собирает его узлы медиа,
+    если медиа ещё не загружалось в Telegram. Ограничение скорости и истёкшая авторизация
+    передаются _with_session; при прочих ошибках узлы соберутся при скачивании (_media_nodes).
+    """
+    if get_cached_files(str(post.mediaid)):
+        return
+    try:
+        _resolve_media(post)
+    except instaloader.exceptions.LoginRequiredException:
+        raise
     except Exception as e:
-        logging.error(f"Ошибка при удалении файла {filepath}: {e}")
+        if is_rate_limit_error(e):
+            raise
+        logging.warning(f"Не удалось получить медиа публикации {post.mediaid}: {e}")
+
+def _media_nodes(post) -> list:
+    """
+    Внутренняя функция: узлы медиа публикации (см. _resolve_media). Если они не собраны
+    при получении поста, собираются сейчас — в аренде свободной сессии пула.
+    """
+    nodes = getattr(post, "_media_nodes_", None)
+    if nodes is not None:
+        return nodes
+
+    def resolve(loader):
+        # Запросы поста идут через арендованную сессию, а не через ту, что его получила
+        post._context = loader.context
+        return _resolve_media(post)
+
+    return _with_session(resolve)
 
-def _download_sidecar_nodes(post, username: str, post_id: str) -> list:
+def _pick_media(node: dict, is_video: bool) -> tuple:
+    """
+    Внутренняя функция: выбирает вариант медиа (см. media_variants).
+    Возвращает (media_type, url, размер или None); url = None, если подходящего варианта нет
+    (например, видео больше предела загрузки Telegram во всех разрешениях).
+    """
+    if is_video:
+        url, size = pick_video(node)
+        return "video", url, size
+    return "photo", pick_image(node), None
+
+def _download_sidecar_nodes(post, username: str, post_id: str, cached: dict = None) -> list:
     """
     Внутренняя функция: скачивает медиа из карусели (sidecar).
+    Элементы, для которых в cached ({node_index: (file_id, media_type)}) уже есть
+    file_id Telegram, не скачиваются.
     Возвращает список словарей формата:
     [
       {
-        "file_path": "/path/to/file",
+        "media_id": "mediaid",
+        "node_index": int,
+        "file_path": "/path/to/file",  # или "file_id": "..."
         "media_type": "photo" / "video"
       },
       ...
     ]
     """
-    media_list = []
-    nodes = post.get_sidecar_nodes()
-    for node_index, node in enumerate(nodes, start=1):
-        if "display_url" in node:
-            file_url = node["display_url"]
-            is_video = node.get("is_video", False)
+    cached = cached or {}
+    # {node_index: запись} — порядок элементов карусели сохраняется
+    entries = {}
+    downloads = []  # [(node_index, media_type, url, size)]
+    for node_index, node in enumerate(_media_nodes(post), start=1):
+        if node_index in cached:
+            file_id, media_type = cached[node_index]
+            entries[node_index] = _media_entry(post_id, node_index, media_type, file_id=file_id)
+            continue
+        media_type, url, size = _pick_media(node, is_video_node(node))
+        if url:
+            downloads.append((node_index, media_type, url, size))
+
+    if MEDIA_STREAMING:
+        # Медиа пойдёт с CDN прямо в Telegram при отправке
+        for node_index, media_type, url, size in downloads:
+            entries[node_index] = _media_entry(post_id, node_index, media_type, source_url=url, size=size)
+    else:
+        # Все элементы карусели скачиваются параллельно
+        filepaths = save_files_from_urls([
+            (url, post_id, node_index, "mp4" if media_type == "video" else "jpg")
+            for node_index, media_type, url, _ in downloads
+        ])
+        for (node_index, media_type, _, _), filepath in zip(downloads, filepaths):
+            if filepath:
+                entries[node_index] = _media_entry(post_id, node_index, media_type, file_path=filepath)
+    return [entries[node_index] for node_index in sorted(entries)]
+
+def _build_post_data(post, username: str) -> dict:
+    """
+    Внутренняя функция: скачивает медиа публикации и собирает словарь формата:
+    {
+      "id": "mediaid",
+      "url": "https://www.instagram.com/p/<shortcode>/",
+      "media": [{"media_id": ..., "node_index": ..., "file_path" / "file_id": ..., "media_type": ...}, ...],
+      "likes": int,
+      "comments": int,
+      "caption": str
+    }
+    Медиа, уже загруженное в Telegram (таблица telegram_files), повторно не скачивается.
+    """
+    post_id = str(post.mediaid)
+    post_data = {
+        "id": post_id,
+        "url": f"https://www.instagram.com/p/{post.shortcode}/",
+        "media": [],
+        "likes": post.likes,
+        "comments": post.comments,  # число комментариев
+        "caption": post.caption or ""
+    }
+    cached = get_cached_files(post_id)
+
+    # Если карусель
+    if post.typename == "GraphSidecar":
+        post_data["media"] = _download_sidecar_nodes(post, username, post_id, cached)
+    elif 0 in cached:
+        file_id, media_type = cached[0]
+        post_data["media"].append(_media_entry(post_id, 0, media_type, file_id=file_id))
+    else:
+        # Одиночное фото/видео (включая Reels, т.к. GraphVideo)
+        is_video = (post.typename == "GraphVideo")
+        media_type, url, size = _pick_media(_media_nodes(post)[0], is_video)
+        if url is None:
+            # Без медиа подписчики получат только ссылку на публикацию
+            logging.info(f"Медиа публикации {post_id} пропущено: нет подходящего варианта.")
+        elif MEDIA_STREAMING:
+            post_data["media"].append(_media_entry(post_id, 0, media_type, source_url=url, size=size))
+        else:
             file_extension = "mp4" if is_video else "jpg"
-            filename = f"{username}_{post_id}_{node_index}.{file_extension}"
-            filepath = save_file_from_url(file_url, filename)
-            media_type = "video" if is_video else "photo"
+            filepath = save_file_from_url(url, post_id, 0, file_extension)
             if filepath:
-                media_list.append({
-                    "file_path": filepath,
-                    "media_type": media_type
-                })
-    return media_list
+                post_data["media"].append(_media_entry(post_id, 0, media_type, file_path=filepath))
+    return post_data
+
+def download_post(post, username: str) -> dict:
+    """
+    Скачивает медиа уже полученной публикации (instaloader.Post).
+    Формат результата — как у _build_post_data.
+    """
+    return _build_post_data(post, username)
+
+def download_story_items(items: list, username: str) -> list:
+    """
+    Параллельно скачивает элементы истории (instaloader.StoryItem) в медиакэш.
+    Возвращает список словарей формата:
+    [
+      {
+        "id": int,
+        "url": "/path/to/story/file" (None, если скачать не удалось),
+        "file_id": "..." (если элемент уже загружался в Telegram; тогда "url" = None),
+        "source_url": "https://..." (в режиме MEDIA_STREAMING вместо "url"),
+        "size": int (размер видео в байтах, если уже известен),
+        "type": "photo"/"video",
+        "date": datetime
+      },
+      ...
+    ]
+    """
+    stories = []
+    downloads = []  # [(story, url, size)]
+    for item in items:
+        story = {
+            "id": item.mediaid,
+            "url": None,
+            "type": "video" if item.is_video else "photo",
+            "date": item.date_local
+        }
+        cached = get_cached_files(item.mediaid)
+        if 0 in cached:
+            story["file_id"], story["type"] = cached[0]
+        else:
+            # Элемент без подходящего варианта (видео больше предела Telegram) не отправляется
+            _, url, size = _pick_media(_media_node(item), item.is_video)
+            if url:
+                downloads.append((story, url, size))
+        stories.append(story)
+
+    if MEDIA_STREAMING:
+        for story, url, size in downloads:
+            story["source_url"] = url
+            if size is not None:
+                story["size"] = size
+    elif downloads:
+        filepaths = save_files_from_urls([
+            (url, story["id"], 0, "mp4" if story["type"] == "video" else "jpg") for story, url, _ in downloads
+        ])
+        for (story, _, _), filepath in zip(downloads, filepaths):
+            story["url"] = filepath
+    return stories
+
+def download_story_item(item, username: str) -> dict:
+    """
+    Скачивает один элемент истории (instaloader.StoryItem) в медиакэш.
+    Формат результата — как у элемента download_story_items.
+    """
+    return download_story_items([item], username)[0]
+
+def fetch_story_items(username: str) -> list:
+    """
+    Возвращает список элементов историй (instaloader.StoryItem) без скачивания медиа.
+    Если нет сторис, вернёт пустой список; если недавно выяснилось, что историй у профиля нет
+    (has_viewable_story в справочнике), Instagram не запрашивается.
+    Если Instagram сейчас недоступен, поднимает ошибку из INSTAGRAM_BUSY_ERRORS.
+    """
+    def fetch(loader):
+        # Истории запрашиваются сразу по userid из справочника, без поиска профиля по нику
+        items = []
+        for story in loader.get_stories(userids=[info["userid"]]):
+            items.extend(story.get_items())
+        return items
+
+    try:
+        info = get_profile_info(username)
+        if info["status"] != PROFILE_OK:
+            logging.info(f"Профиль {username} недоступен ({info['status']}).")
+            return []
+        if _has_no_story(info):
+            logging.info(f"У пользователя {username} нет доступных историй (по данным профиля).")
+            return []
+
+        items = _with_session(fetch)
+        update_profile_story_flag(username, bool(items))
+        _story_flag_checked_at[username] = time.monotonic()
+        if not items:
+            logging.info(f"У пользователя {username} нет доступных историй.")
+        return items
+    except INSTAGRAM_BUSY_ERRORS:
+        raise
+    except instaloader.exceptions.LoginRequiredException:
+        logging.error(f"Не удалось переавторизоваться для историй пользователя {username}.")
+        return []
+    except Exception as e:
+        logging.error(f"Ошибка при получении историй пользователя {username}: {e}")
+        return []
 
 def get_stories(username: str):
     """
@@ -156,56 +677,208 @@ def get_stories(username: str):
         },
         ...
       ]
-    Файлы сохраняются в temp/<username>/.
+    Файлы сохраняются в медиакэш (пути закреплены — отпустить через media_cache.release).
     Если нет сторис, вернёт пустой список.
     """
-    try:
-        profile = instaloader.Profile.from_username(loader.context, username)
-        if not profile.has_viewable_story:
-            logging.info(f"У пользователя {username} нет доступных историй.")
-            return []
-
-        temp_dir = os.path.join(TEMP_FOLDER, username)
-        os.makedirs(temp_dir, exist_ok=True)
-
-        stories = []
-        for story in loader.get_stories(userids=[profile.userid]):
-            for item in story.get_items():
-                file_path = loader.download_storyitem(item, target=temp_dir)
-                stories.append({
-                    "id": item.mediaid,
-                    "url": file_path,
-                    "type": "video" if item.is_video else "photo",
-                    "date": item.date_local
-                })
-        return stories
-
-    except instaloader.exceptions.LoginRequiredException:
-        logging.warning("Сессия Instaloader истекла. Повторная авторизация...")
-        # Переавторизация (загружаем/логиним) и пробуем снова
-        login(INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD, use_session=True)
-        return get_stories(username)
-    except Exception as e:
-        logging.error(f"Ошибка при получении историй пользователя {username}: {e}")
-        return []
+    return download_story_items(fetch_story_items(username), username)
 
 def get_new_posts_count(username: str) -> int:
     """
     Возвращает общее количество публикаций (int) в ленте пользователя username.
     Включает фото, видео, reels (если они в основной ленте).
+    Если Instagram сейчас недоступен, поднимает ошибку из INSTAGRAM_BUSY_ERRORS.
     """
     try:
-        profile = instaloader.Profile.from_username(loader.context, username)
-        if not profile:
+        info = get_profile_info(username)
+        if info["status"] == PROFILE_NOT_EXISTS:
+            logging.error(f"Профиль {username} не существует.")
             return 0
-        return profile.mediacount
-    except instaloader.exceptions.ProfileNotExistsException:
-        logging.error(f"Профиль {username} не существует.")
-        return 0
+        if info["status"] == PROFILE_PRIVATE:
+            logging.info(f"Профиль {username} закрыт.")
+            return 0
+        return info["mediacount"]
+    except INSTAGRAM_BUSY_ERRORS:
+        raise
     except Exception as e:
         logging.error(f"Ошибка при получении количества публикаций {username}: {e}")
         return 0
 
+def _get_feed_cursor(username: str) -> dict:
+    """
+    Возвращает курсор ленты пользователя из кэша (создаёт новый, если нет или истёк TTL).
+    """
+    now = time.monotonic()
+    with _feed_cursors_lock:
+        for expired in [name for name, cursor in _feed_cursors.items() if cursor["expires_at"] <= now]:
+            del _feed_cursors[expired]
+
+        cursor = _feed_cursors.get(username)
+        if cursor is None:
+            cursor = {
+                "posts": [],          # уже загруженные посты (instaloader.Post)
+                "iterator": None,     # _get_posts: NodeIterator внутри хранит курсор следующей страницы
+                "session": None,      # сессия, к которой привязан курсор
+                "exhausted": False,   # лента прочитана до конца
+                "expires_at": now + FEED_CURSOR_TTL,
+                "lock": threading.Lock()
+            }
+            _feed_cursors[username] = cursor
+        return cursor
+
+def _drop_feed_cursor(username: str) -> None:
+    with _feed_cursors_lock:
+        _feed_cursors.pop(username, None)
+
+def _get_post_at(username: str, index: int):
+    """
+    Возвращает пост (instaloader.Post) по 0-based индексу в ленте или None.
+    Читает ровно столько страниц ленты, сколько нужно для index; уже прочитанные
+    страницы и курсор следующей берутся из кэша (FEED_CURSOR_TTL).
+    """
+    if index < 0:
+        return None
+    if _is_known_unavailable(username):
+        return None
+
+    cursor = _get_feed_cursor(username)
+    with cursor["lock"]:
+        if index < len(cursor["posts"]):
+            cache_lookup("feed_cursor", True)
+            return cursor["posts"][index]
+        if cursor["exhausted"]:
+            return None
+        cache_lookup("feed_cursor", False)
+
+        def advance(loader, session):
+            if cursor["iterator"] is None:
+                profile = _load_profile(loader, username)
+                if _remember_profile(username, profile)["status"] != PROFILE_OK:
+                    cursor["exhausted"] = True
+                    return None
+                cursor["iterator"] = _get_posts(profile)
+                # Имя сессии в пуле (в нижнем регистре), а не логин из контекста Instaloader
+                cursor["session"] = session.username
+            for post in cursor["iterator"]:
+                cursor["posts"].append(post)
+                if index < len(cursor["posts"]):
+                    _prefetch_media(post)
+                    return post
+            cursor["exhausted"] = True
+            return None
+
+        try:
+            # Курсор привязан к сессии, в которой он был получен
+            return _with_session(advance, session_username=cursor["session"], pass_session=True)
+        except Exception:
+            _drop_feed_cursor(username)
+            raise
+
+def _filter_new_posts(posts, last_sent_post_id: str = None, time_filter: bool = True):
+    """
+    Внутренний генератор: отдаёт посты новее отметки уровня last_sent_post_id.
+    Лента идёт от новых к старым, поэтому чтение прекращается на первом посте
+    не новее отметки — сколько бы времени ни прошло с прошлой проверки.
+    Закреплённые посты идут вне порядка и на остановку не влияют.
+    Если отметки ещё нет (новая подписка) и time_filter=True,
+    отдаются только посты за последние FEED_BOOTSTRAP_HOURS часов.
+    """
+    high_water_mark = None if last_sent_post_id is None else int(last_sent_post_id)
+    since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(hours=FEED_BOOTSTRAP_HOURS)
+    for post in posts:
+        if high_water_mark is None:
+            # Сравниваем в UTC: date_utc — наивное время в UTC
+            is_new = not time_filter or post.date_utc >= since
+        else:
+            is_new = post.mediaid > high_water_mark
+        if post.is_pinned:
+            if is_new:
+                yield post
+            continue
+        if not is_new:
+            break
+        yield post
+
+def _newest_timeline_id(profile):
+    """
+    Внутренняя функция: mediaid самого нового поста из ответа профиля (первая страница ленты,
+    если Instagram прислал её вместе с профилем) или None. Дополнительных запросов не делает.
+    """
+    edges = (profile._node.get("edge_owner_to_timeline_media") or {}).get("edges") or []
+    post_ids = []
+    for edge in edges:
+        try:
+            post_ids.append(int(edge["node"]["id"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return max(post_ids, default=None)
+
+def fetch_new_posts(
+    username: str,
+    last_sent_post_id: str = None,
+    last_seen_mediacount: int = None,
+    time_filter: bool = True
+):
+    """
+    Инкрементальная проверка ленты. Возвращает (список instaloader.Post, mediacount профиля,
+    mediaid самого нового поста ленты) без скачивания медиа; mediacount = None, если профиль
+    получить не удалось. Самый новый mediaid известен и тогда, когда новых постов нет —
+    по нему вызывающий ставит отметку уровня.
+    Сначала запрашиваются только метаданные профиля: если число публикаций совпадает
+    с last_seen_mediacount и самый новый пост из ответа профиля не новее отметки уровня
+    last_sent_post_id, лента не читается вовсе. Иначе лента читается постранично
+    до отметки уровня. Медиа скачивается отдельно через download_post().
+    Если Instagram сейчас недоступен, поднимает ошибку из INSTAGRAM_BUSY_ERRORS.
+    """
+    def fetch(loader):
+        profile = _load_profile(loader, username)
+        if _remember_profile(username, profile)["status"] != PROFILE_OK:
+            return [], None, None
+        newest_post_id = _newest_timeline_id(profile)
+        # Одного числа публикаций мало: удалённый и добавленный пост его не меняют
+        if (
+            last_sent_post_id is not None
+            and last_seen_mediacount is not None
+            and profile.mediacount == last_seen_mediacount
+            and newest_post_id is not None
+            and newest_post_id <= int(last_sent_post_id)
+        ):
+            logging.info(f"В ленте {username} нет изменений.")
+            return [], profile.mediacount, newest_post_id
+
+        read_ids = []
+
+        def tracked(posts):
+            # Запоминаем mediaid всех прочитанных постов, в том числе не прошедших фильтр
+            for post in posts:
+                read_ids.append(post.mediaid)
+                yield post
+
+        posts = list(_filter_new_posts(tracked(_get_posts(profile)), last_sent_post_id, time_filter))
+        # Медиа скачивается позже, вне аренды сессии, — недостающие данные запрашиваются сейчас
+        for post in posts:
+            _prefetch_media(post)
+        if newest_post_id is not None:
+            read_ids.append(newest_post_id)
+        return posts, profile.mediacount, max(read_ids, default=None)
+
+    try:
+        # Несуществующие и закрытые профили не запрашиваем, пока не истёк TTL
+        if _is_known_unavailable(username):
+            return [], None, None
+        return _with_session(fetch)
+    except INSTAGRAM_BUSY_ERRORS:
+        raise
+    except instaloader.exceptions.ProfileNotExistsException:
+        logging.error(f"Профиль {username} не существует.")
+        upsert_profile(username, PROFILE_NOT_EXISTS)
+        return [], None, None
+    except instaloader.exceptions.LoginRequiredException:
+        logging.error(f"Не удалось переавторизоваться для публикаций {username}.")
+        return [], None, None
+    except Exception as e:
+        logging.error(f"Ошибка при получении публикаций {username}: {e}")
+        return [], None, None
+
 def get_new_posts(
     username: str,
     last_sent_post_id: str = None,
@@ -221,95 +894,33 @@ def get_new_posts(
     Параметры:
       - last_sent_post_id: Строковое ID (mediaid) последнего отправленного поста,
         чтобы фильтровать только более "свежие" посты.
-      - time_filter: Если True, останавливаемся на постах старше 24 часов (экономия).
+      - time_filter: Если True и last_sent_post_id не задан, берём только посты
+        за последние FEED_BOOTSTRAP_HOURS часов.
       - index: Если задан (int), вернём только конкретный пост из ленты (0-based индекс).
                Если индекс некорректный, вернётся None.
+    Если Instagram сейчас недоступен, поднимает ошибку из INSTAGRAM_BUSY_ERRORS.
     """
     try:
-        profile = instaloader.Profile.from_username(loader.context, username)
-        if not profile:
-            # Если профиль не найден
-            return [] if index is None else None
-
-        # Загружаем список всех постов (ленты)
-        posts = list(profile.get_posts())
-        if not posts:
-            return [] if index is None else None
-
-        # Если запрошен конкретный индекс
+        # Если запрошен конкретный индекс — читаем ленту только до него
         if index is not None:
-            if index < 0 or index >= len(posts):
+            post = _get_post_at(username, index)
+            if post is None:
                 return None
-            post = posts[index]
-            post_data = {
-                "id": str(post.mediaid),
-                "media": [],
-                "likes": post.likes,
-                "comments": post.comments,  # число комментариев
-                "caption": post.caption or ""
-            }
+            return _build_post_data(post, username)
 
-            # Если карусель
-            if post.typename == "GraphSidecar":
-                post_data["media"] = _download_sidecar_nodes(post, username, str(post.mediaid))
-            else:
-                # Одиночное фото/видео (включая Reels, т.к. GraphVideo)
-                is_video = (post.typename == "GraphVideo")
-                file_extension = "mp4" if is_video else "jpg"
-                filename = f"{username}_{post.mediaid}.{file_extension}"
-                filepath = save_file_from_url(post.url, filename)
-                if filepath:
-                    post_data["media"].append({
-                        "file_path": filepath,
-                        "media_type": "video" if is_video else "photo"
-                    })
-            return post_data
-
-        # Иначе — ищем все «новые» посты (за 24 часа), если time_filter=True
-        new_posts = []
-        now = datetime.now()
-        for post in posts:
-            post_id = str(post.mediaid)
-            post_date = post.date_utc
-
-            # Прекращаем цикл, если пост старше 24 часов (time_filter=True)
-            if time_filter and post_date < now - timedelta(days=1):
-                break
-
-            # Проверяем, не отправляли ли мы уже этот пост (last_sent_post_id)
-            if last_sent_post_id is None or post_id > last_sent_post_id:
-                post_data = {
-                    "id": post_id,
-                    "media": [],
-                    "likes": post.likes,
-                    "comments": post.comments,
-                    "caption": post.caption or ""
-                }
-
-                if post.typename == "GraphSidecar":
-                    post_data["media"] = _download_sidecar_nodes(post, username, post_id)
-                else:
-                    is_video = (post.typename == "GraphVideo")
-                    file_extension = "mp4" if is_video else "jpg"
-                    filename = f"{username}_{post_id}.{file_extension}"
-                    filepath = save_file_from_url(post.url, filename)
-                    if filepath:
-                        post_data["media"].append({
-                            "file_path": filepath,
-                            "media_type": "video" if is_video else "photo"
-                        })
-
-                new_posts.append(post_data)
-
-        return new_posts
+        # Иначе — все посты новее last_sent_post_id
+        posts, _, _ = fetch_new_posts(username, last_sent_post_id, time_filter=time_filter)
+        return [_build_post_data(post, username) for post in posts]
 
+    except INSTAGRAM_BUSY_ERRORS:
+        raise
     except instaloader.exceptions.ProfileNotExistsException:
         logging.error(f"Профиль {username} не существует.")
+        upsert_profile(username, PROFILE_NOT_EXISTS)
         return [] if index is None else None
     except instaloader.exceptions.LoginRequiredException:
-        logging.warning("Сессия Instaloader истекла. Переавторизация...")
-        login(INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD, use_session=True)
-        return get_new_posts(username, last_sent_post_id, time_filter, index)
+        logging.error(f"Не удалось переавторизоваться для публикаций {username}.")
+        return [] if index is None else None
     except Exception as e:
         logging.error(f"Ошибка при получении публикаций {username}: {e}")
         return [] if index is None else None
@@ -1,17 +1,32 @@
+import re
+import signal
 import asyncio
 import logging
-import os
-import shutil
+import multiprocessing
 
+from aiohttp import web
 from aiogram import Bot, Dispatcher, Router
-from aiogram.types import Message, CallbackQuery, FSInputFile
+from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
 from aiogram.utils.keyboard import InlineKeyboardMarkup, InlineKeyboardButton
-
-from database import initialize_database, add_subscription, remove_subscription, get_subscriptions
-from instagram_parser import login, get_new_posts, get_new_posts_count, get_stories, delete_temp_file
-from scheduler import start_scheduler
-from config.config import TELEGRAM_TOKEN, INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+from database import initialize_database
+from async_db import add_subscription, remove_subscription, get_subscriptions, purge_user_states
+from instagram_parser import login, split_session_budget, INSTAGRAM_BUSY_ERRORS
+from async_instagram import get_post, get_post_count, get_stories, release_files, prefetch_posts, cancel_prefetch
+from scheduler import run_worker
+from outbox import TelegramRateMiddleware, run_dispatcher
+from metrics import start_metrics_server
+from media_cache import collect_garbage
+from telegram_files import send_media_batch, story_media_items
+from state_store import ExpiringStore, SharedStore, LanguageStore
+from config.config import (
+    TELEGRAM_TOKEN, INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD,
+    USER_ACTION_TTL, LAST_MESSAGE_TTL, USER_STATE_MAX_SIZE, LANG_CACHE_SIZE, LANG_FLUSH_INTERVAL,
+    EMBEDDED_WORKER, METRICS_HOST, METRICS_PORT,
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_WORKERS, WEBHOOK_MAX_CONNECTIONS
+)
 
 
 ###############################
@@ -25,19 +40,51 @@ logging.basicConfig(
 ###############################
 # ИНИЦИАЛИЗАЦИЯ БОТА
 ###############################
+# Апдейты принимают несколько процессов (вебхук) — лимит Telegram и состояние диалога общие, в базе
+SHARED_STATE = bool(WEBHOOK_URL) and WEBHOOK_WORKERS > 1
+
 bot = Bot(token=TELEGRAM_TOKEN)
+# Все запросы к Bot API проходят через лимиты Telegram (глобальный и на чат)
+bot.session.middleware(TelegramRateMiddleware(shared=SHARED_STATE))
 dp = Dispatcher()
 router = Router()
 
 ###############################
-# ГЛОБАЛЬНЫЕ СЛОВАРИ
+# СОСТОЯНИЕ ПОЛЬЗОВАТЕЛЕЙ
 ###############################
-# Храним текущее действие пользователя
-user_actions = {}  # {user_id: {"action": "..."}}
-# Храним последнее сообщение бота (чтобы удалять старые)
-last_bot_message = {}  # {user_id: message_id}
-# Храним выбранный язык пользователя
-user_lang = {}  # {user_id: "ru" | "en"}
+if SHARED_STATE:
+    user_actions = SharedStore("user_actions", USER_ACTION_TTL, USER_STATE_MAX_SIZE)
+    last_bot_message = SharedStore("last_bot_message", LAST_MESSAGE_TTL, USER_STATE_MAX_SIZE)
+else:
+    # Храним текущее действие пользователя (забывается через USER_ACTION_TTL)
+    user_actions = ExpiringStore(USER_ACTION_TTL, USER_STATE_MAX_SIZE)  # {user_id: {"action": "..."}}
+    # Храним последнее сообщение бота (чтобы удалять старые; Telegram не даёт удалять сообщения старше 48 ч)
+    last_bot_message = ExpiringStore(LAST_MESSAGE_TTL, USER_STATE_MAX_SIZE)  # {user_id: message_id}
+# Храним выбранный язык пользователя (кэш + таблица user_settings)
+user_lang = LanguageStore(LANG_CACHE_SIZE, shared=SHARED_STATE)  # {user_id: "ru" | "en"}
+
+
+@dp.update.outer_middleware()
+async def load_user_state(handler, event, data):
+    """
+    Подгружает язык пользователя из базы до вызова хендлеров.
+    При общем состоянии (SHARED_STATE) подгружает и состояние диалога,
+    а после обработки апдейта сразу записывает изменения для других процессов.
+    """
+    user = data.get("event_from_user")
+    if user is None:
+        return await handler(event, data)
+    await user_lang.load(user.id)
+    if not SHARED_STATE:
+        return await handler(event, data)
+    await user_actions.load(user.id)
+    await last_bot_message.load(user.id)
+    try:
+        return await handler(event, data)
+    finally:
+        await user_actions.flush()
+        await last_bot_message.flush()
+        await user_lang.flush()
 
 ###############################
 # ЛОКАЛИЗАЦИЯ
@@ -79,6 +126,7 @@ LOCALES = {
         "pick_command": "Пожалуйста, выберите команду из меню:",
         "bot_owner_text": "Я не могу следить за своим создателем.",
         "loading": "Загрузка… Пожалуйста, подождите...",
+        "instagram_busy": "⏳ Instagram временно ограничил запросы. Попробуйте через несколько минут.",
 
         "change_language" : "🌍 Поменять язык"
     },
@@ -118,6 +166,7 @@ LOCALES = {
         "pick_command": "Please choose a command from the menu:",
         "bot_owner_text": "I cannot track my creator.",
         "loading": "Loading… Please wait...",
+        "instagram_busy": "⏳ Instagram is temporarily limiting requests. Try again in a few minutes.",
 
         "change_language" : "🌎 Change language"
     }
@@ -221,6 +270,15 @@ async def send_video_message(chat_id: int, video, user_id: int, caption_key=None
     last_bot_message[chat_id] = new_msg.message_id
     return new_msg
 
+async def send_media_group_message(chat_id: int, items: list, user_id: int, caption=None):
+    """
+    Удаляет старое сообщение, затем отправляет медиа группами по 10 (send_media_group).
+    Сообщения группы не запоминаются в last_bot_message, чтобы пользователь видел всю карусель.
+    """
+    await delete_previous_message_if_exists(chat_id)
+    last_bot_message.pop(chat_id, None)
+    return await send_media_batch(bot, chat_id, items, caption=caption)
+
 async def send_loading_message(chat_id: int, user_id: int):
     """
     Отправляем "Загрузка…" (или "Loading...")
@@ -260,6 +318,14 @@ def generate_post_pagination_keyboard(user_id: int, current_page, total_pages, p
     keyboard.append(nav_buttons)
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
+def _page_indexes(action_data: dict, page: int) -> range:
+    """
+    Индексы постов ленты (с 0), показанных на странице page клавиатуры выбора поста.
+    """
+    posts_per_page = action_data["posts_per_page"]
+    start = (page - 1) * posts_per_page
+    return range(start, min(start + posts_per_page, action_data.get("post_count", start + posts_per_page)))
+
 ###############################
 # ХЕНДЛЕРЫ
 ###############################
@@ -267,6 +333,7 @@ def generate_post_pagination_keyboard(user_id: int, current_page, total_pages, p
 async def cmd_start(message: Message):
     user_id = message.from_user.id
     user_actions.pop(user_id, None)
+    cancel_prefetch(user_id)
 
     # Если пользователь еще не выбирал язык, показываем кнопки выбора
     if user_id not in user_lang:
@@ -291,6 +358,7 @@ async def handle_cancel(callback: CallbackQuery):
     user_id = callback.from_user.id
     await callback.answer()
     user_actions.pop(user_id, None)
+    cancel_prefetch(user_id)
     await callback.message.edit_text(
         t(user_id, "cancel_done"),
         reply_markup=start_keyboard(user_id)
@@ -348,7 +416,7 @@ async def view_post_handler(callback: CallbackQuery):
 async def list_subscriptions_handler(callback: CallbackQuery):
     user_id = callback.from_user.id
     await callback.answer()
-    subs = get_subscriptions(user_id)
+    subs = await get_subscriptions(user_id)
     if subs:
         response = t(user_id, "subs_list_header") + "\n".join(f"- {username}" for _, username, _ in subs)
     else:
@@ -368,6 +436,8 @@ async def handle_pagination(callback: CallbackQuery):
         current_page = int(callback.data.split(":")[1])
         total_pages = action_data["total_pages"]
         posts_per_page = action_data["posts_per_page"]
+        # Посты новой страницы загружаются заранее, пока пользователь выбирает
+        prefetch_posts(user_id, action_data["username"], _page_indexes(action_data, current_page))
         await callback.message.edit_text(
             t(user_id, "found_publications", count="..."),  # Можно улучшить
             reply_markup=generate_post_pagination_keyboard(user_id, current_page, total_pages, posts_per_page)
@@ -390,26 +460,26 @@ async def handle_post_selection(callback: CallbackQuery):
     last_bot_message[user_id] = new_msg.message_id
 
     try:
-        post = get_new_posts(username, index=post_number, time_filter=False)
+        post = await get_post(username, post_number)
         if post:
-            for media in post["media"]:
-                media_type = media["media_type"]
-                file_path = media["file_path"]
-                if media_type == "photo":
-                    await send_photo_message(user_id, FSInputFile(file_path), user_id)
-                else:
-                    await send_video_message(user_id, FSInputFile(file_path), user_id)
-
-            likes = post["likes"]
-            comments = post["comments"]
-            likes_text = "Лайки: скрыты" if (0 <= likes <= 3) else f"👍 Лайков: {likes}"
-            caption = f"{likes_text}\n📝 Комментариев: {comments}\n📄 {post['caption']}"
-            await send_custom_text(user_id, caption, user_id)
-            
-            for media in post["media"]:
-                delete_temp_file(media["file_path"])
+            try:
+                for media in post["media"]:
+                    media["name"] = f"{username}_{media['media_id']}_{media['node_index']}"
+                await send_media_group_message(user_id, post["media"], user_id)
+
+                likes = post["likes"]
+                comments = post["comments"]
+                likes_text = "Лайки: скрыты" if (0 <= likes <= 3) else f"👍 Лайков: {likes}"
+                caption = f"{likes_text}\n📝 Комментариев: {comments}\n📄 {post['caption']}"
+                await send_custom_text(user_id, caption, user_id)
+            finally:
+                # Файлы медиакэша отпускаются и при ошибке отправки
+                release_files(media.get("file_path") for media in post["media"])
         else:
             await send_custom_text(user_id, t(user_id, "no_publications_plain"), user_id)
+    except INSTAGRAM_BUSY_ERRORS as e:
+        logging.warning(f"Instagram недоступен при получении поста: {e}")
+        await send_custom_text(user_id, t(user_id, "instagram_busy"), user_id)
     except Exception as e:
         logging.error(f"Ошибка при получении поста: {e}")
         await send_custom_text(user_id, t(user_id, "publications_error"), user_id)
@@ -448,7 +518,7 @@ async def handle_user_input(message: Message):
 
         if user_action == "add_account":
             try:
-                add_subscription(user_id, username)
+                await add_subscription(user_id, username)
                 await send_custom_text(
                     user_id,
                     t(user_id, "add_account_success", username=username),
@@ -468,7 +538,7 @@ async def handle_user_input(message: Message):
 
         elif user_action == "remove_account":
             try:
-                remove_subscription(user_id, username)
+                await remove_subscription(user_id, username)
                 await send_custom_text(
                     user_id,
                     t(user_id, "remove_account_success", username=username),
@@ -488,7 +558,7 @@ async def handle_user_input(message: Message):
 
         elif user_action == "view_post":
             try:
-                post_count = get_new_posts_count(username)
+                post_count = await get_post_count(username)
                 if post_count > 0:
                     posts_per_page = 5
                     total_pages = (post_count + posts_per_page - 1) // posts_per_page
@@ -496,8 +566,10 @@ async def handle_user_input(message: Message):
                         "action": "pagination",
                         "username": username,
                         "total_pages": total_pages,
-                        "posts_per_page": posts_per_page
+                        "posts_per_page": posts_per_page,
+                        "post_count": post_count
                     }
+                    prefetch_posts(user_id, username, _page_indexes(user_actions[user_id], 1))
                     await send_custom_text(
                         user_id,
                         t(user_id, "found_publications", count=post_count),
@@ -512,6 +584,15 @@ async def handle_user_input(message: Message):
                         reply_markup=start_keyboard(user_id)
                     )
                     user_actions.pop(user_id, None)
+            except INSTAGRAM_BUSY_ERRORS as e:
+                logging.warning(f"Get publications: Instagram is busy: {e}")
+                await send_custom_text(
+                    user_id,
+                    t(user_id, "instagram_busy"),
+                    user_id,
+                    reply_markup=start_keyboard(user_id)
+                )
+                user_actions.pop(user_id, None)
             except Exception as e:
                 logging.error(f"Get publications error: {e}")
                 await send_custom_text(
@@ -524,19 +605,14 @@ async def handle_user_input(message: Message):
 
         elif user_action == "view_story":
             try:
-                stories = await asyncio.to_thread(get_stories, username)
+                stories = await get_stories(username)
                 if stories:
-                    for story in stories:
-                        with open(story["url"], "rb") as f:
-                            if story["type"] == "photo":
-                                await send_photo_message(user_id, f, user_id)
-                            else:
-                                await send_video_message(user_id, f, user_id)
-                        os.remove(story["url"])
-
-                    temp_dir = os.path.dirname(stories[0]["url"])
-                    if os.path.exists(temp_dir):
-                        shutil.rmtree(temp_dir)
+                    items = story_media_items(username, stories)
+                    try:
+                        await send_media_group_message(user_id, items, user_id)
+                    finally:
+                        # Файлы медиакэша отпускаются и при ошибке отправки
+                        release_files(item["file_path"] for item in items)
 
                     await send_custom_text(user_id, t(user_id, "stories_sent"), user_id, reply_markup=start_keyboard(user_id))
                 else:
@@ -547,6 +623,15 @@ async def handle_user_input(message: Message):
                         reply_markup=start_keyboard(user_id)
                     )
                 user_actions.pop(user_id, None)
+            except INSTAGRAM_BUSY_ERRORS as e:
+                logging.warning(f"Get stories: Instagram is busy: {e}")
+                await send_custom_text(
+                    user_id,
+                    t(user_id, "instagram_busy"),
+                    user_id,
+                    reply_markup=start_keyboard(user_id)
+                )
+                user_actions.pop(user_id, None)
             except Exception as e:
                 logging.error(f"Get stories error: {e}")
                 await send_custom_text(
@@ -571,12 +656,129 @@ async def handle_user_input(message: Message):
         pass
 
 
+###############################
+# ВЕБХУК
+###############################
+# Как часто (сек) процесс бота проверяет, живы ли дополнительные процессы вебхука
+WEBHOOK_WATCH_INTERVAL = 5
+
+async def start_webhook_server():
+    """
+    Поднимает HTTP-сервер вебхука: апдейты с верным секретом идут в dp,
+    остальные запросы получают 401. Telegram получает ответ сразу, апдейт
+    обрабатывается в фоне. Возвращает web.AppRunner (для cleanup).
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    # Несколько процессов слушают один порт, соединения между ними распределяет ядро
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=WEBHOOK_WORKERS > 1).start()
+    return runner
+
+def _stop_on_signals() -> asyncio.Event:
+    """
+    Событие, которое выставляется по SIGINT / SIGTERM (как при остановке long polling),
+    чтобы процесс вебхука успел закрыть сервер и остановить свои процессы.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    return stop
+
+async def serve_webhook_worker(number: int):
+    """
+    Дополнительный процесс вебхука: только принимает апдейты. Рассылку очереди,
+    проверки и регистрацию вебхука ведёт основной процесс бота.
+    Запросы хендлеров к Instagram идут через те же аккаунты, что и у основного процесса:
+    лимит GRAPHQL_RATE и паузы сессий общие (через базу), а бюджет аренд сессий
+    делится между WEBHOOK_WORKERS процессами, так что лишний процесс не добавляет
+    аккаунтам нагрузки. Так же общий и лимит TELEGRAM_GLOBAL_RATE на запросы к Bot API.
+    """
+    try:
+        login(INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD)
+        split_session_budget(WEBHOOK_WORKERS)
+    except Exception as e:
+        logging.error(f"Процесс вебхука {number}: ошибка авторизации в Instagram: {e}")
+        return
+
+    dp.include_router(router)
+    # Каждому процессу — свой порт метрик
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT + number if METRICS_PORT else 0)
+    stop = _stop_on_signals()
+    runner = await start_webhook_server()
+    logging.info(f"Процесс вебхука {number} принимает апдейты.")
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await bot.session.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+def webhook_worker(number: int):
+    """
+    Точка входа дополнительного процесса вебхука (multiprocessing).
+    """
+    asyncio.run(serve_webhook_worker(number))
+
+async def run_webhook():
+    """
+    Режим вебхука: регистрирует WEBHOOK_URL в Telegram, запускает WEBHOOK_WORKERS - 1
+    дополнительных процессов и сам принимает апдейты наравне с ними.
+    Упавший дополнительный процесс перезапускается. Останавливается по SIGINT / SIGTERM.
+    """
+    if SHARED_STATE:
+        await purge_user_states()
+    await bot.set_webhook(
+        WEBHOOK_URL + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=True
+    )
+    stop = _stop_on_signals()
+    runner = await start_webhook_server()
+    logging.info(f"Вебхук {WEBHOOK_URL}{WEBHOOK_PATH} принимается на {WEBHOOK_HOST}:{WEBHOOK_PORT}, процессов: {WEBHOOK_WORKERS}.")
+
+    context = multiprocessing.get_context("spawn")
+    workers = {}
+    try:
+        while not stop.is_set():
+            for number in range(1, WEBHOOK_WORKERS):
+                process = workers.get(number)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    logging.warning(f"Процесс вебхука {number} завершился (код {process.exitcode}), перезапуск.")
+                process = context.Process(target=webhook_worker, args=(number,), daemon=True)
+                process.start()
+                workers[number] = process
+            try:
+                await asyncio.wait_for(stop.wait(), WEBHOOK_WATCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            await asyncio.to_thread(process.join, WEBHOOK_WATCH_INTERVAL)
+        await runner.cleanup()
+        await bot.session.close()
+
 ###############################
 # ЗАПУСК
 ###############################
 async def main():
+    if WEBHOOK_URL and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+        logging.error("Для вебхука нужен WEBHOOK_SECRET: 1–256 символов A-Z, a-z, 0-9, _ и -.")
+        return
+
     logging.info("Инициализация базы данных...")
     initialize_database()
+    # Недокачанные и осиротевшие файлы после прошлого запуска
+    collect_garbage()
 
     logging.info("Авторизация в Instagram...")
     try:
@@ -584,14 +786,36 @@ async def main():
     except Exception as e:
         logging.error(f"Ошибка авторизации в Instagram: {e}")
         return
+    if WEBHOOK_URL:
+        # Аккаунты Instagram делят все процессы вебхука
+        split_session_budget(WEBHOOK_WORKERS)
 
     dp.include_router(router)
-    logging.info("Запуск планировщика задач...")
-    asyncio.create_task(start_scheduler(bot))
+    if EMBEDDED_WORKER:
+        logging.info("Запуск планировщика задач...")
+        asyncio.create_task(run_worker(bot))
+    else:
+        logging.info("Проверки выполняют отдельные воркеры (worker.py).")
+
+    metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    # Рассылку из исходящей очереди (её наполняют воркеры) ведёт процесс бота
+    dispatcher = asyncio.create_task(run_dispatcher(bot))
+    # Языки пользователей пишутся в базу пачками
+    flusher = asyncio.create_task(user_lang.run_flusher(LANG_FLUSH_INTERVAL))
 
     logging.info("Запуск Telegram-бота...")
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    try:
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        dispatcher.cancel()
+        flusher.cancel()
+        await user_lang.flush()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,270 @@
+import os
+import re
+import time
+import shutil
+import logging
+import threading
+from downloader import download_many
+from database import get_outbox_file_paths
+from metrics import cache_lookup, media_cache_bytes, media_cache_evictions_total
+from config.config import MEDIA_CACHE_FOLDER, MEDIA_CACHE_MAX_BYTES, MEDIA_CACHE_MIN_AGE
+
+# Медиакэш на диске: один файл на медиа Instagram, имя — <media_id>_<node_index>.<ext>.
+# Поэтому одно и то же медиа скачивается один раз, сколько бы пользователей и проверок
+# его ни запросило, а повторный просмотр берёт файл с диска.
+#
+# Файл не вытесняется, пока он:
+#   - закреплён в этом процессе (pin / release — хендлер или проверка ещё отправляет его);
+#   - упомянут в исходящей очереди (таблица outbox_files — видна всем процессам);
+#   - использовался меньше MEDIA_CACHE_MIN_AGE секунд назад (его может держать другой процесс).
+# Остальные файлы вытесняются по давности использования (mtime), когда кэш больше MEDIA_CACHE_MAX_BYTES.
+
+ENTRY_PATTERN = re.compile(r"^\d+_\d+\.(jpg|mp4)$")
+
+os.makedirs(MEDIA_CACHE_FOLDER, exist_ok=True)
+
+_lock = threading.Lock()
+# Закреплённые файлы: {путь: число держателей}
+_pins = {}
+# Загрузки, которые выполняются прямо сейчас: {путь: threading.Event}
+_downloads = {}
+# Размер кэша по последнему обходу плюс скачанное с тех пор (None — ещё не считали)
+_total_bytes = None
+
+
+def media_path(media_id, node_index: int, extension: str) -> str:
+    """
+    Путь к файлу медиа в кэше.
+    """
+    return os.path.join(MEDIA_CACHE_FOLDER, f"{media_id}_{node_index}.{extension}")
+
+
+def _touch(path: str) -> bool:
+    """
+    Отмечает использование файла (mtime — время последнего использования для LRU).
+    Возвращает False, если файла уже нет.
+    """
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+def pin(path: str, count: int = 1) -> None:
+    """
+    Закрепляет файл: пока держатели его не отпустили, файл не вытесняется.
+    """
+    if not path or count <= 0:
+        return
+    with _lock:
+        _pins[path] = _pins.get(path, 0) + count
+
+
+def release(path: str, count: int = 1) -> None:
+    """
+    Отпускает закреплённый файл. Сам файл остаётся в кэше до вытеснения.
+    """
+    if not path or count <= 0:
+        return
+    with _lock:
+        holders = _pins.get(path, 0) - count
+        if holders > 0:
+            _pins[path] = holders
+        else:
+            _pins.pop(path, None)
+
+
+def acquire(path: str) -> bool:
+    """
+    Закрепляет файл, если он ещё в кэше (отпустить через release). Возвращает False, если его уже нет.
+    """
+    with _lock:
+        if path in _downloads or not _touch(path):
+            return False
+        _pins[path] = _pins.get(path, 0) + 1
+    return True
+
+
+def lookup(media_id, node_index: int, extension: str):
+    """
+    Путь к уже скачанному медиа (закреплённый — отпустить через release) или None.
+    """
+    path = media_path(media_id, node_index, extension)
+    with _lock:
+        hit = path not in _downloads and _touch(path)
+        if hit:
+            _pins[path] = _pins.get(path, 0) + 1
+    cache_lookup("media", hit)
+    return path if hit else None
+
+
+def fetch_many(jobs: list, proxies: dict = None) -> list:
+    """
+    Возвращает пути к медиа в кэше, при необходимости скачивая их параллельно:
+    jobs = [(url, media_id, node_index, extension), ...].
+    Если то же медиа уже скачивает другой поток, ждёт его загрузку вместо повторной.
+    Каждый полученный путь закреплён — его нужно отпустить через release.
+    None — для файлов, которые скачать не удалось; порядок как в jobs.
+    """
+    global _total_bytes
+    results = [None] * len(jobs)
+    own = []       # [(index, url, path, event)] — скачивает этот поток
+    waiting = []   # [(index, path, event)] — скачивает другой поток (или этот, раньше в jobs)
+    with _lock:
+        for index, (url, media_id, node_index, extension) in enumerate(jobs):
+            path = media_path(media_id, node_index, extension)
+            event = _downloads.get(path)
+            if event is not None:
+                waiting.append((index, path, event))
+            elif _touch(path):
+                _pins[path] = _pins.get(path, 0) + 1
+                results[index] = path
+            else:
+                event = _downloads[path] = threading.Event()
+                own.append((index, url, path, event))
+                cache_lookup("media", False)
+                continue
+            cache_lookup("media", True)
+
+    if own:
+        downloaded = [False] * len(own)
+        try:
+            downloaded = download_many([(url, path) for _, url, path, _ in own], proxies)
+        finally:
+            # Даже если загрузка упала, ждущие потоки должны проснуться, а пути — освободиться
+            added = 0
+            with _lock:
+                for (index, _, path, event), ok in zip(own, downloaded):
+                    if ok:
+                        _pins[path] = _pins.get(path, 0) + 1
+                        results[index] = path
+                        added += os.path.getsize(path)
+                    del _downloads[path]
+                    event.set()
+                if _total_bytes is not None:
+                    _total_bytes += added
+                over_budget = _total_bytes is None or _total_bytes > MEDIA_CACHE_MAX_BYTES
+        if over_budget:
+            evict()
+
+    for index, path, event in waiting:
+        event.wait()
+        with _lock:
+            if _touch(path):
+                _pins[path] = _pins.get(path, 0) + 1
+                results[index] = path
+    return results
+
+
+def fetch(url: str, media_id, node_index: int, extension: str, proxies: dict = None):
+    """
+    Путь к медиа в кэше (скачивает, если его там нет) или None при ошибке.
+    Путь закреплён — его нужно отпустить через release.
+    """
+    return fetch_many([(url, media_id, node_index, extension)], proxies)[0]
+
+
+def _scan() -> list:
+    """
+    Файлы кэша: [(путь, размер, mtime), ...].
+    """
+    entries = []
+    with os.scandir(MEDIA_CACHE_FOLDER) as listing:
+        for entry in listing:
+            if entry.is_file() and ENTRY_PATTERN.match(entry.name):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+    return entries
+
+
+def _protected() -> set:
+    """
+    Пути, которые сейчас нельзя удалять: закреплённые, скачиваемые и ожидающие отправки.
+    """
+    with _lock:
+        paths = set(_pins) | set(_downloads)
+    return {os.path.normpath(path) for path in paths | set(get_outbox_file_paths())}
+
+
+def _in_use(path: str) -> bool:
+    """
+    Закреплён ли файл или скачивается ли он сейчас. Вызывать под _lock.
+    """
+    path = os.path.normpath(path)
+    return any(os.path.normpath(held) == path for held in (*_pins, *_downloads))
+
+
+def evict() -> int:
+    """
+    Вытесняет давно не использованные файлы, пока кэш не станет меньше MEDIA_CACHE_MAX_BYTES.
+    Возвращает число удалённых файлов.
+    """
+    global _total_bytes
+    entries = _scan()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    if total > MEDIA_CACHE_MAX_BYTES:
+        protected = _protected()
+        fresh_after = time.time() - MEDIA_CACHE_MIN_AGE
+        for path, size, mtime in sorted(entries, key=lambda entry: entry[2]):
+            if total <= MEDIA_CACHE_MAX_BYTES:
+                break
+            if mtime > fresh_after or os.path.normpath(path) in protected:
+                continue
+            # Пока шёл обход, файл могли закрепить или начать скачивать заново —
+            # проверяем это под блокировкой, чтобы не удалить его из-под держателя
+            with _lock:
+                if _in_use(path):
+                    continue
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logging.warning(f"Не удалось удалить файл медиакэша {path}: {e}")
+                    continue
+            total -= size
+            removed += 1
+        if removed:
+            media_cache_evictions_total.inc(removed)
+            logging.info(f"Из медиакэша вытеснено файлов: {removed}")
+        if total > MEDIA_CACHE_MAX_BYTES:
+            logging.info(f"Медиакэш ({total} байт) больше предела: остальные файлы сейчас используются.")
+    with _lock:
+        _total_bytes = total
+    media_cache_bytes.set(total)
+    return removed
+
+
+def collect_garbage() -> int:
+    """
+    Уборка при запуске: удаляет недокачанные файлы (*.part) и всё, что не является файлом кэша
+    (например, файлы и папки историй из прежнего temp/), если это не ждёт отправки в исходящей
+    очереди и не менялось MEDIA_CACHE_MIN_AGE секунд (другой процесс может ещё работать с ним).
+    Затем вытесняет лишнее сверх MEDIA_CACHE_MAX_BYTES. Возвращает число удалённых объектов.
+    """
+    protected = _protected()
+    fresh_after = time.time() - MEDIA_CACHE_MIN_AGE
+    removed = 0
+    with os.scandir(MEDIA_CACHE_FOLDER) as listing:
+        orphans = [
+            entry for entry in listing
+            if not (entry.is_file() and ENTRY_PATTERN.match(entry.name))
+            and os.path.normpath(entry.path) not in protected
+        ]
+    for entry in orphans:
+        try:
+            if entry.stat(follow_symlinks=False).st_mtime > fresh_after:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+            removed += 1
+        except OSError as e:
+            logging.warning(f"Не удалось удалить {entry.path} из медиакэша: {e}")
+    if removed:
+        logging.info(f"Из медиакэша удалено лишних файлов и папок: {removed}")
+    return removed + evict()
@@ -0,0 +1,121 @@
+import logging
+from downloader import content_length
+from config.config import PHOTO_TARGET_WIDTH, VIDEO_TARGET_WIDTH, TELEGRAM_UPLOAD_LIMIT
+
+# Instagram отдаёт каждое медиа в нескольких разрешениях:
+#   - iPhone API (лента авторизованной сессии): image_versions2.candidates и video_versions
+#     с полями url, width, height;
+#   - graphql (истории, анонимные запросы): display_resources и video_resources
+#     с полями src, config_width, config_height.
+# Вместо самого большого варианта берётся наименьший, который не уже целевой ширины:
+# Telegram всё равно пережимает фото (до 1280 px по большей стороне), а лишние байты
+# тратят трафик CDN и время загрузки в Telegram.
+
+# Допуск при сравнении пропорций вариантов (обрезанные квадратные превью отбрасываются)
+ASPECT_TOLERANCE = 0.02
+
+
+def _same_aspect(width, height, reference) -> bool:
+    if not (width and height and reference):
+        return True
+    return abs(width / height - reference) <= ASPECT_TOLERANCE * reference
+
+
+def _variants(entries: list, url_key: str, width_key: str, height_key: str) -> list:
+    """
+    [(ширина, url), ...] с теми же пропорциями, что у первого (оригинального) варианта.
+    """
+    entries = [entry for entry in entries or [] if entry.get(url_key)]
+    if not entries:
+        return []
+    first = entries[0]
+    reference = first[width_key] / first[height_key] if first.get(width_key) and first.get(height_key) else None
+    return [
+        (entry.get(width_key) or 0, entry[url_key])
+        for entry in entries
+        if _same_aspect(entry.get(width_key), entry.get(height_key), reference)
+    ]
+
+
+def _ordered(variants: list) -> list:
+    """
+    Варианты без повторов url, по возрастанию ширины.
+    """
+    unique = {}
+    for width, url in variants:
+        unique.setdefault(url, width)
+    return sorted(((width, url) for url, width in unique.items()), key=lambda variant: variant[0])
+
+
+def image_variants(node: dict) -> list:
+    """
+    Варианты фото (или превью видео) из узла медиа Instagram: [(ширина, url), ...] по возрастанию.
+    """
+    variants = _variants(
+        (node.get("image_versions2") or {}).get("candidates"), "url", "width", "height"
+    ) + _variants(node.get("display_resources"), "src", "config_width", "config_height")
+    if not variants and node.get("display_url"):
+        variants.append((0, node["display_url"]))
+    return _ordered(variants)
+
+
+def video_variants(node: dict) -> list:
+    """
+    Варианты видео из узла медиа Instagram: [(ширина, url), ...] по возрастанию.
+    """
+    variants = _variants(node.get("video_versions"), "url", "width", "height") + _variants(
+        node.get("video_resources"), "src", "config_width", "config_height"
+    )
+    if not variants and node.get("video_url"):
+        variants.append((0, node["video_url"]))
+    return _ordered(variants)
+
+
+def preferred_urls(variants: list, target_width: int) -> list:
+    """
+    URL вариантов в порядке предпочтения: сначала наименьший не уже target_width
+    (или самый большой, если все уже), затем всё меньшие — на случай, если он не подойдёт.
+    target_width = 0 — начиная с самого большого.
+    """
+    if not variants:
+        return []
+    start = len(variants) - 1
+    if target_width > 0:
+        start = next((index for index, (width, _) in enumerate(variants) if width >= target_width), start)
+    return [url for _, url in reversed(variants[:start + 1])]
+
+
+def pick_image(node: dict):
+    """
+    URL фото нужного размера (PHOTO_TARGET_WIDTH) или None, если вариантов нет.
+    """
+    urls = preferred_urls(image_variants(node), PHOTO_TARGET_WIDTH)
+    return urls[0] if urls else None
+
+
+def pick_video(node: dict, proxies: dict = None) -> tuple:
+    """
+    Вариант видео нужного размера (VIDEO_TARGET_WIDTH), который помещается в предел загрузки
+    Telegram (TELEGRAM_UPLOAD_LIMIT): если выбранный больше предела, берётся меньший.
+    Размер узнаётся запросом HEAD, до скачивания. Возвращает (url, размер в байтах или None),
+    либо (None, None), если вариантов нет или все больше предела.
+    """
+    urls = preferred_urls(video_variants(node), VIDEO_TARGET_WIDTH)
+    if not TELEGRAM_UPLOAD_LIMIT:
+        return (urls[0], None) if urls else (None, None)
+    for url in urls:
+        size = content_length(url, proxies)
+        # Размер неизвестен — решит сама загрузка
+        if size is None or size <= TELEGRAM_UPLOAD_LIMIT:
+            return url, size
+        logging.info(f"Вариант видео {url} ({size} байт) больше предела Telegram, пробуем меньший.")
+    if urls:
+        logging.warning(f"Видео больше предела Telegram ({TELEGRAM_UPLOAD_LIMIT} байт) во всех вариантах — пропущено.")
+    return None, None
+
+
+def is_video_node(node: dict) -> bool:
+    """
+    True, если узел медиа (iPhone API или graphql) — видео.
+    """
+    return node.get("media_type") == 2 or bool(node.get("is_video"))
@@ -0,0 +1,258 @@
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from aiohttp import web
+from database import count_outbox, count_due_poll_jobs
+
+# Границы корзин гистограмм задержек (сек): от быстрых ответов SQLite до долгих загрузок видео
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Тип содержимого текстового формата Prometheus
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Все созданные метрики в порядке объявления
+_registry = []
+_lock = threading.Lock()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    """
+    Общая часть метрик: имя, описание, имена меток и значения по наборам меток.
+    Метрики потокобезопасны: их обновляют и event loop, и пулы потоков Instaloader и загрузок.
+    """
+    kind = None
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}  # {(значения меток): значение}
+        with _lock:
+            _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def _samples(self) -> list:
+        with _lock:
+            return [(self.name, key, None, value) for key, value in self._values.items()]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self._samples():
+            lines.append(f"{name}{_format_labels(self.labels, key, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """
+    Монотонно растущий счётчик (запросы, байты, ошибки).
+    """
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Текущее значение (глубина очереди). Если задана function, значение
+    вычисляется ею в момент чтения метрик (например, запросом к базе).
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labels: tuple = (), function=None):
+        super().__init__(name, description, labels)
+        self.function = function
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = value
+
+    def _samples(self) -> list:
+        if self.function is None:
+            return super()._samples()
+        try:
+            return [(self.name, (), None, self.function())]
+        except Exception as e:
+            logging.error(f"Не удалось вычислить метрику {self.name}: {e}")
+            return []
+
+
+class Histogram(_Metric):
+    """
+    Распределение значений (задержек) по корзинам, плюс сумма и количество наблюдений.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            record = self._values.get(key)
+            if record is None:
+                record = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    record["counts"][index] += 1
+                    break
+            record["sum"] += value
+            record["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Замеряет время выполнения блока with (в том числе завершившегося исключением).
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self) -> list:
+        samples = []
+        with _lock:
+            for key, record in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, record["counts"]):
+                    cumulative += count
+                    samples.append((f"{self.name}_bucket", key, f'le="{_format_value(bound)}"', cumulative))
+                samples.append((f"{self.name}_sum", key, None, record["sum"]))
+                samples.append((f"{self.name}_count", key, None, record["count"]))
+        return samples
+
+
+def render() -> str:
+    """
+    Все метрики в текстовом формате Prometheus.
+    """
+    with _lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+###############################
+# МЕТРИКИ
+###############################
+# Instagram
+instagram_requests_total = Counter(
+    "instagram_requests_total", "Запросы к API Instagram по сессиям.", ("session", "query_type")
+)
+instagram_profile_seconds = Histogram(
+    "instagram_profile_seconds", "Время Profile.from_username."
+)
+instagram_feed_page_seconds = Histogram(
+    "instagram_feed_page_seconds", "Время загрузки одной страницы ленты (get_posts)."
+)
+# CDN
+media_download_seconds = Histogram(
+    "media_download_seconds", "Время скачивания одного файла с CDN (save_file_from_url)."
+)
+media_download_bytes_total = Counter(
+    "media_download_bytes_total", "Скачано байт с CDN."
+)
+# Telegram
+telegram_request_seconds = Histogram(
+    "telegram_request_seconds", "Время запроса к Bot API (без ожидания лимитов).", ("method",)
+)
+telegram_request_errors_total = Counter(
+    "telegram_request_errors_total", "Ошибки запросов к Bot API.", ("method", "error")
+)
+outbox_deliveries_total = Counter(
+    "outbox_deliveries_total", "Исходы отправки сообщений исходящей очереди.", ("result",)
+)
+outbox_messages = Gauge(
+    "outbox_messages", "Сообщений в исходящей очереди.", function=count_outbox
+)
+# Планировщик
+scheduler_cycle_seconds = Histogram(
+    "scheduler_cycle_seconds", "Длительность прохода проверки профилей."
+)
+scheduler_cycle_subscriptions = Histogram(
+    "scheduler_cycle_subscriptions", "Подписок, обработанных за проход.",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+)
+scheduler_queue_depth = Gauge(
+    "scheduler_queue_depth", "Заданий в очереди стадии конвейера.", ("stage",)
+)
+poll_jobs_due = Gauge(
+    "poll_jobs_due", "Профилей, чья проверка уже подошла по времени.", function=count_due_poll_jobs
+)
+# Медиакэш на диске
+media_cache_bytes = Gauge(
+    "media_cache_bytes", "Размер медиакэша на диске по последнему обходу."
+)
+media_cache_evictions_total = Counter(
+    "media_cache_evictions_total", "Файлов вытеснено из медиакэша."
+)
+# Кэши: profile, feed_cursor, coalesce, file_id, user_lang, media
+cache_requests_total = Counter(
+    "cache_requests_total", "Обращения к кэшам: попадания и промахи.", ("cache", "result")
+)
+
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    """
+    Учитывает обращение к кэшу cache (попадание или промах).
+    """
+    cache_requests_total.inc(cache=cache, result="hit" if hit else "miss")
+
+
+###############################
+# HTTP-ЭНДПОИНТ
+###############################
+async def _handle_metrics(request: web.Request) -> web.Response:
+    # Часть метрик читается из SQLite — не в event loop
+    body = await asyncio.to_thread(render)
+    return web.Response(body=body.encode(), headers={"Content-Type": CONTENT_TYPE})
+
+
+async def start_metrics_server(host: str, port: int):
+    """
+    Поднимает HTTP-эндпоинт /metrics (формат Prometheus) на host:port.
+    port = 0 — эндпоинт выключен. Возвращает web.AppRunner (для cleanup) или None.
+    Ошибка запуска (например, порт занят другим процессом) не останавливает бота.
+    """
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logging.error(f"Не удалось запустить эндпоинт метрик на {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
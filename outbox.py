@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import contextvars
+from contextlib import asynccontextmanager
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from async_db import (
+    enqueue_outbox, claim_outbox, extend_outbox_lease, retry_outbox, complete_outbox, get_next_outbox_at,
+    get_cached_files, delete_file_ids
+)
+from media_cache import release
+from rate_limiter import TokenBucket
+from state_store import ExpiringStore
+from metrics import telegram_request_seconds, telegram_request_errors_total, outbox_deliveries_total
+from telegram_files import send_media_batch, MEDIA_GROUP_LIMIT
+from config.config import (
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_INTERVAL, USER_STATE_MAX_SIZE,
+    OUTBOX_CONCURRENCY, OUTBOX_LEASE_TIME, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_DELAY, OUTBOX_POLL_INTERVAL
+)
+
+
+# Выставлен, пока диспетчер отправляет сообщение очереди (интервал между сообщениями в чат
+# действует только для рассылки, ответы хендлеров на действия пользователя его не ждут)
+_outbox_send = contextvars.ContextVar("outbox_send", default=False)
+
+
+class TelegramRateMiddleware(BaseRequestMiddleware):
+    """
+    Middleware сессии бота: держит все запросы к Bot API в пределах лимитов Telegram —
+    не больше TELEGRAM_GLOBAL_RATE запросов в секунду на бота, а рассылка из исходящей
+    очереди — не чаще одного сообщения в TELEGRAM_CHAT_INTERVAL секунд в один чат.
+    Время самих запросов и их ошибки попадают в метрики telegram_request_*.
+    Подключается через bot.session.middleware(TelegramRateMiddleware()).
+    """
+
+    def __init__(self, shared: bool = False):
+        """
+        :param shared: делить глобальный лимит с другими процессами бота через базу
+                       (несколько процессов вебхука отправляют от имени одного бота).
+        """
+        self.bucket = TokenBucket("telegram", TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE, shared=shared)
+        # {chat_id: когда (time.monotonic()) в чат можно отправить следующее сообщение}
+        self.chat_ready_at = ExpiringStore(max(TELEGRAM_CHAT_INTERVAL, 1) * 60, USER_STATE_MAX_SIZE)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is not None and _outbox_send.get() and method.__api_method__.startswith("send"):
+            now = time.monotonic()
+            ready_at = max(now, self.chat_ready_at.get(chat_id, now))
+            self.chat_ready_at[chat_id] = ready_at + TELEGRAM_CHAT_INTERVAL
+            if ready_at > now:
+                await asyncio.sleep(ready_at - now)
+        await self.bucket.acquire_async()
+        api_method = method.__api_method__
+        try:
+            with telegram_request_seconds.time(method=api_method):
+                return await make_request(bot, method)
+        except Exception as e:
+            telegram_request_errors_total.inc(method=api_method, error=type(e).__name__)
+            raise
+
+
+# Будит диспетчер, когда в очередь что-то поставили в этом же процессе
+_wakeup = asyncio.Event()
+
+###############################
+# ПОСТАНОВКА В ОЧЕРЕДЬ
+###############################
+def text_message(chat_id: int, text: str) -> tuple:
+    """
+    Текстовое сообщение для enqueue.
+    """
+    return chat_id, {"text": text}
+
+def media_messages(chat_id: int, items: list, caption: str = None) -> list:
+    """
+    Медиа для enqueue: по одному сообщению очереди на каждую медиагруппу (MEDIA_GROUP_LIMIT штук),
+    чтобы повтор после ошибки не отправлял уже доставленные группы. Подпись — у первой группы.
+    items — как у telegram_files.send_media_batch.
+    """
+    return [
+        (chat_id, {
+            "items": items[start:start + MEDIA_GROUP_LIMIT],
+            "caption": caption if start == 0 else None
+        })
+        for start in range(0, len(items), MEDIA_GROUP_LIMIT)
+    ]
+
+async def enqueue(messages: list):
+    """
+    Ставит сообщения [(chat_id, payload), ...] в исходящую очередь одной транзакцией.
+    Файлы медиакэша из payload не вытесняются, пока на них ссылается сообщение очереди
+    (закрепление вызывающего после постановки можно отпустить).
+    """
+    await enqueue_outbox([
+        (
+            chat_id,
+            json.dumps(payload, ensure_ascii=False),
+            sorted({item["file_path"] for item in payload.get("items", []) if item.get("file_path")})
+        )
+        for chat_id, payload in messages
+    ])
+    _wakeup.set()
+
+###############################
+# ДИСПЕТЧЕР
+###############################
+def _dispatcher_id() -> str:
+    return f"outbox:{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+def _retry_delay(attempts: int) -> float:
+    return min(OUTBOX_RETRY_DELAY * 2 ** attempts, 3600)
+
+# Ошибки Telegram о недействительном file_id (файл удалён или file_id от другого бота)
+FILE_ID_ERROR_MARKERS = ("wrong file identifier", "wrong remote file identifier", "file reference")
+
+def _is_file_id_error(error: TelegramBadRequest) -> bool:
+    text = (error.message or "").lower()
+    return any(marker in text for marker in FILE_ID_ERROR_MARKERS)
+
+# Первые загрузки медиа в Telegram: {(media_id, node_index): [asyncio.Lock, число держателей]}
+_uploads = {}
+
+@asynccontextmanager
+async def _first_upload(keys: list):
+    """
+    Пока медиа keys загружается в Telegram для одного получателя, остальные ждут
+    и затем отправляют его по сохранённому file_id. Блокировки берутся в порядке keys.
+    """
+    entries = []
+    acquired = []
+    try:
+        for key in keys:
+            entry = _uploads.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            entries.append((key, entry))
+            await entry[0].acquire()
+            acquired.append(entry[0])
+        yield
+    finally:
+        for lock in reversed(acquired):
+            lock.release()
+        for key, entry in entries:
+            entry[1] -= 1
+            if not entry[1]:
+                del _uploads[key]
+
+async def _use_cached_file_ids(items: list) -> None:
+    """
+    Подставляет сохранённые file_id элементам, у которых его ещё нет.
+    """
+    for item in items:
+        if not item.get("file_id"):
+            cached = (await get_cached_files(item["media_id"])).get(item["node_index"])
+            if cached:
+                item["file_id"] = cached[0]
+
+async def _send(bot: Bot, chat_id: int, payload: dict) -> None:
+    """
+    Отправляет одно сообщение очереди. Медиа, уже загруженное в Telegram
+    (в том числе этим же диспетчером для предыдущего получателя), уходит по file_id.
+    Новое медиа загружается один раз: одновременные отправки того же медиа в другие чаты
+    ждут первую загрузку (_first_upload) и берут её file_id.
+    Если Telegram не принял сохранённый file_id, он забывается, и медиа загружается
+    заново из source_url / file_path.
+    """
+    if "text" in payload:
+        await bot.send_message(chat_id=chat_id, text=payload["text"])
+        return
+
+    items = payload["items"]
+    await _use_cached_file_ids(items)
+    uploads = sorted({(str(item["media_id"]), item["node_index"]) for item in items if not item.get("file_id")})
+    async with _first_upload(uploads):
+        # За время ожидания медиа мог загрузить другой получатель
+        await _use_cached_file_ids(items)
+        await _send_media(bot, chat_id, items, payload.get("caption"))
+
+async def _send_media(bot: Bot, chat_id: int, items: list, caption: str = None) -> None:
+    """
+    send_media_batch с повторной загрузкой медиа, если Telegram не принял сохранённый file_id.
+    """
+    own_files = {item.get("file_path") for item in items}
+    try:
+        try:
+            await send_media_batch(bot, chat_id, items, caption=caption)
+        except TelegramBadRequest as e:
+            stale = [item for item in items if item.get("file_id")]
+            if not stale or not _is_file_id_error(e):
+                raise
+            logging.warning(f"Чат {chat_id}: Telegram не принял сохранённый file_id ({e.message}).")
+            await delete_file_ids([(item["media_id"], item["node_index"]) for item in stale])
+            if any(not (item.get("source_url") or item.get("file_path")) for item in stale):
+                # Загрузить медиа заново не из чего
+                raise
+            for item in stale:
+                item["file_id"] = None
+            await send_media_batch(bot, chat_id, items, caption=caption)
+    finally:
+        # Файлы, которые send_media_batch взял из медиакэша сам (большие видео), закреплены этой отправкой
+        for item in items:
+            if item.get("file_path") and item["file_path"] not in own_files:
+                release(item["file_path"])
+
+async def _keep_lease(owner: str, outbox_id: int):
+    """
+    Продлевает аренду сообщения, пока идёт его отправка (паузы лимитов и загрузка большого видео
+    могут занять больше OUTBOX_LEASE_TIME), чтобы его не отправили второй раз.
+    """
+    while True:
+        await asyncio.sleep(OUTBOX_LEASE_TIME / 3)
+        try:
+            await extend_outbox_lease(outbox_id, owner, OUTBOX_LEASE_TIME)
+        except Exception as e:
+            logging.error(f"Не удалось продлить аренду сообщения {outbox_id}: {e}")
+
+async def _deliver(bot: Bot, owner: str, outbox_id: int, chat_id: int, payload: str, attempts: int):
+    """
+    Отправляет сообщение и решает его судьбу: удалить из очереди, повторить позже или отбросить.
+    """
+    _outbox_send.set(True)
+    heartbeat = asyncio.create_task(_keep_lease(owner, outbox_id))
+    try:
+        await _send(bot, chat_id, json.loads(payload))
+    except TelegramRetryAfter as e:
+        # Telegram сам назвал паузу: ждёт только этот чат, попытка не считается
+        logging.warning(f"Чат {chat_id}: Telegram просит подождать {e.retry_after} c.")
+        await retry_outbox(outbox_id, owner, time.time() + e.retry_after, str(e), count_attempt=False)
+        outbox_deliveries_total.inc(result="retry_after")
+        return
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        # Бот заблокирован, чат не найден и т.п. — повтор не поможет
+        logging.error(f"Сообщение для чата {chat_id} отброшено: {e}")
+        outbox_deliveries_total.inc(result="dropped")
+    except Exception as e:
+        if attempts + 1 < OUTBOX_MAX_ATTEMPTS:
+            delay = _retry_delay(attempts)
+            logging.warning(f"Ошибка отправки в чат {chat_id}, повтор через {delay:.0f} c: {e}")
+            await retry_outbox(outbox_id, owner, time.time() + delay, str(e))
+            outbox_deliveries_total.inc(result="retry")
+            return
+        logging.error(f"Сообщение для чата {chat_id} отброшено после {attempts + 1} попыток: {e}")
+        outbox_deliveries_total.inc(result="dropped")
+    else:
+        outbox_deliveries_total.inc(result="sent")
+    finally:
+        heartbeat.cancel()
+
+    await complete_outbox(outbox_id)
+
+async def run_dispatcher(bot: Bot, owner: str = None):
+    """
+    Диспетчер исходящей очереди: отправляет сообщения в разные чаты параллельно
+    (до OUTBOX_CONCURRENCY одновременно), сохраняя порядок внутри каждого чата.
+    Ошибка или пауза одного чата не задерживает остальные. Сообщения арендуются,
+    поэтому после падения процесса неотправленное уйдёт после перезапуска.
+    Аренда сообщения продлевается, пока идёт его отправка.
+    Скорость ограничивает TelegramRateMiddleware на сессии бота.
+    """
+    owner = owner or _dispatcher_id()
+    # {id сообщения: задача отправки}
+    in_flight = {}
+    logging.info(f"Диспетчер исходящей очереди {owner} запущен.")
+    while True:
+        _wakeup.clear()
+        next_attempt_at = None
+        try:
+            free = OUTBOX_CONCURRENCY - len(in_flight)
+            if free > 0:
+                # Сообщения, которые ещё отправляются, не арендуются повторно
+                messages = await claim_outbox(owner, free, OUTBOX_LEASE_TIME, list(in_flight))
+                for message in messages:
+                    outbox_id = message[0]
+                    task = asyncio.create_task(_deliver(bot, owner, *message))
+                    in_flight[outbox_id] = task
+                    task.add_done_callback(lambda _, outbox_id=outbox_id: in_flight.pop(outbox_id, None))
+                if messages:
+                    continue
+                next_attempt_at = await get_next_outbox_at()
+        except Exception as e:
+            logging.error(f"Ошибка диспетчера исходящей очереди: {e}")
+
+        delay = OUTBOX_POLL_INTERVAL if next_attempt_at is None else next_attempt_at - time.time()
+        delay = min(max(delay, 0), OUTBOX_POLL_INTERVAL)
+        # Просыпаемся раньше, если освободился слот или в очередь что-то поставили
+        waiters = [asyncio.create_task(_wakeup.wait())] + list(in_flight.values())
+        await asyncio.wait(waiters, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+        waiters[0].cancel()
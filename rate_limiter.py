@@ -0,0 +1,263 @@
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+import instaloader
+from instaloader.instaloadercontext import RateController
+from database import get_limiter_state, save_limiter_state, update_limiter_state
+from metrics import instagram_requests_total
+from config.config import (
+    GRAPHQL_RATE, GRAPHQL_BURST, GRAPHQL_MAX_WAIT, CDN_RATE, CDN_BURST,
+    LIMITER_MIN_RATE, LIMITER_RECOVERY, LIMITER_BACKOFF, LIMITER_MAX_BACKOFF
+)
+
+
+class RateLimitedError(Exception):
+    """
+    Instagram ответил 429 / «Please wait a few minutes»: запрос прерван, чтобы не долбить сервер повторами.
+    """
+
+
+# Исключения Instaloader, которыми Instagram ограничивает частоту запросов:
+# 429 и 400 (так Instagram отвечает на «Please wait a few minutes» и checkpoint)
+RATE_LIMIT_ERRORS = (
+    RateLimitedError,
+    instaloader.exceptions.TooManyRequestsException,
+    instaloader.exceptions.QueryReturnedBadRequestException
+)
+# HTTP-коды ограничения скорости у исключений с ответом сервера (requests / httpx)
+RATE_LIMIT_STATUS_CODES = {429}
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    True, если исключение означает ограничение скорости или блокировку со стороны Instagram.
+    Проверяются тип исключения и HTTP-код ответа — по всей цепочке причин
+    (Instaloader оборачивает исходную ошибку в ConnectionException).
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, RATE_LIMIT_ERRORS):
+            return True
+        response = getattr(error, "response", None)
+        if getattr(response, "status_code", None) in RATE_LIMIT_STATUS_CODES:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+class TokenBucket:
+    """
+    Потокобезопасное ведро токенов с адаптивной скоростью.
+
+    Каждый запрос резервирует токен; если токенов нет, вызывающий ждёт своей очереди.
+    При 429 скорость падает вдвое (но не ниже min_rate) и ведро закрывается на время
+    паузы, которая удваивается при повторных 429 подряд. Успешные запросы понемногу
+    возвращают скорость к максимальной (AIMD). Скорость и пауза сохраняются в базе
+    и переживают перезапуск.
+
+    Общее ведро (shared=True) целиком хранится в базе и меняется в транзакции при каждом
+    запросе: его делят все процессы на машине (бот, worker.py, процессы вебхука),
+    так что лишний процесс не добавляет запросов к Instagram.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: float, shared: bool = False):
+        """
+        :param name: имя ведра (ключ состояния в базе).
+        :param rate: максимальная скорость, запросов в секунду.
+        :param capacity: размер всплеска — сколько запросов можно сделать подряд без ожидания.
+        :param shared: делить ведро с другими процессами через базу.
+        """
+        self.name = name
+        self.max_rate = rate
+        self.min_rate = rate * LIMITER_MIN_RATE
+        self.capacity = capacity
+        self.shared = shared
+        self.rate = rate
+        self.tokens = capacity
+        self.backoff = LIMITER_BACKOFF
+        self.blocked_until = 0.0  # время (time.time()), до которого запросы не выполняются
+        self._updated_at = time.time()
+        self._lock = threading.Lock()
+
+    def restore(self) -> None:
+        """
+        Восстанавливает скорость и паузу, сохранённые до перезапуска.
+        """
+        state = get_limiter_state(self.name)
+        if state is None:
+            return
+        rate, backoff, blocked_until = state
+        with self._lock:
+            if rate is not None:
+                self.rate = min(max(rate, self.min_rate), self.max_rate)
+            self.backoff = backoff or LIMITER_BACKOFF
+            self.blocked_until = blocked_until or 0.0
+        if self.blocked_until > time.time():
+            logging.warning(f"Лимитер {self.name}: пауза до перезапуска ещё действует.")
+
+    def _save(self) -> None:
+        if self.shared:
+            # Общее ведро сохраняется вместе с каждым изменением (_locked)
+            return
+        try:
+            save_limiter_state(self.name, self.rate, self.backoff, self.blocked_until)
+        except Exception as e:
+            logging.error(f"Не удалось сохранить состояние лимитера {self.name}: {e}")
+
+    def _load_state(self, state: dict) -> None:
+        if not state:
+            return
+        if state["rate"] is not None:
+            self.rate = min(max(state["rate"], self.min_rate), self.max_rate)
+        self.backoff = state["backoff"] or LIMITER_BACKOFF
+        self.blocked_until = state["blocked_until"] or 0.0
+        if state["tokens"] is not None and state["updated_at"] is not None:
+            self.tokens = state["tokens"]
+            self._updated_at = state["updated_at"]
+
+    def _locked(self, operation):
+        """
+        Выполняет operation() над состоянием ведра под блокировкой;
+        для общего ведра — внутри транзакции над его состоянием в базе.
+        """
+        with self._lock:
+            if not self.shared:
+                return operation()
+
+            def update(state: dict):
+                self._load_state(state)
+                result = operation()
+                state.update(
+                    rate=self.rate, backoff=self.backoff, blocked_until=self.blocked_until,
+                    tokens=self.tokens, updated_at=self._updated_at
+                )
+                return result
+
+            try:
+                return update_limiter_state(self.name, update)
+            except sqlite3.Error as e:
+                # База недоступна — ведро этого процесса работает само по себе
+                logging.error(f"Не удалось обновить общее состояние лимитера {self.name}: {e}")
+                return operation()
+
+    def reserve(self, max_wait: float = None) -> float:
+        """
+        Резервирует один токен и возвращает, сколько секунд нужно подождать перед запросом.
+        Если ждать пришлось бы дольше max_wait (например, ведро закрыто после 429),
+        токен не резервируется и поднимается RateLimitedError.
+        """
+        def operation():
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + max(now - self._updated_at, 0) * self.rate)
+            self._updated_at = now
+            tokens = self.tokens - 1
+            delay = 0.0 if tokens >= 0 else -tokens / self.rate
+            delay = max(delay, self.blocked_until - now)
+            if max_wait is not None and delay > max_wait:
+                raise RateLimitedError(f"Лимитер {self.name}: запросы приостановлены ещё на {delay:.0f} c.")
+            self.tokens = tokens
+            return delay
+
+        return self._locked(operation)
+
+    def acquire(self, max_wait: float = None) -> None:
+        """
+        Ждёт разрешения на запрос (для рабочих потоков).
+        :param max_wait: не ждать дольше стольких секунд — сразу поднять RateLimitedError.
+        """
+        delay = self.reserve(max_wait)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        """
+        Ждёт разрешения на запрос, не блокируя event loop.
+        Общее ведро резервирует токен в потоке: транзакция в базе может ждать другие процессы.
+        """
+        delay = await asyncio.to_thread(self.reserve) if self.shared else self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def success(self) -> None:
+        """
+        Запрос прошёл: скорость понемногу возвращается к максимальной.
+        """
+        if self.rate >= self.max_rate and self.backoff == LIMITER_BACKOFF:
+            return
+
+        def operation():
+            if self.rate >= self.max_rate and self.backoff == LIMITER_BACKOFF:
+                return False
+            self.rate = min(self.max_rate, self.rate + self.max_rate * LIMITER_RECOVERY)
+            self.backoff = LIMITER_BACKOFF
+            return self.rate >= self.max_rate
+
+        if self._locked(operation):
+            logging.info(f"Лимитер {self.name}: скорость восстановлена.")
+            self._save()
+
+    def penalize(self, retry_after: float = None) -> float:
+        """
+        Instagram ответил 429: снижает скорость и закрывает ведро на паузу.
+        retry_after — пауза, которую назвал сервер (если назвал).
+        Возвращает длительность паузы в секундах.
+        """
+        def operation():
+            self.rate = max(self.min_rate, self.rate / 2)
+            pause = retry_after if retry_after else self.backoff
+            self.backoff = min(LIMITER_MAX_BACKOFF, self.backoff * 2)
+            self.blocked_until = max(self.blocked_until, time.time() + pause)
+            self.tokens = min(self.tokens, 0)
+            return pause
+
+        pause = self._locked(operation)
+        logging.warning(
+            f"Лимитер {self.name}: ограничение скорости, пауза {pause:.1f} c, "
+            f"скорость {self.rate:.2f} запр./с."
+        )
+        self._save()
+        return pause
+
+
+# Лимитеры запросов к API Instagram и скачивания медиа с CDN — общие для всех процессов машины
+graphql_limiter = TokenBucket("graphql", GRAPHQL_RATE, GRAPHQL_BURST, shared=True)
+cdn_limiter = TokenBucket("cdn", CDN_RATE, CDN_BURST, shared=True)
+
+
+# Запросы к Instagram, начатые каждым потоком: счётчик и время начала последнего
+# (после всех ожиданий лимитеров) — по ним замеряется время загрузки страниц ленты
+_query_log = threading.local()
+
+
+def last_query() -> tuple:
+    """
+    (сколько запросов к Instagram начал этот поток, time.perf_counter() начала последнего из них).
+    """
+    return getattr(_query_log, "count", 0), getattr(_query_log, "started", None)
+
+
+class LimitedRateController(RateController):
+    """
+    RateController для Instaloader: перед каждым запросом к Instagram берёт токен
+    из общего graphql_limiter (поверх собственных окон Instaloader для одной сессии).
+    Если токена пришлось бы ждать дольше GRAPHQL_MAX_WAIT (ведро закрыто после 429),
+    запрос сразу прерывается RateLimitedError: поток и арендованная сессия не простаивают.
+    На 429 не спит внутри арендованной сессии, а снижает общую скорость
+    и прерывает запрос исключением RateLimitedError.
+    Заодно считает запросы каждой сессии (метрика instagram_requests_total)
+    и отмечает начало каждого запроса для потока (last_query).
+    """
+
+    def wait_before_query(self, query_type: str) -> None:
+        graphql_limiter.acquire(GRAPHQL_MAX_WAIT)
+        super().wait_before_query(query_type)
+        instagram_requests_total.inc(session=self._context.username or "anonymous", query_type=query_type)
+        _query_log.count = getattr(_query_log, "count", 0) + 1
+        _query_log.started = time.perf_counter()
+
+    def handle_429(self, query_type: str) -> None:
+        graphql_limiter.penalize()
+        raise RateLimitedError(f"Instagram ограничил частоту запросов ({query_type}).")
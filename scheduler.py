@@ -1,69 +1,433 @@
+import os
+import time
+import uuid
+import random
+import socket
 import asyncio
 import logging
-from datetime import datetime
-from database import get_subscriptions, update_last_sent_post_id
-from instagram_parser import get_new_posts, get_stories
+from datetime import datetime, timezone
+from async_db import (
+    get_subscriptions_grouped, update_high_water_marks,
+    get_seen_story_ids, mark_stories_seen, purge_seen_stories,
+    sync_poll_jobs, claim_poll_jobs, extend_poll_job_leases,
+    complete_poll_jobs, release_poll_jobs, get_next_poll_job_at
+)
+from async_instagram import (
+    fetch_new_posts, fetch_story_items, download_post, download_story_items, release_files
+)
+from instagram_parser import INSTAGRAM_BUSY_ERRORS
+from telegram_files import story_media_items
+from outbox import enqueue, text_message, media_messages
+from metrics import scheduler_cycle_seconds, scheduler_cycle_subscriptions, scheduler_queue_depth
+from config.config import (
+    SCHEDULER_FETCH_WORKERS, SCHEDULER_DOWNLOAD_WORKERS,
+    SCHEDULER_DELIVERY_WORKERS, SCHEDULER_QUEUE_SIZE,
+    SCHEDULER_MIN_INTERVAL, SCHEDULER_MAX_INTERVAL, SCHEDULER_INITIAL_INTERVAL,
+    SCHEDULER_BACKOFF, SCHEDULER_JITTER, SCHEDULER_BATCH_SIZE, SCHEDULER_TICK, POLL_LEASE_TIME
+)
 from aiogram import Bot
 
-async def check_updates(bot: Bot, user_id=None, username=None, action=None):
+def _is_newer(post_id: str, last_sent_post_id: str) -> bool:
+    """
+    Сравнивает mediaid как числа (строки разной длины сравниваются неверно).
+    """
+    return last_sent_post_id is None or int(post_id) > int(last_sent_post_id)
+
+def _oldest_last_sent_post_id(subscribers: list):
+    """
+    Возвращает самый старый last_sent_post_id среди подписчиков аккаунта,
+    чтобы одного запроса хватило всем. None, если хотя бы один подписчик ещё ничего не получал.
+    """
+    post_ids = [last_sent_post_id for _, last_sent_post_id, _ in subscribers]
+    if any(post_id is None for post_id in post_ids):
+        return None
+    return min(post_ids, key=int)
+
+def _common_mediacount(subscribers: list):
+    """
+    Возвращает last_seen_mediacount, если он одинаков у всех подписчиков аккаунта.
+    Только тогда неизменное число публикаций означает, что читать ленту не нужно.
+    """
+    counts = {last_seen_mediacount for _, _, last_seen_mediacount in subscribers}
+    return counts.pop() if len(counts) == 1 else None
+
+def _high_water_marks(grouped: dict, newest_seen: dict, probed: dict, pending: dict) -> list:
+    """
+    Новые отметки уровня подписок по итогам цикла: [(telegram_user_id, insta_username,
+    last_sent_post_id или None, last_seen_mediacount или None), ...] для update_high_water_marks.
+    Отметка — самый новый пост ленты, даже если отправлять было нечего (новая подписка сразу
+    получает отметку и дальше читает ленту инкрементально). Если какой-то пост не удалось
+    поставить в очередь, отметка остаётся ниже самого старого из них, а mediacount не обновляется,
+    чтобы в следующем цикле этот пост был прочитан и отправлен снова.
+    """
+    updates = []
+    for insta_username, subscribers in grouped.items():
+        for telegram_user_id, last_sent_post_id, _ in subscribers:
+            mark = newest_seen.get(insta_username)
+            undelivered = pending.get((telegram_user_id, insta_username))
+            if undelivered:
+                cap = min(undelivered) - 1
+                mark = cap if mark is None else min(mark, cap)
+            if mark is not None and not _is_newer(str(mark), last_sent_post_id):
+                mark = None
+            mediacount = None if undelivered else probed.get(insta_username)
+            if mark is not None or mediacount is not None:
+                updates.append((telegram_user_id, insta_username, mark, mediacount))
+    return updates
+
+def _story_expires_at(item) -> float:
+    """
+    Момент (timestamp), когда история исчезнет из Instagram: до него её запись хранится в журнале.
+    """
+    return item.expiring_utc.replace(tzinfo=timezone.utc).timestamp()
+
+async def _run_stage(name: str, queue: asyncio.Queue, handler):
+    """
+    Воркер стадии конвейера: берёт задания из очереди и обрабатывает их.
+    Ошибка в одном задании не останавливает остальные.
+    """
+    while True:
+        job = await queue.get()
+        scheduler_queue_depth.set(queue.qsize(), stage=name)
+        try:
+            await handler(job)
+        except Exception as e:
+            logging.error(f"Ошибка на стадии {name}: {e}")
+        finally:
+            queue.task_done()
+
+def _post_messages(chat_id: int, insta_username: str, post: dict) -> list:
+    """
+    Сообщения исходящей очереди для публикации: медиагруппы (по 10 элементов), подпись — у первой.
+    Если медиа скачать не удалось, отправляется только текст со ссылкой.
+    """
+    caption = (
+        f"Новый пост от {insta_username}:\n"
+        f"{post['url']}\n"
+        f"👍 Лайков: {post['likes']} 📝 Комментариев: {post['comments']}"
+    )
+    if not post["media"]:
+        return [text_message(chat_id, caption)]
+
+    for media in post["media"]:
+        media.setdefault("name", f"{insta_username}_{media['media_id']}_{media['node_index']}")
+    # Медиа загружается в Telegram один раз: диспетчер придерживает остальных подписчиков
+    # до первой загрузки и отправляет им медиа по её file_id
+    return media_messages(chat_id, post["media"], caption=caption)
+
+def _story_messages(chat_id: int, insta_username: str, items: list) -> list:
+    """
+    Сообщения исходящей очереди для историй профиля (медиагруппами).
+    """
+    return media_messages(chat_id, items, caption=f"Новая история от {insta_username}")
+
+async def check_updates(bot: Bot, user_id=None, username=None, action=None, usernames=None) -> dict:
     """
     Проверяет новые публикации и истории для всех подписок или конкретного пользователя.
+    Каждый профиль Instagram запрашивается один раз за цикл,
+    результат рассылается всем его подписчикам.
+    Истории, уже доставленные подписчику (журнал seen_stories), не скачиваются и не отправляются повторно.
+    Лента читается инкрементально: если число публикаций профиля не изменилось
+    с прошлой проверки, она не читается вовсе, иначе — только до отметки уровня подписчиков.
+
+    Цикл разбит на конвейер из трёх стадий: получение профиля -> скачивание медиа ->
+    постановка сообщений в исходящую очередь (отправляет их диспетчер outbox).
+    В режиме MEDIA_STREAMING стадия скачивания только готовит ссылки на CDN,
+    а байты идут в Telegram потоково при отправке.
+    Стадии связаны ограниченными очередями (SCHEDULER_QUEUE_SIZE), поэтому скачивание
+    не убегает вперёд отправки. Блокирующая работа Instaloader выполняется в пуле async_instagram,
+    так что бот продолжает отвечать пользователям во время цикла.
+    Задание стадий — все новые посты одного профиля: скачиваются они параллельно,
+    а в исходящую очередь попадают одной транзакцией в хронологическом порядке.
     :param bot: экземпляр бота.
     :param user_id: ID пользователя Telegram (опционально).
     :param username: Никнейм Instagram (опционально).
     :param action: Действие ("story" или "post").
+    :param usernames: проверить только эти аккаунты Instagram (опционально).
+    :return: активность проверенных профилей {insta_username: (число нового контента,
+             время исчезновения ближайшей активной истории или None)}; None вместо активности —
+             Instagram был недоступен (ограничение скорости, нет свободной сессии), профиль не проверен.
     """
     logging.info(f"{datetime.now()} - Проверка обновлений...")
+    started = time.perf_counter()
 
     if user_id and username:
         # Если указан конкретный пользователь и действие
-        subscriptions = [(user_id, username, None)]
+        grouped = {username: [(user_id, None, None)]}
     else:
         # Если проверяем все подписки
-        subscriptions = get_subscriptions()
+        grouped = await get_subscriptions_grouped()
+        if usernames is not None:
+            grouped = {
+                insta_username: subscribers for insta_username, subscribers in grouped.items()
+                if insta_username in usernames
+            }
 
-    for subscription in subscriptions:
-        telegram_user_id, insta_username, last_sent_post_id = subscription
+    fetch_queue = asyncio.Queue()
+    download_queue = asyncio.Queue(maxsize=SCHEDULER_QUEUE_SIZE)
+    delivery_queue = asyncio.Queue(maxsize=SCHEDULER_QUEUE_SIZE)
+    # {insta_username: mediaid самого нового поста ленты на момент проверки}
+    newest_seen = {}
+    # {insta_username: mediacount профиля на момент проверки}
+    probed = {}
+    # {(telegram_user_id, insta_username): {mediaid постов, ещё не поставленных в исходящую очередь}}
+    pending = {}
+    # {mediaid истории: когда она исчезнет} и записи для журнала доставленных историй
+    story_expires_at = {}
+    seen_stories = []
+    # {insta_username: [число нового контента, ближайшее исчезновение истории]}
+    activity = {}
 
-        if action == "post" or action is None:
-            # Проверяем новые публикации
-            new_posts = get_new_posts(insta_username, last_sent_post_id)
-            if new_posts:
-                for post in new_posts:
-                    await bot.send_message(
-                        chat_id=telegram_user_id,
-                        text=(
-                            f"Новый пост от {insta_username}:\n"
-                            f"{post['url']}\n"
-                            f"👍 Лайков: {post['likes']} 📝 Комментариев: {post['comments']}"
-                        )
-                    )
+    purged = await purge_seen_stories()
+    if purged:
+        logging.info(f"Удалено записей об истёкших историях: {purged}")
 
-                # Обновляем last_sent_post_id
-                last_post_id = new_posts[-1]["id"]
-                update_last_sent_post_id(telegram_user_id, insta_username, last_post_id)
+    async def fetch_profile(job):
+        insta_username, subscribers = job
+        activity.setdefault(insta_username, [0, None])
+        try:
+            await fetch_updates(insta_username, subscribers)
+        except INSTAGRAM_BUSY_ERRORS as e:
+            # Профиль не проверен — это не «нового нет»
+            logging.warning(f"Проверка {insta_username} отложена: {e}")
+            activity[insta_username] = None
+
+    async def fetch_updates(insta_username, subscribers):
+        profile_activity = activity[insta_username]
+        if action == "post" or action is None:
+            posts, mediacount, newest_post_id = await fetch_new_posts(
+                insta_username, _oldest_last_sent_post_id(subscribers), _common_mediacount(subscribers)
+            )
+            if mediacount is not None:
+                probed[insta_username] = mediacount
+            if newest_post_id is not None:
+                newest_seen[insta_username] = newest_post_id
+            profile_activity[0] += len(posts)
+            # Лента идёт от новых к старым; отправляем в хронологическом порядке.
+            # Все новые посты профиля — одно задание, чтобы они попали в очередь по порядку
+            jobs = []
+            for post in reversed(posts):
+                recipients = [
+                    telegram_user_id for telegram_user_id, last_sent_post_id, _ in subscribers
+                    if _is_newer(str(post.mediaid), last_sent_post_id)
+                ]
+                if recipients:
+                    for telegram_user_id in recipients:
+                        pending.setdefault((telegram_user_id, insta_username), set()).add(post.mediaid)
+                    jobs.append((post, recipients))
+            if jobs:
+                await download_queue.put(("posts", insta_username, jobs))
 
         if action == "story" or action is None:
-            # Проверяем новые истории
-            stories = get_stories(insta_username)
-            if stories:
-                for story in stories:
-                    await bot.send_photo(
-                        chat_id=telegram_user_id,
-                        photo=story['url'],
-                        caption=f"Новая история от {insta_username}"
+            items = await fetch_story_items(insta_username)
+            if items:
+                profile_activity[1] = min(_story_expires_at(item) for item in items)
+                seen = await get_seen_story_ids(insta_username)
+                # {telegram_user_id: {mediaid историй, которых он ещё не получал}}
+                recipients = {}
+                for telegram_user_id, _, _ in subscribers:
+                    unseen = {item.mediaid for item in items} - seen.get(telegram_user_id, set())
+                    if unseen:
+                        recipients[telegram_user_id] = unseen
+                # Скачиваем только истории, которые ещё хоть кому-то не отправлялись
+                wanted = set().union(*recipients.values())
+                items = [item for item in items if item.mediaid in wanted]
+                for item in items:
+                    story_expires_at[item.mediaid] = _story_expires_at(item)
+                profile_activity[0] += len(items)
+                if items:
+                    # Все новые истории профиля — одно задание, чтобы отправить их медиагруппой
+                    await download_queue.put(("stories", insta_username, (items, recipients)))
+
+    async def download_media(job):
+        kind, insta_username, payload = job
+        if kind == "posts":
+            # Посты профиля скачиваются параллельно, но дальше идут в хронологическом порядке
+            results = await asyncio.gather(
+                *(download_post(post, insta_username) for post, _ in payload), return_exceptions=True
+            )
+            downloaded = []
+            for (post, recipients), result in zip(payload, results):
+                if isinstance(result, Exception):
+                    # Пост остаётся в pending и будет отправлен в следующем цикле
+                    logging.error(f"Не удалось скачать пост {post.mediaid} ({insta_username}): {result}")
+                    continue
+                downloaded.append((result, recipients))
+            if downloaded:
+                await delivery_queue.put((kind, insta_username, downloaded))
+        else:
+            items, recipients = payload
+            stories = await download_story_items(items, insta_username)
+            data = story_media_items(insta_username, stories)
+            if data:
+                await delivery_queue.put((kind, insta_username, [(data, recipients)]))
+
+    async def deliver(job):
+        kind, insta_username, batches = job
+        messages = []
+        for data, recipients in batches:
+            for telegram_user_id in recipients:
+                if kind == "posts":
+                    messages.extend(_post_messages(telegram_user_id, insta_username, data))
+                else:
+                    items = [item for item in data if item["media_id"] in recipients[telegram_user_id]]
+                    if items:
+                        messages.extend(_story_messages(telegram_user_id, insta_username, items))
+
+        try:
+            # Отправку выполняет диспетчер исходящей очереди; файлы медиакэша теперь держат её сообщения.
+            # Сообщения профиля ставятся одной транзакцией, в хронологическом порядке
+            await enqueue(messages)
+        except Exception as e:
+            logging.error(f"Не удалось поставить в очередь рассылку {insta_username}: {e}")
+            return
+        finally:
+            for data, _ in batches:
+                release_files(media.get("file_path") for media in (data["media"] if kind == "posts" else data))
+
+        # Сообщение в очереди будет доставлено (с повторами), поэтому пост больше не ждёт доставки
+        for data, recipients in batches:
+            for telegram_user_id in recipients:
+                if kind == "posts":
+                    pending[(telegram_user_id, insta_username)].discard(int(data["id"]))
+                else:
+                    seen_stories.extend(
+                        (telegram_user_id, insta_username, media_id, story_expires_at[media_id])
+                        for media_id in recipients[telegram_user_id]
+                        if any(item["media_id"] == media_id for item in data)
                     )
 
+    workers = (
+        [asyncio.create_task(_run_stage("fetch", fetch_queue, fetch_profile))
+         for _ in range(SCHEDULER_FETCH_WORKERS)]
+        + [asyncio.create_task(_run_stage("download", download_queue, download_media))
+           for _ in range(SCHEDULER_DOWNLOAD_WORKERS)]
+        + [asyncio.create_task(_run_stage("delivery", delivery_queue, deliver))
+           for _ in range(SCHEDULER_DELIVERY_WORKERS)]
+    )
+    try:
+        for job in grouped.items():
+            fetch_queue.put_nowait(job)
+        # Стадии завершаются по порядку: следующая очередь пополняется только предыдущей
+        await fetch_queue.join()
+        await download_queue.join()
+        await delivery_queue.join()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        # Отметки уровня всех подписок — одной транзакцией
+        await update_high_water_marks(_high_water_marks(grouped, newest_seen, probed, pending))
+        await mark_stories_seen(seen_stories)
+
+    scheduler_cycle_seconds.observe(time.perf_counter() - started)
+    scheduler_cycle_subscriptions.observe(sum(len(subscribers) for subscribers in grouped.values()))
     logging.info(f"{datetime.now()} - Обновления проверены.")
+    return {
+        insta_username: None if profile_activity is None else tuple(profile_activity)
+        for insta_username, profile_activity in activity.items()
+    }
 
-async def start_scheduler(bot: Bot):
+def _next_check(check_interval: float, new_items: int, nearest_story_expiry, now: float):
     """
-    Запускает планировщик задач, который выполняется каждые 24 часа.
-    :param bot: экземпляр бота.
+    Новый интервал и время следующей проверки профиля.
+    Нашёлся новый контент — интервал вдвое короче, нет — длиннее в SCHEDULER_BACKOFF раз
+    (в пределах SCHEDULER_MIN_INTERVAL..SCHEDULER_MAX_INTERVAL). Джиттер разносит проверки
+    по времени. Если у профиля есть активные истории, следующая проверка — не позже
+    исчезновения ближайшей из них: активный автор историй проверяется чаще.
+    """
+    if new_items:
+        check_interval = max(SCHEDULER_MIN_INTERVAL, check_interval / 2)
+    else:
+        check_interval = min(SCHEDULER_MAX_INTERVAL, check_interval * SCHEDULER_BACKOFF)
+    delay = check_interval * random.uniform(1 - SCHEDULER_JITTER, 1 + SCHEDULER_JITTER)
+    if nearest_story_expiry is not None:
+        delay = min(delay, nearest_story_expiry - now)
+    delay = min(max(delay, SCHEDULER_MIN_INTERVAL), SCHEDULER_MAX_INTERVAL)
+    return check_interval, now + delay
+
+def _worker_id() -> str:
+    """
+    Уникальное имя воркера для аренды заданий: хост, процесс и случайный суффикс.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+async def _keep_leases(owner: str, usernames: list):
+    """
+    Продлевает аренду заданий, пока идёт их проверка (heartbeat).
     """
     while True:
+        await asyncio.sleep(POLL_LEASE_TIME / 3)
         try:
-            await check_updates(bot)
+            await extend_poll_job_leases(owner, usernames, POLL_LEASE_TIME)
+        except Exception as e:
+            logging.error(f"Не удалось продлить аренду заданий: {e}")
+
+async def _process_jobs(bot: Bot, owner: str, jobs: list):
+    """
+    Проверяет арендованные профили одним проходом конвейера и планирует их следующие проверки.
+    Если проход упал или Instagram был недоступен для профиля, задание возвращается в очередь
+    с экспоненциальной задержкой по числу попыток, а интервал проверок профиля не меняется.
+    """
+    usernames = [insta_username for insta_username, _, _ in jobs]
+    heartbeat = asyncio.create_task(_keep_leases(owner, usernames))
+    try:
+        activity = await check_updates(bot, usernames=set(usernames))
+    except Exception as e:
+        logging.error(f"Ошибка проверки профилей {', '.join(usernames)}: {e}")
+        activity = None
+    finally:
+        heartbeat.cancel()
+
+    now = time.time()
+    failed = jobs if activity is None else [job for job in jobs if activity.get(job[0], (0, None)) is None]
+    await release_poll_jobs(owner, [
+        (insta_username, now + min(SCHEDULER_MAX_INTERVAL, SCHEDULER_MIN_INTERVAL * 2 ** (attempts - 1)))
+        for insta_username, _, attempts in failed
+    ])
+    if activity is None:
+        return
+    await complete_poll_jobs(owner, [
+        (insta_username, *_next_check(check_interval, *activity.get(insta_username, (0, None)), now))
+        for insta_username, check_interval, _ in jobs
+        if activity.get(insta_username, (0, None)) is not None
+    ])
+
+async def run_worker(bot: Bot, owner: str = None):
+    """
+    Воркер проверок: арендует подошедшие по времени профили в таблице заданий poll_schedule
+    и проверяет их (см. _next_check). Задания упорядочены по времени следующей проверки,
+    так что проверки распределены по времени, а не идут раз в сутки одной пачкой.
+
+    Воркеров может быть несколько (в процессе бота и в отдельных процессах worker.py) —
+    только на одной машине: SQLite в режиме WAL нельзя держать на сетевой файловой системе.
+    Профиль арендует один воркер, аренда продлевается, пока идёт проверка, и истекает,
+    если воркер упал, — тогда задание подберёт другой воркер. Лимитеры запросов к Instagram
+    и предохранители сессий общие для всех процессов (через базу), поэтому новый воркер
+    ускоряет проверки, только пока упирается не в GRAPHQL_RATE.
+    :param bot: экземпляр бота (для рассылки).
+    :param owner: имя воркера в таблице заданий (по умолчанию — хост, PID и случайный суффикс).
+    """
+    owner = owner or _worker_id()
+    logging.info(f"Воркер проверок {owner} запущен.")
+    synced_at = 0.0
+    while True:
+        next_check_at = None
+        try:
+            # Новые подписки попадают в таблицу заданий не реже раза в SCHEDULER_TICK
+            if time.monotonic() - synced_at >= SCHEDULER_TICK:
+                await sync_poll_jobs(SCHEDULER_INITIAL_INTERVAL)
+                synced_at = time.monotonic()
+            jobs = await claim_poll_jobs(
+                owner, SCHEDULER_BATCH_SIZE, POLL_LEASE_TIME, SCHEDULER_MIN_INTERVAL, SCHEDULER_MAX_INTERVAL
+            )
+            if jobs:
+                await _process_jobs(bot, owner, jobs)
+                continue
+            next_check_at = await get_next_poll_job_at()
         except Exception as e:
             logging.error(f"Ошибка в планировщике: {e}")
-        await asyncio.sleep(86400)  # 24 часа
+
+        delay = SCHEDULER_TICK if next_check_at is None else next_check_at - time.time()
+        await asyncio.sleep(min(max(delay, 0), SCHEDULER_TICK))
@@ -0,0 +1,278 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+import instaloader
+
+SESSION_FILE_PREFIX = "session-"
+
+
+class NoSessionAvailableError(Exception):
+    """
+    В пуле нет ни одной рабочей сессии Instagram.
+    """
+
+
+class InstaSession:
+    """
+    Одна сессия Instagram: собственный экземпляр Instaloader и счётчики нагрузки.
+    """
+
+    def __init__(self, username: str, session_file: str, loader: instaloader.Instaloader = None):
+        self.username = username
+        self.session_file = session_file
+        self.loader = loader or instaloader.Instaloader()
+        self.healthy = True
+        self.in_use = False
+        self.requests_in_window = 0
+        self.window_started_at = time.monotonic()
+        self.cooldown_until = 0.0
+        self.last_relogin_at = None
+        # Предохранитель: пауза, которую получит сессия при следующем ограничении скорости
+        # (None — предохранитель замкнут, сессия работает штатно)
+        self.breaker_backoff = None
+        # Счётчик переавторизаций: по нему видно, что сессию уже обновил другой поток
+        self.generation = 0
+        self.relogin_lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<InstaSession {self.username}>"
+
+
+class SessionPool:
+    """
+    Пул сессий Instaloader из папки sessions/.
+
+    Каждый запрос арендует (lease) одну свободную рабочую сессию. У сессии есть бюджет
+    запросов на окно времени и пауза (cooldown) после ошибок. При истёкшей авторизации
+    переавторизуется только упавшая сессия — один раз и одним потоком.
+    Если Instagram ограничил сессию (429, «please wait»), срабатывает её предохранитель:
+    сессия выводится из ротации на паузу, которая удваивается при повторных срабатываниях
+    и сбрасывается после первого успешного запроса.
+    """
+
+    def __init__(
+        self,
+        session_folder: str,
+        request_budget: int = 200,
+        budget_window: float = 3600,
+        cooldown: float = 600,
+        credentials: dict = None,
+        max_cooldown: float = 6 * 3600,
+        loader_factory=None
+    ):
+        """
+        :param session_folder: папка с файлами session-<username>.
+        :param request_budget: сколько аренд разрешено одной сессии за budget_window секунд.
+        :param budget_window: длина окна бюджета в секундах.
+        :param cooldown: пауза в секундах для сессии после ошибки/неудачной переавторизации.
+        :param credentials: {username: password} для аккаунтов, которые можно перелогинить паролем.
+        :param max_cooldown: предельная пауза сессии после повторных срабатываний предохранителя.
+        :param loader_factory: функция без аргументов, создающая instaloader.Instaloader для сессии.
+        """
+        self.session_folder = session_folder
+        self.request_budget = request_budget
+        self.budget_window = budget_window
+        self.cooldown = cooldown
+        self.credentials = credentials or {}
+        self.max_cooldown = max_cooldown
+        self.loader_factory = loader_factory or instaloader.Instaloader
+        self.sessions = []
+        self._condition = threading.Condition()
+
+    def load(self) -> int:
+        """
+        Загружает все файлы session-* из папки сессий.
+        Возвращает количество успешно загруженных сессий.
+        """
+        loaded_usernames = {session.username for session in self.sessions}
+        for filename in sorted(os.listdir(self.session_folder)):
+            if not filename.startswith(SESSION_FILE_PREFIX):
+                continue
+            username = filename[len(SESSION_FILE_PREFIX):]
+            if username in loaded_usernames:
+                continue
+            session_file = os.path.join(self.session_folder, filename)
+            session = InstaSession(username, session_file, self.loader_factory())
+            try:
+                session.loader.load_session_from_file(username, filename=session_file)
+                logging.info(f"Сессия загружена из файла: {session_file}")
+            except Exception as e:
+                logging.warning(f"Не удалось загрузить сессию ({session_file}): {e}")
+                continue
+            self.add(session)
+        return len(self.sessions)
+
+    def add(self, session: InstaSession) -> None:
+        """
+        Добавляет сессию в пул (например, после авторизации по логину/паролю).
+        """
+        with self._condition:
+            self.sessions = [s for s in self.sessions if s.username != session.username]
+            self.sessions.append(session)
+            self._condition.notify_all()
+
+    def _refresh_budget(self, session: InstaSession, now: float) -> None:
+        if now - session.window_started_at >= self.budget_window:
+            session.window_started_at = now
+            session.requests_in_window = 0
+
+    def _pick(self, now: float, username: str = None):
+        """
+        Выбирает свободную рабочую сессию с наименьшей нагрузкой
+        (или конкретную сессию username, если она указана).
+        Возвращает (сессия, None) или (None, через сколько секунд стоит попробовать снова).
+        """
+        candidates = []
+        wait_times = []
+        for session in self.sessions:
+            if not session.healthy:
+                continue
+            if username is not None and session.username != username:
+                continue
+            self._refresh_budget(session, now)
+            if session.in_use:
+                continue
+            if session.cooldown_until > now:
+                wait_times.append(session.cooldown_until - now)
+                continue
+            if session.requests_in_window >= self.request_budget:
+                wait_times.append(session.window_started_at + self.budget_window - now)
+                continue
+            candidates.append(session)
+
+        if candidates:
+            return min(candidates, key=lambda s: s.requests_in_window), None
+        return None, (min(wait_times) if wait_times else None)
+
+    @contextmanager
+    def lease(self, timeout: float = None, username: str = None):
+        """
+        Арендует сессию на время одного запроса к Instagram.
+        Если все сессии заняты или исчерпали бюджет — ждёт освобождения.
+        :param timeout: ждать не дольше стольких секунд; если ближайшая сессия освободится
+                        от паузы или бюджета позже, NoSessionAvailableError поднимается сразу.
+        :param username: арендовать именно эту сессию (например, чтобы продолжить её курсор).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                matching = [
+                    session for session in self.sessions
+                    if session.healthy and (username is None or session.username == username)
+                ]
+                if not matching:
+                    raise NoSessionAvailableError("Нет доступных сессий Instagram.")
+                now = time.monotonic()
+                session, retry_in = self._pick(now, username)
+                if session:
+                    break
+                if deadline is not None:
+                    if now >= deadline:
+                        raise NoSessionAvailableError("Истекло ожидание свободной сессии Instagram.")
+                    # Занятая сессия может освободиться в любой момент, а паузу не переждать
+                    if (
+                        retry_in is not None and now + retry_in > deadline
+                        and not any(session.in_use for session in matching)
+                    ):
+                        raise NoSessionAvailableError(
+                            f"Все сессии Instagram на паузе ещё {retry_in:.0f} c."
+                        )
+                    retry_in = min(retry_in or deadline - now, deadline - now)
+                self._condition.wait(retry_in)
+
+            session.in_use = True
+            session.requests_in_window += 1
+
+        try:
+            yield session
+        finally:
+            with self._condition:
+                session.in_use = False
+                self._condition.notify_all()
+
+    def pause(self, session: InstaSession, seconds: float = None) -> None:
+        """
+        Временно выводит сессию из ротации.
+        """
+        with self._condition:
+            session.cooldown_until = time.monotonic() + (self.cooldown if seconds is None else seconds)
+            logging.warning(f"Сессия {session.username} на паузе до восстановления.")
+
+    def trip(self, session: InstaSession, seconds: float = None) -> float:
+        """
+        Размыкает предохранитель сессии после ограничения скорости со стороны Instagram.
+        Возвращает длительность паузы в секундах.
+        """
+        with self._condition:
+            pause = seconds or session.breaker_backoff or self.cooldown
+            session.breaker_backoff = min(self.max_cooldown, pause * 2)
+            session.cooldown_until = max(session.cooldown_until, time.monotonic() + pause)
+        logging.warning(f"Предохранитель сессии {session.username}: пауза {pause:.0f} c.")
+        return pause
+
+    def record_success(self, session: InstaSession) -> None:
+        """
+        Успешный запрос после паузы замыкает предохранитель сессии.
+        """
+        if session.breaker_backoff is not None:
+            with self._condition:
+                session.breaker_backoff = None
+            logging.info(f"Предохранитель сессии {session.username} сброшен.")
+
+    def reauthenticate(self, session: InstaSession, seen_generation: int = None) -> bool:
+        """
+        Переавторизует одну сессию (single-flight).
+        Если за время ожидания блокировки сессию уже обновил другой поток, повторно не логинится.
+        Если переавторизация недавно уже была, сессия уходит на паузу вместо нового логина.
+        Неудачная переавторизация тоже ставит сессию на паузу (cooldown), после которой
+        её можно переавторизовать снова; из пула сессия выводится только при неверном пароле.
+        Возвращает True, если сессия снова пригодна к работе.
+        """
+        if seen_generation is None:
+            seen_generation = session.generation
+
+        with session.relogin_lock:
+            if session.generation != seen_generation:
+                return session.healthy
+
+            now = time.monotonic()
+            if session.last_relogin_at is not None and now - session.last_relogin_at < self.cooldown:
+                self.pause(session)
+                return False
+            session.last_relogin_at = now
+
+            loader = self.loader_factory()
+            try:
+                password = self.credentials.get(session.username)
+                if password:
+                    loader.login(session.username, password)
+                    loader.save_session_to_file(filename=session.session_file)
+                else:
+                    # Пароля нет — перечитываем файл сессии (его могли обновить снаружи)
+                    loader.load_session_from_file(session.username, filename=session.session_file)
+                    if not loader.test_login():
+                        raise instaloader.exceptions.LoginRequiredException(
+                            f"Сессия {session.username} недействительна."
+                        )
+            except instaloader.exceptions.BadCredentialsException as e:
+                # Неверный пароль сам не исправится — сессия выводится из пула до перезапуска
+                logging.error(f"Не удалось переавторизовать сессию {session.username}: {e}")
+                with self._condition:
+                    session.healthy = False
+                    self._condition.notify_all()
+                return False
+            except Exception as e:
+                # Сеть, ограничение скорости, checkpoint: повторим после паузы
+                logging.error(f"Не удалось переавторизовать сессию {session.username}: {e}")
+                self.pause(session)
+                return False
+
+            with self._condition:
+                session.loader = loader
+                session.generation += 1
+                session.healthy = True
+                self._condition.notify_all()
+            logging.info(f"Сессия {session.username} переавторизована.")
+            return True
@@ -0,0 +1,198 @@
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from async_db import get_user_lang, save_user_langs, get_user_state, save_user_states
+from metrics import cache_lookup
+
+
+class ExpiringStore:
+    """
+    Ограниченное хранилище состояния пользователей {user_id: значение}.
+    Запись живёт ttl секунд с последнего обращения; при превышении max_size
+    вытесняются самые давно использованные записи (LRU). Память не растёт
+    вместе с числом пользователей, когда-либо писавших боту.
+    Интерфейс повторяет dict: get / pop / [] / in.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()  # {key: (expires_at, value)}
+
+    def _purge_expired(self, now: float) -> None:
+        # Записи упорядочены по последнему обращению: просроченные — в начале
+        while self._data:
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[key]
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        record = self._data.get(key)
+        if record is None:
+            return default
+        expires_at, value = record
+        if expires_at <= now:
+            del self._data[key]
+            return default
+        # Продлеваем жизнь записи при обращении
+        self._data[key] = (now + self.ttl, value)
+        self._data.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        now = time.monotonic()
+        self._data[key] = (now + self.ttl, value)
+        self._data.move_to_end(key)
+        self._purge_expired(now)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def pop(self, key, default=None):
+        record = self._data.pop(key, None)
+        if record is None or record[0] <= time.monotonic():
+            return default
+        return record[1]
+
+    def __len__(self):
+        self._purge_expired(time.monotonic())
+        return len(self._data)
+
+
+_MISSING = object()
+
+
+class SharedStore(ExpiringStore):
+    """
+    ExpiringStore, общее для нескольких процессов бота (вебхук с WEBHOOK_WORKERS > 1):
+    апдейты одного пользователя могут попасть в разные процессы. Перед обработкой апдейта
+    запись пользователя подгружается из таблицы user_state (load), а изменения после
+    обработки записываются туда же (flush). Значения должны сериализоваться в JSON;
+    срок жизни записи в базе отсчитывается от последнего изменения.
+    """
+
+    def __init__(self, name: str, ttl: float, max_size: int):
+        super().__init__(ttl, max_size)
+        self.name = name
+        self._dirty = {}  # {key: значение или None (запись удалена)}, ещё не записанные в базу
+
+    async def load(self, key) -> None:
+        """
+        Подгружает запись из базы: её могли изменить в другом процессе.
+        """
+        if key in self._dirty:
+            return
+        row = await get_user_state(self.name, key)
+        if row is None:
+            super().pop(key)
+            return
+        value, expires_at = row
+        self._data[key] = (time.monotonic() + expires_at - time.time(), json.loads(value))
+        self._data.move_to_end(key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._dirty[key] = value
+
+    def pop(self, key, default=None):
+        value = super().pop(key, default)
+        self._dirty[key] = None
+        return value
+
+    async def flush(self) -> None:
+        """
+        Записывает изменения в базу одной транзакцией.
+        """
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        expires_at = time.time() + self.ttl
+        try:
+            await save_user_states([
+                (self.name, key, None if value is None else json.dumps(value), expires_at)
+                for key, value in batch.items()
+            ])
+        except Exception as e:
+            logging.error(f"Не удалось сохранить состояние пользователей ({self.name}): {e}")
+            self._dirty = {**batch, **self._dirty}
+
+
+class LanguageStore:
+    """
+    Язык пользователей: LRU-кэш в памяти + отложенная запись (write-behind) в SQLite.
+    Перед обработкой апдейта язык подгружается из базы (load), дальше get/in работают
+    синхронно по кэшу. Изменения копятся в _dirty и сбрасываются пачкой (flush).
+    shared=True (несколько процессов бота): язык перечитывается из базы перед каждым
+    апдейтом, потому что его мог сменить другой процесс.
+    """
+
+    def __init__(self, max_size: int, shared: bool = False):
+        self.max_size = max_size
+        self.shared = shared
+        self._cache = OrderedDict()  # {user_id: lang или None (в базе нет)}
+        self._dirty = {}             # {user_id: lang}, ещё не записанные в базу
+
+    def _remember(self, user_id: int, lang) -> None:
+        self._cache[user_id] = lang
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    async def load(self, user_id: int) -> None:
+        """
+        Подгружает язык пользователя из базы, если его ещё нет в кэше.
+        """
+        if user_id in self._cache and not self.shared:
+            cache_lookup("user_lang", True)
+            self._cache.move_to_end(user_id)
+            return
+        if user_id in self._dirty:
+            cache_lookup("user_lang", True)
+            return
+        cache_lookup("user_lang", False)
+        self._remember(user_id, await get_user_lang(user_id))
+
+    def get(self, user_id: int, default=None):
+        lang = self._dirty.get(user_id) or self._cache.get(user_id)
+        return lang if lang is not None else default
+
+    def __contains__(self, user_id: int):
+        return self.get(user_id) is not None
+
+    def __setitem__(self, user_id: int, lang: str):
+        self._dirty[user_id] = lang
+        self._remember(user_id, lang)
+
+    async def flush(self) -> None:
+        """
+        Записывает накопленные изменения языка одной транзакцией.
+        """
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            await save_user_langs(list(batch.items()))
+        except Exception as e:
+            logging.error(f"Не удалось сохранить языки пользователей: {e}")
+            # Возвращаем несохранённое, не затирая более свежие изменения
+            self._dirty = {**batch, **self._dirty}
+
+    async def run_flusher(self, interval: float) -> None:
+        """
+        Периодически сбрасывает изменения в базу (запускается отдельной задачей).
+        """
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+from aiogram.types import FSInputFile, BufferedInputFile, URLInputFile, InputMediaPhoto, InputMediaVideo
+from async_db import save_file_id
+from downloader import fetch_bytes, content_length
+from rate_limiter import cdn_limiter
+from metrics import cache_lookup
+from instagram_parser import save_file_from_url
+from media_cache import lookup
+from config.config import STREAM_MAX_VIDEO_BYTES, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_TIMEOUT
+
+async def media_input(
+    media_type: str, file_id: str = None, file_path: str = None, source_url: str = None, name: str = "media",
+    media_id=None, node_index: int = 0, size: int = None
+):
+    """
+    Возвращает (что передать в send_photo/send_video, закреплённый путь в медиакэше или None):
+      - file_id Telegram, если медиа уже загружалось;
+      - локальный файл, если медиа уже скачано (file_path) или лежит в медиакэше;
+      - фото с CDN — буфер в памяти, без записи на диск;
+      - видео с CDN — потоковая передача чанками прямо в загрузку Telegram;
+        если видео больше STREAM_MAX_VIDEO_BYTES или размер неизвестен — скачивается в медиакэш
+        (size — размер видео, если он уже известен после выбора варианта).
+    Путь (второй элемент) вызывающая сторона отпускает после отправки (media_cache.release).
+    """
+    cache_lookup("file_id", bool(file_id))
+    if file_id:
+        return file_id, None
+    if file_path:
+        return FSInputFile(file_path), None
+
+    # Медиа, уже скачанное для другого получателя или проверки, берётся с диска
+    extension = "jpg" if media_type == "photo" else "mp4"
+    cached = await asyncio.to_thread(lookup, media_id, node_index, extension) if media_id is not None else None
+    if cached:
+        return FSInputFile(cached, filename=f"{name}.{extension}"), cached
+
+    if media_type == "photo":
+        data = await asyncio.to_thread(fetch_bytes, source_url)
+        if data is None:
+            raise RuntimeError(f"Не удалось скачать фото {source_url}")
+        return BufferedInputFile(data, filename=f"{name}.jpg"), None
+
+    if size is None:
+        size = await asyncio.to_thread(content_length, source_url)
+    if size is not None and size <= STREAM_MAX_VIDEO_BYTES:
+        # Видео с CDN забирает сам aiogram при отправке — токен лимитера берём заранее
+        await cdn_limiter.acquire_async()
+        return URLInputFile(
+            source_url, filename=f"{name}.mp4", chunk_size=DOWNLOAD_CHUNK_SIZE, timeout=int(DOWNLOAD_TIMEOUT)
+        ), None
+
+    # Большое видео: надёжнее через диск
+    logging.info(f"Видео {name} ({size} байт) скачивается на диск.")
+    downloaded = await asyncio.to_thread(save_file_from_url, source_url, media_id, node_index, extension)
+    if downloaded is None:
+        raise RuntimeError(f"Не удалось скачать видео {source_url}")
+    return FSInputFile(downloaded), downloaded
+
+def sent_file_id(message, media_type: str):
+    """
+    Достаёт file_id из ответа Telegram на отправку фото/видео.
+    """
+    if media_type == "photo" and message.photo:
+        # Последний PhotoSize — самый большой
+        return message.photo[-1].file_id
+    if media_type == "video" and message.video:
+        return message.video.file_id
+    return None
+
+async def remember_file_id(media_id, node_index: int, media_type: str, message):
+    """
+    Сохраняет file_id после первой загрузки медиа, чтобы следующие отправки
+    (любому пользователю) шли по file_id без скачивания и повторной загрузки.
+    Возвращает file_id или None.
+    """
+    file_id = sent_file_id(message, media_type)
+    if file_id and media_id is not None:
+        try:
+            await save_file_id(media_id, node_index, file_id, media_type)
+        except Exception as e:
+            logging.error(f"Не удалось сохранить file_id для {media_id}: {e}")
+    return file_id
+
+# Telegram принимает в одной медиагруппе от 2 до 10 элементов
+MEDIA_GROUP_LIMIT = 10
+
+def story_media_items(username: str, stories: list) -> list:
+    """
+    Преобразует истории (результат download_story_items) в элементы для send_media_batch.
+    """
+    return [
+        {
+            "media_type": story["type"],
+            "media_id": story["id"],
+            "node_index": 0,
+            "file_id": story.get("file_id"),
+            "file_path": story["url"],
+            "source_url": story.get("source_url"),
+            "size": story.get("size"),
+            "name": f"{username}_{story['id']}"
+        }
+        for story in stories
+        if story["url"] or story.get("file_id") or story.get("source_url")
+    ]
+
+async def send_media_batch(bot, chat_id: int, items: list, caption: str = None) -> list:
+    """
+    Отправляет несколько медиа группами (send_media_group) по MEDIA_GROUP_LIMIT штук,
+    подпись — у первого элемента. Одиночный остаток отправляется обычным send_photo/send_video.
+    items — список словарей с ключами media_type, media_id, node_index, name и одним из
+    file_id / file_path / source_url.
+    После отправки у элементов заполняется file_id (для следующих получателей), а если медиа
+    взято из медиакэша — file_path (вызывающая сторона отпускает его после рассылки).
+    Возвращает список отправленных сообщений.
+    """
+    messages = []
+    for start in range(0, len(items), MEDIA_GROUP_LIMIT):
+        chunk = items[start:start + MEDIA_GROUP_LIMIT]
+        chunk_caption = caption if start == 0 else None
+
+        # Медиа группы готовятся параллельно; закреплённые пути запоминаются и при ошибке
+        # соседнего элемента — вызывающая сторона всё равно должна их отпустить
+        resolved = await asyncio.gather(*(
+            media_input(
+                item["media_type"], item.get("file_id"), item.get("file_path"), item.get("source_url"),
+                name=item.get("name", "media"), media_id=item.get("media_id"), node_index=item.get("node_index", 0),
+                size=item.get("size")
+            )
+            for item in chunk
+        ), return_exceptions=True)
+        inputs = []
+        for item, result in zip(chunk, resolved):
+            if isinstance(result, BaseException):
+                continue
+            file, downloaded = result
+            if downloaded:
+                item["file_path"] = downloaded
+            inputs.append(file)
+        for result in resolved:
+            if isinstance(result, BaseException):
+                raise result
+
+        if len(chunk) == 1:
+            if chunk[0]["media_type"] == "photo":
+                sent = [await bot.send_photo(chat_id=chat_id, photo=inputs[0], caption=chunk_caption)]
+            else:
+                sent = [await bot.send_video(chat_id=chat_id, video=inputs[0], caption=chunk_caption)]
+        else:
+            group = [
+                (InputMediaPhoto if item["media_type"] == "photo" else InputMediaVideo)(
+                    media=file, caption=chunk_caption if index == 0 else None
+                )
+                for index, (item, file) in enumerate(zip(chunk, inputs))
+            ]
+            sent = await bot.send_media_group(chat_id=chat_id, media=group)
+
+        for item, message in zip(chunk, sent):
+            if not item.get("file_id"):
+                item["file_id"] = await remember_file_id(
+                    item["media_id"], item["node_index"], item["media_type"], message
+                )
+        messages.extend(sent)
+    return messages
@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from instagram_parser import _filter_new_posts
+from scheduler import _is_newer, _high_water_marks
+
+
+def _post(mediaid: int, hours_ago: float = 1, is_pinned: bool = False):
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    return SimpleNamespace(mediaid=mediaid, date_utc=now - timedelta(hours=hours_ago), is_pinned=is_pinned)
+
+
+class ExhaustibleFeed:
+    """
+    Лента, которая падает, если её читают дальше нужного.
+    """
+
+    def __init__(self, posts, limit: int):
+        self.posts = posts
+        self.limit = limit
+        self.read = 0
+
+    def __iter__(self):
+        for post in self.posts:
+            self.read += 1
+            assert self.read <= self.limit, "лента прочитана дальше отметки уровня"
+            yield post
+
+
+def test_is_newer_compares_ids_as_numbers():
+    assert _is_newer("10", "9")
+    assert not _is_newer("9", "10")
+    assert not _is_newer("10", "10")
+    assert _is_newer("3000000000000000001", "999999999999999999")
+
+
+def test_is_newer_without_mark():
+    assert _is_newer("1", None)
+
+
+def test_filter_stops_at_mark():
+    feed = ExhaustibleFeed([_post(12), _post(11), _post(10), _post(9)], limit=3)
+    assert [post.mediaid for post in _filter_new_posts(feed, "10")] == [12, 11]
+
+
+def test_filter_mark_of_different_length():
+    posts = [_post(100), _post(99)]
+    assert [post.mediaid for post in _filter_new_posts(posts, "99")] == [100]
+
+
+def test_filter_skips_old_pinned_posts_without_stopping():
+    posts = [_post(5, is_pinned=True), _post(30, is_pinned=True), _post(21), _post(20)]
+    assert [post.mediaid for post in _filter_new_posts(posts, "20")] == [30, 21]
+
+
+def test_filter_bootstrap_takes_recent_posts_only():
+    posts = [_post(3, hours_ago=1), _post(2, hours_ago=2), _post(1, hours_ago=24 * 30)]
+    assert [post.mediaid for post in _filter_new_posts(posts)] == [3, 2]
+
+
+def test_filter_bootstrap_without_time_filter():
+    posts = [_post(2, hours_ago=24 * 30), _post(1, hours_ago=24 * 60)]
+    assert [post.mediaid for post in _filter_new_posts(posts, time_filter=False)] == [2, 1]
+
+
+def test_marks_set_for_new_subscription_without_new_posts():
+    grouped = {"alice": [(1, None, None)]}
+    assert _high_water_marks(grouped, {"alice": 50}, {"alice": 7}, {}) == [(1, "alice", 50, 7)]
+
+
+def test_marks_stay_below_oldest_undelivered_post():
+    grouped = {"alice": [(1, "10", 5), (2, "10", 5)]}
+    pending = {(1, "alice"): {12}, (2, "alice"): set()}
+    assert _high_water_marks(grouped, {"alice": 13}, {"alice": 8}, pending) == [
+        (1, "alice", 11, None),
+        (2, "alice", 13, 8),
+    ]
+
+
+def test_marks_never_move_back():
+    grouped = {"alice": [(1, "20", 5)]}
+    assert _high_water_marks(grouped, {"alice": 20}, {"alice": 5}, {}) == [(1, "alice", None, 5)]
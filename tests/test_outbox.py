@@ -0,0 +1,36 @@
+import asyncio
+
+import outbox
+
+
+def test_new_media_uploaded_once_for_concurrent_chats(monkeypatch):
+    saved = {}
+    uploads = []
+
+    async def get_cached_files(media_id):
+        return saved.get(media_id, {})
+
+    async def send_media_batch(bot, chat_id, items, caption=None):
+        for item in items:
+            if not item.get("file_id"):
+                uploads.append(chat_id)
+                # Загрузка в Telegram занимает время — остальные отправки успевают начаться
+                await asyncio.sleep(0.01)
+                item["file_id"] = f"file-{item['media_id']}"
+                saved.setdefault(item["media_id"], {})[item["node_index"]] = (item["file_id"], item["media_type"])
+
+    monkeypatch.setattr(outbox, "get_cached_files", get_cached_files)
+    monkeypatch.setattr(outbox, "send_media_batch", send_media_batch)
+
+    def payload():
+        return {
+            "items": [{"media_type": "photo", "media_id": "42", "node_index": 0, "source_url": "https://cdn/42.jpg"}],
+            "caption": "Новый пост"
+        }
+
+    async def deliver_to_all():
+        await asyncio.gather(*(outbox._send(None, chat_id, payload()) for chat_id in range(30)))
+
+    asyncio.run(deliver_to_all())
+    assert len(uploads) == 1
+    assert not outbox._uploads
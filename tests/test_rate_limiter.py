@@ -0,0 +1,42 @@
+import time
+import asyncio
+import sqlite3
+
+import database
+from rate_limiter import TokenBucket
+
+
+def test_shared_acquire_does_not_block_event_loop(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "bot.db"))
+    database.initialize_database()
+    database.close_connection()
+    bucket = TokenBucket("test", 1000, 1000, shared=True)
+
+    # Другой процесс держит блокировку записи базы
+    holder = sqlite3.connect(str(tmp_path / "bot.db"))
+    holder.execute("BEGIN IMMEDIATE")
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.5, holder.commit)
+        gaps = []
+
+        async def tick():
+            while True:
+                started = time.monotonic()
+                await asyncio.sleep(0.01)
+                gaps.append(time.monotonic() - started)
+
+        ticker = asyncio.create_task(tick())
+        started = time.monotonic()
+        await bucket.acquire_async()
+        waited = time.monotonic() - started
+        ticker.cancel()
+        return waited, max(gaps)
+
+    try:
+        waited, longest_gap = asyncio.run(run())
+    finally:
+        holder.close()
+    assert waited >= 0.4
+    assert longest_gap < 0.2
@@ -0,0 +1,49 @@
+import asyncio
+
+import scheduler
+from rate_limiter import RateLimitedError
+
+
+def test_busy_fetch_keeps_interval_and_retries(monkeypatch):
+    completed = []
+    released = []
+
+    async def get_subscriptions_grouped():
+        return {"alice": [(1, "10", 5)], "bob": [(2, "20", 7)]}
+
+    async def fetch_new_posts(username, last_sent_post_id=None, last_seen_mediacount=None):
+        if username == "alice":
+            raise RateLimitedError("Лимитер graphql: запросы приостановлены")
+        return [], 7, 20
+
+    async def fetch_story_items(username):
+        return []
+
+    async def nothing(*args, **kwargs):
+        return 0
+
+    async def complete_poll_jobs(owner, entries):
+        completed.extend(entries)
+
+    async def release_poll_jobs(owner, entries):
+        released.extend(entries)
+
+    monkeypatch.setattr(scheduler, "get_subscriptions_grouped", get_subscriptions_grouped)
+    monkeypatch.setattr(scheduler, "fetch_new_posts", fetch_new_posts)
+    monkeypatch.setattr(scheduler, "fetch_story_items", fetch_story_items)
+    monkeypatch.setattr(scheduler, "purge_seen_stories", nothing)
+    monkeypatch.setattr(scheduler, "update_high_water_marks", nothing)
+    monkeypatch.setattr(scheduler, "mark_stories_seen", nothing)
+    monkeypatch.setattr(scheduler, "extend_poll_job_leases", nothing)
+    monkeypatch.setattr(scheduler, "complete_poll_jobs", complete_poll_jobs)
+    monkeypatch.setattr(scheduler, "release_poll_jobs", release_poll_jobs)
+
+    asyncio.run(scheduler._process_jobs(None, "worker", [("alice", 600, 1), ("bob", 600, 1)]))
+
+    # Ограниченный профиль не проверен: интервал не растёт, повтор — скоро
+    assert [username for username, _ in released] == ["alice"]
+    assert released[0][1] - scheduler.time.time() <= scheduler.SCHEDULER_MIN_INTERVAL
+    # Профиль без нового контента проверяется реже
+    assert [(username, interval) for username, interval, _ in completed] == [
+        ("bob", min(scheduler.SCHEDULER_MAX_INTERVAL, 600 * scheduler.SCHEDULER_BACKOFF))
+    ]
@@ -0,0 +1,53 @@
+import time
+
+import instaloader
+import pytest
+
+from session_pool import SessionPool, InstaSession, NoSessionAvailableError
+
+
+class FailingLoader:
+    """
+    Instaloader, у которого переавторизация падает с заданной ошибкой.
+    """
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+    def login(self, username, password):
+        raise self.error
+
+    def load_session_from_file(self, username, filename=None):
+        raise self.error
+
+
+def _pool(error: Exception) -> SessionPool:
+    pool = SessionPool("sessions", cooldown=60, loader_factory=lambda: FailingLoader(error))
+    pool.add(InstaSession("alice", "sessions/session-alice", FailingLoader(error)))
+    return pool
+
+
+def test_failed_relogin_pauses_session():
+    pool = _pool(instaloader.exceptions.ConnectionException("network is down"))
+    session = pool.sessions[0]
+
+    assert not pool.reauthenticate(session)
+    assert session.healthy
+    assert session.cooldown_until > time.monotonic()
+    with pytest.raises(NoSessionAvailableError):
+        with pool.lease(timeout=1):
+            pass
+
+    # Пауза прошла — сессию снова можно арендовать
+    session.cooldown_until = 0
+    with pool.lease(timeout=1) as leased:
+        assert leased is session
+
+
+def test_bad_credentials_remove_session():
+    pool = _pool(instaloader.exceptions.BadCredentialsException("wrong password"))
+    pool.credentials["alice"] = "secret"
+    session = pool.sessions[0]
+
+    assert not pool.reauthenticate(session)
+    assert not session.healthy
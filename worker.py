@@ -0,0 +1,54 @@
+import asyncio
+import logging
+from aiogram import Bot
+from database import initialize_database
+from instagram_parser import login
+from scheduler import run_worker
+from metrics import start_metrics_server
+from media_cache import collect_garbage
+from config.config import TELEGRAM_TOKEN, INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD, METRICS_HOST, WORKER_METRICS_PORT
+
+###############################
+# НАСТРОЙКИ И ЛОГИРОВАНИЕ
+###############################
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+###############################
+# ЗАПУСК
+###############################
+# Отдельный процесс проверок: не принимает апдейты Telegram, только проверяет профили
+# и ставит новое в исходящую очередь (её рассылает процесс бота, main.py).
+# Процессов можно запустить несколько, но только на той же машине, что и бот: база SQLite (WAL)
+# и медиакэш MEDIA_CACHE_FOLDER должны лежать на локальном диске. Профили делятся между
+# процессами через аренду заданий, а лимит запросов к Instagram (GRAPHQL_RATE) и паузы сессий —
+# общие для всех процессов, так что аккаунты не получают больше запросов, чем с одним процессом.
+# Бюджет аренд SESSION_REQUEST_BUDGET считает каждый процесс сам.
+async def main():
+    logging.info("Инициализация базы данных...")
+    initialize_database()
+    collect_garbage()
+
+    logging.info("Авторизация в Instagram...")
+    try:
+        login(INSTAGRAM_USERNAME, INSTAGRAM_PASSWORD)
+    except Exception as e:
+        logging.error(f"Ошибка авторизации в Instagram: {e}")
+        return
+
+    metrics_runner = await start_metrics_server(METRICS_HOST, WORKER_METRICS_PORT)
+    bot = Bot(token=TELEGRAM_TOKEN)
+    try:
+        await run_worker(bot)
+    finally:
+        await bot.session.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, SystemExit):
+        logging.info("Воркер остановлен вручную.")